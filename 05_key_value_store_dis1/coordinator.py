@@ -2,16 +2,26 @@ import asyncio
 import os
 import logging
 import random
-from typing import Dict, List, Any, Optional
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from contextlib import asynccontextmanager
+from typing import Dict, List, Any, Optional, Tuple
+from urllib.parse import urlencode
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Query, Request, Response
 from pydantic import BaseModel
 import httpx
 
+# h2 è opzionale: senza il pacchetto il client verso i nodi usa solo HTTP/1.1
+try:
+    import h2  # noqa: F401
+    H2_AVAILABLE = True
+except ImportError:
+    H2_AVAILABLE = False
+
 # Configurazione del logger
+LOG_FILE = os.environ.get("COORDINATOR_LOG_FILE", "coordinator.log")
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='coordinator.log'
+    filename=LOG_FILE
 )
 logger = logging.getLogger("coordinator")
 
@@ -28,10 +38,12 @@ class NodeResponse(BaseModel):
     success: bool
     value: Optional[Any] = None
     error: Optional[str] = None
+    status_code: Optional[int] = None
 
 class KeyValueResponse(BaseModel):
     key: str
     value: Any
+    version: Optional[int] = None
     quorum_size: int
     responses: List[NodeResponse]
 
@@ -39,56 +51,182 @@ class KeyValueResponse(BaseModel):
 KVS_NODES = os.environ.get("KVS_NODES", "").split(",")
 QUORUM_SIZE = int(os.environ.get("QUORUM_SIZE", max(len(KVS_NODES) // 2 + 1, 1)))
 REQUEST_TIMEOUT = int(os.environ.get("REQUEST_TIMEOUT", 10))  # secondi
+KEYS_PAGE_SIZE = int(os.environ.get("KEYS_PAGE_SIZE", 1000))  # Chiavi richieste ai nodi per pagina
+# Pagina massima accettata dai nodi (KEYS_PAGE_MAX del nodo): oltre, i nodi rispondono 422
+KEYS_PAGE_MAX = int(os.environ.get("KEYS_PAGE_MAX", 10000))
+# Client HTTP condiviso verso i nodi: le connessioni restano aperte (keep-alive) tra una richiesta e l'altra
+NODE_MAX_CONNECTIONS = int(os.environ.get("NODE_MAX_CONNECTIONS", 50))  # Richieste contemporanee per nodo
+NODE_KEEPALIVE_CONNECTIONS = int(os.environ.get("NODE_KEEPALIVE_CONNECTIONS", 10))  # Connessioni inattive mantenute per nodo
+KEEPALIVE_EXPIRY = float(os.environ.get("KEEPALIVE_EXPIRY", 30))  # secondi prima di chiudere una connessione inattiva
+CONNECT_TIMEOUT = float(os.environ.get("CONNECT_TIMEOUT", 2))  # secondi per aprire una connessione
+HTTP2 = os.environ.get("HTTP2", "0") == "1"
+
+# Validazione della configurazione
+if KEYS_PAGE_SIZE < 1 or KEYS_PAGE_SIZE > KEYS_PAGE_MAX:
+    logger.error(f"KEYS_PAGE_SIZE deve essere tra 1 e KEYS_PAGE_MAX ({KEYS_PAGE_MAX}), ricevuto: {KEYS_PAGE_SIZE}")
+    KEYS_PAGE_SIZE = max(1, min(KEYS_PAGE_MAX, KEYS_PAGE_SIZE))  # Fallback a un valore valido
 
 logger.info(f"Configurato coordinatore con {len(KVS_NODES)} nodi e quorum di {QUORUM_SIZE}")
 logger.info(f"Nodi configurati: {KVS_NODES}")
 
-# Inizializzazione FastAPI
-app = FastAPI(title="KV Store Coordinator")
+# Client HTTP verso i nodi, creato nel lifespan e condiviso da tutte le richieste
+http_client: Optional[httpx.AsyncClient] = None
+# Limite di richieste contemporanee per nodo: un nodo lento non occupa tutte le connessioni del pool
+node_slots: Dict[str, asyncio.Semaphore] = {}
+
+def create_http_client() -> httpx.AsyncClient:
+    """Crea il client condiviso: pool di connessioni keep-alive, timeout separato per la connessione
+    e HTTP/2 opzionale"""
+    http2 = HTTP2 and H2_AVAILABLE
+    if HTTP2 and not H2_AVAILABLE:
+        logger.warning("HTTP2=1 ma il pacchetto h2 non è installato: il client usa HTTP/1.1")
+    logger.info(f"Client verso i nodi: {NODE_MAX_CONNECTIONS} richieste contemporanee per nodo, "
+                f"keep-alive {KEEPALIVE_EXPIRY}s, {'HTTP/2' if http2 else 'HTTP/1.1'}")
+    limits = httpx.Limits(
+        max_connections=None,  # Limitate per nodo da node_slots
+        max_keepalive_connections=NODE_KEEPALIVE_CONNECTIONS * max(len(KVS_NODES), 1),
+        keepalive_expiry=KEEPALIVE_EXPIRY
+    )
+    timeout = httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
+
+def node_slot(node: str) -> asyncio.Semaphore:
+    """Semaforo che limita le richieste contemporanee verso un nodo"""
+    slot = node_slots.get(node)
+    if slot is None:
+        slot = node_slots[node] = asyncio.Semaphore(NODE_MAX_CONNECTIONS)
+    return slot
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    http_client = create_http_client()
+    
+    yield
+    
+    await http_client.aclose()
+    http_client = None
+
+# Inizializzazione FastAPI con lifespan
+app = FastAPI(title="KV Store Coordinator", lifespan=lifespan)
 
 # Funzioni di utilità
 async def request_node(client: httpx.AsyncClient, node: str, method: str, endpoint: str, 
-                      json: Dict = None) -> NodeResponse:
+                      json: Dict = None, params: Dict = None) -> NodeResponse:
     """Esegue una richiesta a un nodo specifico del KV store"""
     try:
-        if method.upper() == "GET":
-            response = await client.get(f"http://{node}{endpoint}", timeout=REQUEST_TIMEOUT)
-        elif method.upper() == "PUT":
-            response = await client.put(f"http://{node}{endpoint}", json=json, timeout=REQUEST_TIMEOUT)
-        elif method.upper() == "DELETE":
-            response = await client.delete(f"http://{node}{endpoint}", timeout=REQUEST_TIMEOUT)
-        else:
-            return NodeResponse(node=node, success=False, error=f"Metodo non supportato: {method}")
+        async with node_slot(node):
+            if method.upper() == "GET":
+                response = await client.get(f"http://{node}{endpoint}", params=params)
+            elif method.upper() == "PUT":
+                response = await client.put(f"http://{node}{endpoint}", json=json, params=params)
+            elif method.upper() == "DELETE":
+                response = await client.delete(f"http://{node}{endpoint}", params=params)
+            elif method.upper() == "POST":
+                response = await client.post(f"http://{node}{endpoint}", json=json, params=params)
+            else:
+                return NodeResponse(node=node, success=False, error=f"Metodo non supportato: {method}")
         
         if response.status_code >= 200 and response.status_code < 300:
-            return NodeResponse(node=node, success=True, value=response.json())
+            return NodeResponse(node=node, success=True, value=response.json(), status_code=response.status_code)
         else:
-            return NodeResponse(node=node, success=False, error=f"Errore {response.status_code}: {response.text}")
+            return NodeResponse(node=node, success=False, error=f"Errore {response.status_code}: {response.text}",
+                                status_code=response.status_code)
     
     except Exception as e:
         logger.error(f"Errore durante la richiesta al nodo {node}: {str(e)}")
         return NodeResponse(node=node, success=False, error=str(e))
 
+def newest_response(responses: List[NodeResponse]) -> NodeResponse:
+    """Tra le risposte positive, quella con la versione più alta: una replica che ha perso
+    delle scritture ha una versione minore. A parità di versione (nodi senza NODE_ID, dopo un
+    cambio di primario) vince il nodo con il nome più alto, così lettura e ribilanciamento
+    scelgono la stessa copia"""
+    return max(responses, key=lambda response: (response.value.get("version") or 0, response.node))
+
+def not_modified(request: Request, version: Optional[int]) -> Optional[Response]:
+    """Risposta 304 se il client ha già la versione indicata (If-None-Match con il suo ETag)"""
+    header = request.headers.get("if-none-match")
+    if version is None or not header:
+        return None
+    etag = f'"{version}"'
+    if any(tag.strip() in (etag, "W/" + etag, "*") for tag in header.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+async def replicated_put(client: httpx.AsyncClient, nodes: List[str], key: str, value: Any,
+                         if_version: Optional[int] = None) -> Tuple[Optional[int], int, List[NodeResponse]]:
+    """Scrive prima su un nodo primario, che controlla if_version e assegna la versione, poi invia
+    la stessa versione alle altre repliche: tutte le copie di una scrittura hanno la stessa versione.
+    Restituisce versione, numero di repliche aggiornate e risposte dei nodi"""
+    node_responses = []
+    params = {"if_version": if_version} if if_version is not None else None
+    version = None
+    for index, node in enumerate(nodes):
+        response = await request_node(client, node, "PUT", f"/key/{key}", json={"value": value}, params=params)
+        node_responses.append(response)
+        if response.success:
+            version = response.value.get("version")
+            break
+        if response.status_code == 412:
+            raise HTTPException(status_code=412, detail=f"Versione della chiave '{key}' non corrispondente: {response.error}")
+    else:
+        return None, 0, node_responses
+    
+    # Le repliche applicano la versione solo se più recente: 409 indica una copia già aggiornata
+    tasks = [request_node(client, node, "PUT", f"/key/{key}", json={"value": value}, params={"version": version})
+             for node in nodes[index + 1:]]
+    responses = await asyncio.gather(*tasks)
+    node_responses.extend(responses)
+    successful_writes = 1 + sum(1 for response in responses if response.success or response.status_code == 409)
+    return version, successful_writes, node_responses
+
+async def fetch_keys_page(client: httpx.AsyncClient, after: str, limit: int) -> Tuple[List[str], Optional[str]]:
+    """Unisce le pagine di chiavi dei nodi (ognuna in ordine) e restituisce il cursore della pagina successiva;
+    se nessun nodo risponde solleva un errore invece di restituire una pagina vuota"""
+    # Il cursore vuoto della prima pagina precede ogni chiave: i nodi rifiutano le chiavi vuote
+    endpoint = "/keys?" + urlencode({"after": after, "limit": limit})
+    responses = await asyncio.gather(*[request_node(client, node, "GET", endpoint) for node in KVS_NODES])
+    
+    keys = set()
+    # Oltre il cursore più basso tra i nodi con altre pagine, le chiavi di quei nodi non sono ancora note
+    bound = None
+    answered = 0
+    for response in responses:
+        if response.success and response.value and "keys" in response.value:
+            answered += 1
+            keys.update(response.value["keys"])
+            node_next = response.value.get("next_after")
+            if node_next is not None and (bound is None or node_next < bound):
+                bound = node_next
+        else:
+            logger.warning(f"Pagina di chiavi non ottenuta dal nodo {response.node}: {response.error}")
+    
+    if not answered:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Nessun nodo ha restituito le chiavi: {responses[0].error if responses else 'nessun nodo configurato'}"
+        )
+    
+    merged = sorted(key for key in keys if bound is None or key <= bound)
+    if len(merged) > limit:
+        return merged[:limit], merged[limit - 1]
+    return merged, bound
+
 # Routes
 @app.get("/")
 async def root():
     return {"message": "KV Store Coordinator", "nodes": KVS_NODES, "quorum_size": QUORUM_SIZE}
 
 @app.get("/keys")
-async def get_all_keys():
-    """Ottiene tutte le chiavi da almeno un nodo"""
-    all_keys = set()
-    
-    async with httpx.AsyncClient() as client:
-        for node in KVS_NODES:
-            response = await request_node(client, node, "GET", "/keys")
-            if response.success and response.value and "keys" in response.value:
-                all_keys.update(response.value["keys"])
+async def get_all_keys(after: str = "", limit: int = Query(KEYS_PAGE_SIZE, ge=1, le=KEYS_PAGE_MAX)):
+    """Ottiene le chiavi di tutti i nodi in ordine, una pagina alla volta: next_after è il cursore della pagina successiva"""
+    keys, next_after = await fetch_keys_page(http_client, after, limit)
     
-    return {"keys": list(all_keys)}
+    return {"keys": keys, "next_after": next_after}
 
 @app.get("/key/{key}")
-async def get_value(key: str):
+async def get_value(key: str, request: Request, response: Response):
     """Ottiene il valore associato a una chiave con quorum"""
     if not KVS_NODES:
         raise HTTPException(status_code=500, detail="Nessun nodo KV Store configurato")
@@ -98,18 +236,14 @@ async def get_value(key: str):
     successful_responses = []
     node_responses = []
     
-    async with httpx.AsyncClient() as client:
-        tasks = [request_node(client, node, "GET", f"/key/{key}") for node in nodes]
-        responses = await asyncio.gather(*tasks)
+    tasks = [request_node(http_client, node, "GET", f"/key/{key}") for node in nodes]
+    responses = await asyncio.gather(*tasks)
         
-        for response in responses:
-            node_responses.append(response)
-            if response.success:
-                successful_responses.append(response)
-                
-                # Se abbiamo raggiunto il quorum, possiamo interrompere
-                if len(successful_responses) >= QUORUM_SIZE:
-                    break
+    # Le risposte arrivano tutte insieme: si tengono tutte per scegliere la versione più recente
+    for node_response in responses:
+        node_responses.append(node_response)
+        if node_response.success:
+            successful_responses.append(node_response)
     
     # Verifica se abbiamo raggiunto il quorum
     if len(successful_responses) < QUORUM_SIZE:
@@ -118,33 +252,31 @@ async def get_value(key: str):
             detail=f"Quorum non raggiunto per la chiave '{key}'. Ottenute {len(successful_responses)} risposte su {QUORUM_SIZE} richieste."
         )
     
-    # Estrai il valore dal primo nodo che ha risposto con successo
-    value = successful_responses[0].value["value"]
+    # Tra le repliche che hanno risposto vince quella con la versione più recente
+    newest = newest_response(successful_responses).value
+    version = newest.get("version")
+    cached = not_modified(request, version)
+    if cached is not None:
+        return cached
+    if version is not None:
+        response.headers["ETag"] = f'"{version}"'
     
     return KeyValueResponse(
         key=key,
-        value=value,
+        value=newest["value"],
+        version=version,
         quorum_size=QUORUM_SIZE,
         responses=node_responses
     )
 
 @app.put("/key/{key}")
-async def put_value(key: str, item: KeyValue, background_tasks: BackgroundTasks):
+async def put_value(key: str, item: KeyValue, background_tasks: BackgroundTasks,
+                    if_version: Optional[int] = Query(None, ge=0, description="Scrive solo se la versione attuale è questa (0: la chiave non deve esistere)")):
     """Inserisce o aggiorna un valore su tutti i nodi (replicazione completa)"""
     if not KVS_NODES:
         raise HTTPException(status_code=500, detail="Nessun nodo KV Store configurato")
     
-    successful_writes = 0
-    node_responses = []
-    
-    async with httpx.AsyncClient() as client:
-        tasks = [request_node(client, node, "PUT", f"/key/{key}", json={"value": item.value}) for node in KVS_NODES]
-        responses = await asyncio.gather(*tasks)
-        
-        for response in responses:
-            node_responses.append(response)
-            if response.success:
-                successful_writes += 1
+    version, successful_writes, node_responses = await replicated_put(http_client, KVS_NODES, key, item.value, if_version)
     
     # Verifica se la scrittura è avvenuta con successo su almeno un nodo
     if successful_writes == 0:
@@ -161,6 +293,7 @@ async def put_value(key: str, item: KeyValue, background_tasks: BackgroundTasks)
     return KeyValueResponse(
         key=key,
         value=item.value,
+        version=version,
         quorum_size=successful_writes,
         responses=node_responses
     )
@@ -174,14 +307,13 @@ async def delete_value(key: str):
     successful_deletes = 0
     node_responses = []
     
-    async with httpx.AsyncClient() as client:
-        tasks = [request_node(client, node, "DELETE", f"/key/{key}") for node in KVS_NODES]
-        responses = await asyncio.gather(*tasks)
+    tasks = [request_node(http_client, node, "DELETE", f"/key/{key}") for node in KVS_NODES]
+    responses = await asyncio.gather(*tasks)
         
-        for response in responses:
-            node_responses.append(response)
-            if response.success:
-                successful_deletes += 1
+    for response in responses:
+        node_responses.append(response)
+        if response.success:
+            successful_deletes += 1
     
     # Verifica se la cancellazione è avvenuta con successo su almeno un nodo
     if successful_deletes == 0:
@@ -200,13 +332,12 @@ async def get_stats():
     """Ottiene le statistiche da tutti i nodi"""
     node_stats = {}
     
-    async with httpx.AsyncClient() as client:
-        tasks = [request_node(client, node, "GET", "/stats") for node in KVS_NODES]
-        responses = await asyncio.gather(*tasks)
+    tasks = [request_node(http_client, node, "GET", "/stats") for node in KVS_NODES]
+    responses = await asyncio.gather(*tasks)
         
-        for response in responses:
-            if response.success:
-                node_stats[response.node] = response.value
+    for response in responses:
+        if response.success:
+            node_stats[response.node] = response.value
     
     return {
         "coordinator": {
@@ -222,12 +353,11 @@ async def force_sync():
     """Forza la sincronizzazione su tutti i nodi"""
     results = []
     
-    async with httpx.AsyncClient() as client:
-        tasks = [request_node(client, node, "POST", "/force-sync") for node in KVS_NODES]
-        responses = await asyncio.gather(*tasks)
+    tasks = [request_node(http_client, node, "POST", "/force-sync") for node in KVS_NODES]
+    responses = await asyncio.gather(*tasks)
         
-        for response in responses:
-            results.append(response)
+    for response in responses:
+        results.append(response)
     
     return {
         "status": "completed",
@@ -1,13 +1,23 @@
 import time
+import asyncio
 import sqlite3
 import logging
 import threading
+import json
 import sys
 import os
-from typing import Dict, Any, Optional, List, Tuple, OrderedDict
+import struct
+import zlib
+import base64
+import bisect
+import math
+from typing import Dict, Any, Optional, List, Set, Tuple, OrderedDict
+from abc import ABC, abstractmethod
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Query, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
 # Lettura delle variabili d'ambiente
@@ -15,69 +25,236 @@ MAX_CACHE_ITEMS = int(os.environ.get("MAX_CACHE_ITEMS", 1000))
 MAX_CACHE_SIZE_BYTES = int(os.environ.get("MAX_CACHE_SIZE_BYTES", 10 * 1024 * 1024))  # 10 MB in bytes
 DB_FILE = os.environ.get("DB_FILE", "kv_store.db")
 LOG_FILE = os.environ.get("LOG_FILE", "kv_store.log")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")  # DEBUG registra anche ogni richiesta con il suo valore
 
 # Configurazione del logger
 logging.basicConfig(
-    level=logging.INFO,
+    level=LOG_LEVEL,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     filename=LOG_FILE
 )
 logger = logging.getLogger("kv_store")
 
-# Modelli Pydantic
-class KeyValue(BaseModel):
-    value: Any
+# msgpack è opzionale: senza il pacchetto i valori si scambiano solo in JSON
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
+# Modelli Pydantic
 class StatusResponse(BaseModel):
     status: str
     message: str
 
+class KeysRequest(BaseModel):
+    keys: List[str]
+
+# Codifica dei valori: nel database, nella cache, nel batch e nel log ogni valore è il suo
+# JSON canonico (compatto, UTF-8), così le risposte lo includono senza ricodificarlo
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+def encode_value(value) -> bytes:
+    """Serializza un valore nel JSON canonico"""
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def decode_value(data: bytes):
+    return json.loads(expand_value(data))
+
+# Compressione dei valori grandi: la forma memorizzata (cache, batch, log e database) è il JSON
+# oppure COMPRESSED_MARKER seguito dal JSON compresso con zlib. Il marcatore è il flag per voce:
+# nessun JSON inizia con un byte nullo. La decompressione avviene solo quando il valore viene letto
+COMPRESSION_THRESHOLD_BYTES = int(os.environ.get("COMPRESSION_THRESHOLD_BYTES", 1024))  # 0: disattivata
+COMPRESSION_LEVEL = int(os.environ.get("COMPRESSION_LEVEL", 6))
+COMPRESSED_MARKER = b"\x00"
+
+compression_stats: Dict[str, Any] = {
+    "compressed_values": 0,
+    "incompressible_values": 0,  # Compressi senza guadagno: memorizzati in chiaro
+    "input_bytes": 0,
+    "output_bytes": 0,
+    "compress_cpu_seconds": 0.0,
+    "decompressed_values": 0,
+    "decompress_cpu_seconds": 0.0
+}
+
+def is_compressed(data: bytes) -> bool:
+    return data[:1] == COMPRESSED_MARKER
+
+def compress_value(data: bytes) -> bytes:
+    """Forma memorizzata di un valore serializzato: compresso solo oltre la soglia e se più piccolo"""
+    if not COMPRESSION_THRESHOLD_BYTES or len(data) < COMPRESSION_THRESHOLD_BYTES:
+        return data
+    # Tempo di CPU del solo thread corrente, non influenzato dagli altri thread del processo
+    start = time.thread_time()
+    compressed = COMPRESSED_MARKER + zlib.compress(data, COMPRESSION_LEVEL)
+    compression_stats["compress_cpu_seconds"] += time.thread_time() - start
+    if len(compressed) >= len(data):
+        compression_stats["incompressible_values"] += 1
+        return data
+    compression_stats["compressed_values"] += 1
+    compression_stats["input_bytes"] += len(data)
+    compression_stats["output_bytes"] += len(compressed)
+    return compressed
+
+def expand_value(data: bytes) -> bytes:
+    """JSON di un valore nella forma memorizzata"""
+    if not is_compressed(data):
+        return data
+    start = time.thread_time()
+    expanded = zlib.decompress(data[1:])
+    compression_stats["decompress_cpu_seconds"] += time.thread_time() - start
+    compression_stats["decompressed_values"] += 1
+    return expanded
+
+def get_compression_stats():
+    stats = dict(compression_stats)
+    stats["ratio"] = round(stats["input_bytes"] / stats["output_bytes"], 3) if stats["output_bytes"] else None
+    stats["compress_cpu_seconds"] = round(stats["compress_cpu_seconds"], 6)
+    stats["decompress_cpu_seconds"] = round(stats["decompress_cpu_seconds"], 6)
+    stats["threshold_bytes"] = COMPRESSION_THRESHOLD_BYTES
+    stats["level"] = COMPRESSION_LEVEL
+    return stats
+
+def raw_json_object(fields: List[Tuple[str, bytes]]) -> bytes:
+    """Oggetto JSON composto da campi già serializzati, senza ricodificarli"""
+    return b"{" + b",".join(encode_value(name) + b":" + data for name, data in fields) + b"}"
+
+async def read_body(request: Request):
+    """Decodifica il corpo della richiesta in base al Content-Type (JSON o msgpack)"""
+    body = await request.body()
+    content_type = request.headers.get("content-type", JSON_MEDIA_TYPE).split(";")[0].strip().lower()
+    if content_type in MSGPACK_MEDIA_TYPES:
+        if msgpack is None:
+            raise HTTPException(status_code=415, detail="msgpack is not available on this node")
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid msgpack body")
+    if content_type == JSON_MEDIA_TYPE or content_type.endswith("+json"):
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+    raise HTTPException(status_code=415, detail=f"Unsupported content type: {content_type}")
+
+def encode_request_value(value) -> bytes:
+    """Serializza un valore ricevuto, rifiutando quelli non rappresentabili in JSON (es. binari msgpack)"""
+    try:
+        return encode_value(value)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=422, detail="Value is not representable as JSON")
+
+def encoded_response(request: Request, fields: List[Tuple[str, bytes]],
+                     headers: Optional[Dict[str, str]] = None) -> Response:
+    """Risposta con campi già serializzati: in JSON li concatena, in msgpack (se richiesto) li converte"""
+    if msgpack is not None and any(media_type in request.headers.get("accept", "") for media_type in MSGPACK_MEDIA_TYPES):
+        content = msgpack.packb({name: decode_value(data) for name, data in fields}, use_bin_type=True)
+        return Response(content=content, media_type=MSGPACK_MEDIA_TYPES[0], headers=headers)
+    return Response(content=raw_json_object(fields), media_type=JSON_MEDIA_TYPE, headers=headers)
+
 # Cache in memoria con LRU (Least Recently Used)
 class LRUCache:
-    def __init__(self, max_items=1000, max_size_bytes=10*1024*1024):
+    def __init__(self, max_items=1000, max_size_bytes=10*1024*1024, read_promotion="lru"):
+        # Ogni voce è una lista [valore, dimensione in bytes, bit di riferimento];
+        # la dimensione è calcolata una sola volta all'inserimento
         self.cache = OrderedDict()
         self.max_items = max_items
         self.max_size_bytes = max_size_bytes
         self.current_size_bytes = 0
         self.lock = threading.RLock()
+        # "lru": ogni lettura sposta l'elemento in coda (sotto lock)
+        # "clock": la lettura imposta solo il bit di riferimento, senza lock;
+        # l'elemento riceve una seconda possibilità al momento della rimozione
+        self.read_promotion = read_promotion
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
     
     def get(self, key):
         """Ottiene un valore dalla cache, aggiorna l'ordine LRU"""
+        if self.read_promotion == "clock":
+            # Lettura atomica grazie al GIL: nessun lock e nessun riordino
+            # (i contatori di hit/miss sono quindi approssimati)
+            entry = self.cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry[2] = True
+            return entry[0]
+        
         with self.lock:
             if key not in self.cache:
+                self.misses += 1
                 return None
             
             # Sposta l'elemento alla fine (più recentemente usato)
-            value = self.cache.pop(key)
-            self.cache[key] = value
-            return value
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key][0]
+    
+    def peek(self, key):
+        """Legge un valore senza aggiornare ordine e contatori (lettura atomica grazie al GIL)"""
+        entry = self.cache.get(key)
+        return entry[0] if entry is not None else None
+    
+    def get_many(self, keys):
+        """Ottiene i valori presenti in cache per più chiavi con una sola acquisizione del lock"""
+        result = {}
+        if self.read_promotion == "clock":
+            for key in keys:
+                entry = self.cache.get(key)
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                entry[2] = True
+                result[key] = entry[0]
+            return result
+        
+        with self.lock:
+            for key in keys:
+                entry = self.cache.get(key)
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                self.cache.move_to_end(key)
+                result[key] = entry[0]
+        return result
     
-    def put(self, key, value):
+    def put(self, key, value, size=None):
         """Inserisce un valore nella cache, rispettando i limiti"""
+        # La dimensione viene calcolata fuori dal lock, sul payload serializzato
+        new_item_size = self._get_item_size(key, value) if size is None else size
+        
         with self.lock:
             # Se la chiave esiste già, rimuovila prima di inserirla di nuovo
             if key in self.cache:
-                old_value = self.cache.pop(key)
-                self.current_size_bytes -= self._get_item_size(key, old_value)
-            
-            # Calcola la dimensione del nuovo elemento
-            new_item_size = self._get_item_size(key, value)
+                old_entry = self.cache.pop(key)
+                self.current_size_bytes -= old_entry[1]
             
             # Verifica se la dimensione del nuovo elemento è accettabile
             if new_item_size > self.max_size_bytes:
-                logger.warning(f"L'elemento con chiave '{key}' è troppo grande per la cache ({new_item_size} bytes)")
+                logger.warning("L'elemento con chiave '%s' è troppo grande per la cache (%d bytes)", key, new_item_size)
                 return False
             
             # Rimuovi elementi finché non c'è abbastanza spazio
             while (len(self.cache) >= self.max_items or 
                    self.current_size_bytes + new_item_size > self.max_size_bytes) and self.cache:
-                oldest_key, oldest_value = self.cache.popitem(last=False)
-                oldest_size = self._get_item_size(oldest_key, oldest_value)
-                self.current_size_bytes -= oldest_size
-                logger.debug(f"Rimosso dalla cache l'elemento '{oldest_key}' ({oldest_size} bytes)")
+                oldest_key, oldest_entry = self.cache.popitem(last=False)
+                if oldest_entry[2]:
+                    # CLOCK: l'elemento è stato letto di recente, seconda possibilità
+                    oldest_entry[2] = False
+                    self.cache[oldest_key] = oldest_entry
+                    continue
+                self.current_size_bytes -= oldest_entry[1]
+                self.evictions += 1
+                logger.debug("Rimosso dalla cache l'elemento '%s' (%d bytes)", oldest_key, oldest_entry[1])
             
             # Inserisci il nuovo elemento
-            self.cache[key] = value
+            self.cache[key] = [value, new_item_size, False]
             self.current_size_bytes += new_item_size
             return True
     
@@ -85,23 +262,29 @@ class LRUCache:
         """Elimina un elemento dalla cache"""
         with self.lock:
             if key in self.cache:
-                value = self.cache.pop(key)
-                self.current_size_bytes -= self._get_item_size(key, value)
+                entry = self.cache.pop(key)
+                self.current_size_bytes -= entry[1]
                 return True
             return False
     
     def _get_item_size(self, key, value):
-        """Stima la dimensione in bytes di un elemento in cache"""
-        # Questa è una stima approssimativa, la dimensione reale dipende da molti fattori
-        key_size = sys.getsizeof(key)
-        value_size = sys.getsizeof(value)
-        return key_size + value_size
+        """Calcola la dimensione in bytes di un elemento dal suo payload serializzato"""
+        return get_item_size(key, value)
     
     def keys(self):
         """Restituisce tutte le chiavi nella cache"""
         with self.lock:
             return list(self.cache.keys())
     
+    def hot_keys(self):
+        """Chiavi dalla prossima da rimuovere alla più preziosa"""
+        with self.lock:
+            if self.read_promotion != "clock":
+                return list(self.cache.keys())
+            # CLOCK: le chiavi senza bit di riferimento vengono rimosse per prime, nell'ordine della lancetta
+            return ([key for key, entry in self.cache.items() if not entry[2]] +
+                    [key for key, entry in self.cache.items() if entry[2]])
+    
     def clear(self):
         """Svuota la cache"""
         with self.lock:
@@ -116,120 +299,2360 @@ class LRUCache:
                 "max_items": self.max_items,
                 "size_bytes": self.current_size_bytes,
                 "max_size_bytes": self.max_size_bytes,
-                "utilization_percent": round((self.current_size_bytes / self.max_size_bytes) * 100, 2) if self.max_size_bytes > 0 else 0
+                "utilization_percent": round((self.current_size_bytes / self.max_size_bytes) * 100, 2) if self.max_size_bytes > 0 else 0,
+                "policy": "lru",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": get_hit_ratio(self.hits, self.misses),
+                "evictions": self.evictions
             }
 
+# Politiche di rimozione alternative all'LRU
+class EvictionPolicy(ABC):
+    """Interfaccia delle politiche di rimozione: gestiscono solo l'ordine delle chiavi"""
+    name = "base"
+    
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+    
+    def record_access(self, key):
+        """Registra un accesso (hit) a una chiave presente"""
+    
+    def record_miss(self, key):
+        """Registra la richiesta di una chiave assente"""
+    
+    def before_insert(self, key):
+        """Prepara l'inserimento di una nuova chiave"""
+    
+    @abstractmethod
+    def record_insert(self, key):
+        """Registra l'inserimento di una nuova chiave"""
+    
+    @abstractmethod
+    def record_remove(self, key):
+        """Registra la cancellazione esplicita di una chiave"""
+    
+    def record_evict(self, key):
+        """Registra la rimozione di una chiave scelta come vittima"""
+        self.record_remove(key)
+    
+    @abstractmethod
+    def select_victim(self):
+        """Sceglie la prossima chiave da rimuovere"""
+    
+    @abstractmethod
+    def hot_keys(self):
+        """Chiavi presenti dalla prossima da rimuovere alla più preziosa"""
+    
+    @abstractmethod
+    def clear(self):
+        """Dimentica tutte le chiavi"""
+
+class LRUPolicy(EvictionPolicy):
+    """Least Recently Used: rimuove la chiave usata meno di recente"""
+    name = "lru"
+    
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.order = OrderedDict()
+    
+    def record_access(self, key):
+        self.order.move_to_end(key)
+    
+    def record_insert(self, key):
+        self.order[key] = None
+    
+    def record_remove(self, key):
+        self.order.pop(key, None)
+    
+    def select_victim(self):
+        return next(iter(self.order), None)
+    
+    def hot_keys(self):
+        return list(self.order)
+    
+    def clear(self):
+        self.order.clear()
+
+class CountMinSketch:
+    """Stima approssimata delle frequenze con contatori a 4 bit e invecchiamento periodico"""
+    
+    def __init__(self, capacity, depth=4):
+        # Larghezza arrotondata alla potenza di 2 successiva per usare una maschera
+        self.width = 1 << max(4, (max(1, capacity) - 1).bit_length())
+        self.mask = self.width - 1
+        self.table = [bytearray(self.width) for _ in range(depth)]
+        self.additions = 0
+        # Dopo sample_size incrementi tutti i contatori vengono dimezzati
+        self.sample_size = 10 * max(1, capacity)
+    
+    def _indexes(self, key):
+        # Doppio hashing: righe indipendenti derivate da un unico hash
+        h1 = hash(key)
+        h2 = (h1 >> 32) | 1
+        return [(h1 + i * h2) & self.mask for i in range(len(self.table))]
+    
+    def increment(self, key):
+        for row, index in zip(self.table, self._indexes(key)):
+            if row[index] < 15:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self._reset()
+    
+    def frequency(self, key):
+        return min(row[index] for row, index in zip(self.table, self._indexes(key)))
+    
+    def _reset(self):
+        """Dimezza tutti i contatori per dare più peso agli accessi recenti"""
+        self.table = [bytearray(count >> 1 for count in row) for row in self.table]
+        self.additions //= 2
+    
+    def clear(self):
+        self.table = [bytearray(self.width) for _ in self.table]
+        self.additions = 0
+
+class TinyLFUPolicy(EvictionPolicy):
+    """W-TinyLFU: finestra LRU piccola, area principale SLRU e ammissione basata sulla frequenza"""
+    name = "tinylfu"
+    
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        # 1% della capacità alla finestra, dell'area principale l'80% è protetta
+        self.window_capacity = max(1, self.capacity // 100)
+        main_capacity = max(1, self.capacity - self.window_capacity)
+        self.protected_capacity = max(1, int(main_capacity * 0.8))
+        self.window = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        # Chiavi uscite dalla finestra che devono ancora superare l'ammissione, in ordine di uscita:
+        # una chiave rimossa o promossa nell'area protetta non è più un candidato
+        self.candidates = OrderedDict()
+        self.sketch = CountMinSketch(self.capacity)
+    
+    def record_access(self, key):
+        self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+        elif key in self.probation:
+            # Un secondo accesso promuove la chiave nell'area protetta
+            del self.probation[key]
+            self.candidates.pop(key, None)
+            self.protected[key] = None
+            if len(self.protected) > self.protected_capacity:
+                demoted, _ = self.protected.popitem(last=False)
+                self.probation[demoted] = None
+        elif key in self.protected:
+            self.protected.move_to_end(key)
+    
+    def record_miss(self, key):
+        self.sketch.increment(key)
+    
+    def record_insert(self, key):
+        self.sketch.increment(key)
+        self.window[key] = None
+        if len(self.window) > self.window_capacity:
+            candidate, _ = self.window.popitem(last=False)
+            self.probation[candidate] = None
+            self.candidates[candidate] = None
+    
+    def record_remove(self, key):
+        self.candidates.pop(key, None)
+        for segment in (self.window, self.probation, self.protected):
+            if key in segment:
+                del segment[key]
+                return
+    
+    def select_victim(self):
+        if self.candidates:
+            candidate, _ = self.candidates.popitem(last=False)
+            victim = next((k for k in self.probation if k != candidate), None)
+            if victim is None:
+                victim = next(iter(self.protected), None)
+            if victim is None:
+                return candidate
+            # Ammissione TinyLFU: il candidato resta solo se più frequente della vittima
+            if self.sketch.frequency(candidate) > self.sketch.frequency(victim):
+                return victim
+            return candidate
+        for segment in (self.probation, self.protected, self.window):
+            if segment:
+                return next(iter(segment))
+        return None
+    
+    def hot_keys(self):
+        # Probation (viste una volta), finestra (appena inserite), protetta (richieste più volte)
+        return list(self.probation) + list(self.window) + list(self.protected)
+    
+    def clear(self):
+        self.window.clear()
+        self.probation.clear()
+        self.protected.clear()
+        self.candidates.clear()
+        self.sketch.clear()
+
+class ARCPolicy(EvictionPolicy):
+    """Adaptive Replacement Cache: bilancia recency (T1) e frequency (T2) tramite liste fantasma"""
+    name = "arc"
+    
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.p = 0  # Dimensione obiettivo di T1
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()  # Chiavi rimosse da T1 (solo chiavi)
+        self.b2 = OrderedDict()  # Chiavi rimosse da T2 (solo chiavi)
+        self._insert_into_t2 = False
+        self._incoming_from_b2 = False
+    
+    def record_access(self, key):
+        if key in self.t1:
+            del self.t1[key]
+            self.t2[key] = None
+        elif key in self.t2:
+            self.t2.move_to_end(key)
+    
+    def before_insert(self, key):
+        self._insert_into_t2 = False
+        self._incoming_from_b2 = False
+        if key in self.b1:
+            # Hit fantasma in B1: T1 era troppo piccola
+            self.p = min(self.capacity, self.p + max(1, len(self.b2) // max(1, len(self.b1))))
+            del self.b1[key]
+            self._insert_into_t2 = True
+        elif key in self.b2:
+            # Hit fantasma in B2: T2 era troppo piccola
+            self.p = max(0, self.p - max(1, len(self.b1) // max(1, len(self.b2))))
+            del self.b2[key]
+            self._insert_into_t2 = True
+            self._incoming_from_b2 = True
+    
+    def record_insert(self, key):
+        (self.t2 if self._insert_into_t2 else self.t1)[key] = None
+        self._trim_ghosts()
+    
+    def record_remove(self, key):
+        self.t1.pop(key, None)
+        self.t2.pop(key, None)
+    
+    def record_evict(self, key):
+        if key in self.t1:
+            del self.t1[key]
+            self.b1[key] = None
+        elif key in self.t2:
+            del self.t2[key]
+            self.b2[key] = None
+        self._trim_ghosts()
+    
+    def select_victim(self):
+        if self.t1 and (len(self.t1) > self.p or (self._incoming_from_b2 and len(self.t1) == self.p)):
+            return next(iter(self.t1))
+        if self.t2:
+            return next(iter(self.t2))
+        return next(iter(self.t1), None)
+    
+    def hot_keys(self):
+        # T1 (viste una volta) prima di T2 (viste più volte); le liste fantasma non sono in cache
+        return list(self.t1) + list(self.t2)
+    
+    def _trim_ghosts(self):
+        """Mantiene |T1|+|B1| <= c e il totale delle liste <= 2c"""
+        while self.b1 and len(self.t1) + len(self.b1) > self.capacity:
+            self.b1.popitem(last=False)
+        while self.b2 and len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2) > 2 * self.capacity:
+            self.b2.popitem(last=False)
+    
+    def clear(self):
+        self.p = 0
+        for segment in (self.t1, self.t2, self.b1, self.b2):
+            segment.clear()
+
+class TwoQPolicy(EvictionPolicy):
+    """2Q: le chiavi nuove passano da una FIFO (A1in) e accedono all'LRU (Am) solo se richieste di nuovo"""
+    name = "2q"
+    
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.in_capacity = max(1, self.capacity // 4)
+        self.out_capacity = max(1, self.capacity // 2)
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()  # Chiavi uscite da A1in (solo chiavi)
+        self.am = OrderedDict()
+        self._insert_into_am = False
+    
+    def record_access(self, key):
+        if key in self.am:
+            self.am.move_to_end(key)
+    
+    def before_insert(self, key):
+        self._insert_into_am = key in self.a1out
+        if self._insert_into_am:
+            del self.a1out[key]
+    
+    def record_insert(self, key):
+        (self.am if self._insert_into_am else self.a1in)[key] = None
+    
+    def record_remove(self, key):
+        self.a1in.pop(key, None)
+        self.am.pop(key, None)
+    
+    def record_evict(self, key):
+        if key in self.a1in:
+            del self.a1in[key]
+            self.a1out[key] = None
+            if len(self.a1out) > self.out_capacity:
+                self.a1out.popitem(last=False)
+        else:
+            self.am.pop(key, None)
+    
+    def select_victim(self):
+        if self.a1in and (len(self.a1in) > self.in_capacity or not self.am):
+            return next(iter(self.a1in))
+        return next(iter(self.am), None)
+    
+    def hot_keys(self):
+        # A1in (FIFO delle chiavi nuove) prima di Am (LRU delle chiavi richieste di nuovo)
+        return list(self.a1in) + list(self.am)
+    
+    def clear(self):
+        self.a1in.clear()
+        self.a1out.clear()
+        self.am.clear()
+
+EVICTION_POLICIES = {
+    "lru": LRUPolicy,
+    "tinylfu": TinyLFUPolicy,
+    "arc": ARCPolicy,
+    "2q": TwoQPolicy,
+}
+
+# Cache con politica di rimozione configurabile
+class PolicyCache:
+    def __init__(self, policy="tinylfu", max_items=1000, max_size_bytes=10*1024*1024):
+        # Ogni voce è una lista [valore, dimensione in bytes]; l'ordine è gestito dalla politica
+        self.cache = {}
+        self.policy = EVICTION_POLICIES[policy](max_items)
+        self.max_items = max_items
+        self.max_size_bytes = max_size_bytes
+        self.current_size_bytes = 0
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def _lookup(self, key):
+        """Cerca una voce aggiornando politica e contatori (da chiamare sotto lock)"""
+        entry = self.cache.get(key)
+        if entry is None:
+            self.misses += 1
+            self.policy.record_miss(key)
+            return None
+        self.hits += 1
+        self.policy.record_access(key)
+        return entry
+    
+    def get(self, key):
+        """Ottiene un valore dalla cache, aggiornando la politica"""
+        with self.lock:
+            entry = self._lookup(key)
+            return entry[0] if entry is not None else None
+    
+    def get_many(self, keys):
+        """Ottiene i valori presenti in cache per più chiavi con una sola acquisizione del lock"""
+        result = {}
+        with self.lock:
+            for key in keys:
+                entry = self._lookup(key)
+                if entry is not None:
+                    result[key] = entry[0]
+        return result
+    
+    def peek(self, key):
+        """Legge un valore senza aggiornare politica e contatori"""
+        entry = self.cache.get(key)
+        return entry[0] if entry is not None else None
+    
+    def touch(self, key):
+        """Registra un accesso e indica se la chiave è presente"""
+        with self.lock:
+            return self._lookup(key) is not None
+    
+    def put(self, key, value, size=None):
+        """Inserisce un valore nella cache, rispettando i limiti"""
+        new_item_size = get_item_size(key, value) if size is None else size
+        
+        with self.lock:
+            if key in self.cache:
+                # Aggiornamento: conta come accesso, la posizione è decisa dalla politica
+                if new_item_size > self.max_size_bytes:
+                    self.delete(key)
+                    logger.warning("L'elemento con chiave '%s' è troppo grande per la cache (%d bytes)", key, new_item_size)
+                    return False
+                self.current_size_bytes += new_item_size - self.cache[key][1]
+                self.cache[key] = [value, new_item_size]
+                self.policy.record_access(key)
+            else:
+                if new_item_size > self.max_size_bytes:
+                    logger.warning("L'elemento con chiave '%s' è troppo grande per la cache (%d bytes)", key, new_item_size)
+                    return False
+                self.policy.before_insert(key)
+                self.cache[key] = [value, new_item_size]
+                self.current_size_bytes += new_item_size
+                self.policy.record_insert(key)
+            
+            # Rimuovi le vittime scelte dalla politica finché non si rientra nei limiti
+            while (len(self.cache) > self.max_items or 
+                   self.current_size_bytes > self.max_size_bytes) and self.cache:
+                victim = self.policy.select_victim()
+                if victim is None or victim not in self.cache:
+                    break
+                victim_entry = self.cache.pop(victim)
+                self.current_size_bytes -= victim_entry[1]
+                self.policy.record_evict(victim)
+                self.evictions += 1
+                logger.debug("Rimosso dalla cache l'elemento '%s' (%d bytes)", victim, victim_entry[1])
+            
+            # Con TinyLFU la nuova chiave può non essere ammessa
+            return key in self.cache
+    
+    def delete(self, key):
+        """Elimina un elemento dalla cache"""
+        with self.lock:
+            if key in self.cache:
+                entry = self.cache.pop(key)
+                self.current_size_bytes -= entry[1]
+                self.policy.record_remove(key)
+                return True
+            return False
+    
+    def keys(self):
+        """Restituisce tutte le chiavi nella cache"""
+        with self.lock:
+            return list(self.cache.keys())
+    
+    def hot_keys(self):
+        """Chiavi dalla prossima da rimuovere alla più preziosa, secondo la politica"""
+        with self.lock:
+            return [key for key in self.policy.hot_keys() if key in self.cache]
+    
+    def clear(self):
+        """Svuota la cache"""
+        with self.lock:
+            self.cache.clear()
+            self.policy.clear()
+            self.current_size_bytes = 0
+    
+    def get_stats(self):
+        """Restituisce statistiche sulla cache"""
+        with self.lock:
+            return {
+                "items_count": len(self.cache),
+                "max_items": self.max_items,
+                "size_bytes": self.current_size_bytes,
+                "max_size_bytes": self.max_size_bytes,
+                "utilization_percent": round((self.current_size_bytes / self.max_size_bytes) * 100, 2) if self.max_size_bytes > 0 else 0,
+                "policy": self.policy.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": get_hit_ratio(self.hits, self.misses),
+                "evictions": self.evictions
+            }
+
+# Cache partizionata in segmenti LRU indipendenti (lock striping)
+class ShardedLRUCache:
+    def __init__(self, shards=8, max_items=1000, max_size_bytes=10*1024*1024, read_promotion="lru", policy="lru"):
+        # Ogni segmento ha il proprio lock e una quota dei limiti complessivi
+        self.shards = [
+            create_segment(
+                policy=policy,
+                max_items=max(1, max_items // shards),
+                max_size_bytes=max(1, max_size_bytes // shards),
+                read_promotion=read_promotion
+            )
+            for _ in range(shards)
+        ]
+        self.max_items = max_items
+        self.max_size_bytes = max_size_bytes
+        self.read_promotion = read_promotion
+        self.policy = policy
+    
+    def _shard_for(self, key):
+        """Seleziona il segmento responsabile di una chiave"""
+        return self.shards[hash(key) % len(self.shards)]
+    
+    def get(self, key):
+        """Ottiene un valore dal segmento della chiave"""
+        return self._shard_for(key).get(key)
+    
+    def peek(self, key):
+        """Legge un valore dal segmento della chiave senza aggiornare ordine e contatori"""
+        return self._shard_for(key).peek(key)
+    
+    def get_many(self, keys):
+        """Ottiene i valori di più chiavi, con un'acquisizione del lock per ogni segmento coinvolto"""
+        by_shard: Dict[int, List[str]] = {}
+        for key in keys:
+            by_shard.setdefault(hash(key) % len(self.shards), []).append(key)
+        result = {}
+        for index, shard_keys in by_shard.items():
+            result.update(self.shards[index].get_many(shard_keys))
+        return result
+    
+    def put(self, key, value, size=None):
+        """Inserisce un valore nel segmento della chiave"""
+        return self._shard_for(key).put(key, value, size)
+    
+    def delete(self, key):
+        """Elimina un elemento dal segmento della chiave"""
+        return self._shard_for(key).delete(key)
+    
+    def keys(self):
+        """Restituisce tutte le chiavi di tutti i segmenti"""
+        result = []
+        for shard in self.shards:
+            result.extend(shard.keys())
+        return result
+    
+    def hot_keys(self):
+        """Chiavi dalla prossima da rimuovere alla più preziosa: i segmenti non condividono un ordine,
+        quindi si uniscono per posizione relativa nel proprio segmento"""
+        ranked = []
+        for shard in self.shards:
+            shard_keys = shard.hot_keys()
+            ranked.extend(((index + 1) / len(shard_keys), key) for index, key in enumerate(shard_keys))
+        ranked.sort(key=lambda item: item[0])
+        return [key for _, key in ranked]
+    
+    def clear(self):
+        """Svuota tutti i segmenti"""
+        for shard in self.shards:
+            shard.clear()
+    
+    def get_stats(self):
+        """Restituisce statistiche aggregate sui segmenti"""
+        shard_stats = [shard.get_stats() for shard in self.shards]
+        size_bytes = sum(stats["size_bytes"] for stats in shard_stats)
+        hits = sum(stats["hits"] for stats in shard_stats)
+        misses = sum(stats["misses"] for stats in shard_stats)
+        return {
+            "items_count": sum(stats["items_count"] for stats in shard_stats),
+            "max_items": self.max_items,
+            "size_bytes": size_bytes,
+            "max_size_bytes": self.max_size_bytes,
+            "utilization_percent": round((size_bytes / self.max_size_bytes) * 100, 2) if self.max_size_bytes > 0 else 0,
+            "shards": len(self.shards),
+            "read_promotion": self.read_promotion,
+            "policy": self.policy,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": get_hit_ratio(hits, misses),
+            "evictions": sum(stats["evictions"] for stats in shard_stats)
+        }
+
+# Confronto tra politiche sullo stesso traffico
+class PolicyComparisonCache:
+    def __init__(self, cache, policies):
+        # Le cache ombra memorizzano solo chiavi e dimensioni, non i valori
+        self.cache = cache
+        self.max_items = cache.max_items
+        self.max_size_bytes = cache.max_size_bytes
+        self.shadows = {
+            name: PolicyCache(policy=name, max_items=cache.max_items, max_size_bytes=cache.max_size_bytes)
+            for name in policies
+        }
+    
+    def get(self, key):
+        """Ottiene un valore dalla cache principale e simula la lettura sulle cache ombra"""
+        value = self.cache.get(key)
+        for shadow in self.shadows.values():
+            if not shadow.touch(key) and value is not None:
+                # Miss solo nella cache ombra: simula il caricamento dal database
+                shadow.put(key, None, get_item_size(key, value))
+        return value
+    
+    def peek(self, key):
+        """Legge un valore dalla cache principale senza simulare un accesso"""
+        return self.cache.peek(key)
+    
+    def get_many(self, keys):
+        """Ottiene i valori di più chiavi dalla cache principale e simula le letture sulle cache ombra"""
+        values = self.cache.get_many(keys)
+        for key in keys:
+            value = values.get(key)
+            for shadow in self.shadows.values():
+                if not shadow.touch(key) and value is not None:
+                    shadow.put(key, None, get_item_size(key, value))
+        return values
+    
+    def put(self, key, value, size=None):
+        """Inserisce un valore nella cache principale e nelle cache ombra"""
+        if size is None:
+            size = get_item_size(key, value)
+        for shadow in self.shadows.values():
+            shadow.put(key, None, size)
+        return self.cache.put(key, value, size)
+    
+    def delete(self, key):
+        """Elimina un elemento dalla cache principale e dalle cache ombra"""
+        for shadow in self.shadows.values():
+            shadow.delete(key)
+        return self.cache.delete(key)
+    
+    def keys(self):
+        """Restituisce tutte le chiavi nella cache principale"""
+        return self.cache.keys()
+    
+    def hot_keys(self):
+        """Chiavi della cache principale dalla prossima da rimuovere alla più preziosa"""
+        return self.cache.hot_keys()
+    
+    def clear(self):
+        """Svuota la cache principale e le cache ombra"""
+        for shadow in self.shadows.values():
+            shadow.clear()
+        self.cache.clear()
+    
+    def get_stats(self):
+        """Restituisce le statistiche della cache principale e l'hit ratio di ogni politica"""
+        stats = self.cache.get_stats()
+        comparison = {stats["policy"]: stats["hit_ratio"]}
+        for name, shadow in self.shadows.items():
+            comparison.setdefault(name, shadow.get_stats()["hit_ratio"])
+        stats["policy_comparison"] = comparison
+        return stats
+
+def create_segment(policy="lru", max_items=1000, max_size_bytes=10*1024*1024, read_promotion="lru"):
+    """Crea un singolo segmento di cache con la politica richiesta"""
+    if policy == "lru":
+        return LRUCache(max_items=max_items, max_size_bytes=max_size_bytes, read_promotion=read_promotion)
+    return PolicyCache(policy=policy, max_items=max_items, max_size_bytes=max_size_bytes)
+
+def create_cache(shards=1, max_items=1000, max_size_bytes=10*1024*1024, read_promotion="lru",
+                 policy="lru", compare_policies=False):
+    """Crea la cache in base alla configurazione (politica, segmentazione, confronto)"""
+    if shards > 1:
+        cache = ShardedLRUCache(shards=shards, max_items=max_items, max_size_bytes=max_size_bytes,
+                                read_promotion=read_promotion, policy=policy)
+    else:
+        cache = create_segment(policy=policy, max_items=max_items, max_size_bytes=max_size_bytes,
+                               read_promotion=read_promotion)
+    if compare_policies:
+        return PolicyComparisonCache(cache, [name for name in EVICTION_POLICIES if name != policy])
+    return cache
+
+def get_item_size(key, value):
+    """Calcola la dimensione in bytes di un elemento dal suo payload serializzato"""
+    if isinstance(value, tuple):
+        # Voce del nodo: (valore serializzato, versione)
+        value = value[0]
+    if isinstance(value, bytes):
+        # Valore già serializzato
+        return len(key.encode("utf-8")) + len(value)
+    # sys.getsizeof non considera gli oggetti annidati (dict, liste): si usa la
+    # lunghezza della serializzazione JSON, che cresce con l'intero contenuto
+    try:
+        payload = json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=str)
+    except (TypeError, ValueError):
+        payload = str(value)
+    return len(str(key).encode("utf-8")) + len(payload.encode("utf-8"))
+
+def get_hit_ratio(hits, misses):
+    """Calcola la percentuale di hit sul totale delle letture"""
+    total = hits + misses
+    return round(hits / total, 4) if total else None
+
+def get_process_rss_bytes() -> Optional[int]:
+    """Restituisce la memoria residente (RSS) attuale del processo in bytes"""
+    try:
+        # Linux: il secondo campo di statm è il numero di pagine residenti
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # Fallback: picco di RSS (in KB su Linux, in bytes su macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+# Istogrammi per le statistiche e per /metrics
+class Histogram:
+    """Istogramma a bucket fissi: registrazione O(1), percentili stimati dai bucket"""
+    # Limiti superiori predefiniti in secondi, per le latenze: da 50 us a circa 37 s,
+    # con un fattore √2 tra un bucket e il successivo
+    LATENCY_BOUNDS = [0.00005 * 2 ** (i / 2) for i in range(40)]
+    
+    def __init__(self, bounds=None):
+        self.bounds = list(bounds) if bounds is not None else self.LATENCY_BOUNDS
+        self.counts = [0] * (len(self.bounds) + 1)  # L'ultimo bucket raccoglie i valori oltre il limite
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+    
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+    
+    def snapshot(self) -> Tuple[List[int], int, float]:
+        with self.lock:
+            return list(self.counts), self.count, self.sum
+    
+    def percentile(self, counts: List[int], count: int, fraction: float) -> Optional[float]:
+        """Percentile interpolato linearmente all'interno del bucket"""
+        if count == 0:
+            return None
+        rank = fraction * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if index == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                return lower + (self.bounds[index] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.bounds[-1]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Numero di campioni, media e percentili in millisecondi (per gli istogrammi di latenza)"""
+        counts, count, total = self.snapshot()
+        stats = {"count": count, "mean_ms": round(total / count * 1000, 3) if count else None}
+        for name, fraction in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            value = self.percentile(counts, count, fraction)
+            stats[name] = round(value * 1000, 3) if value is not None else None
+        return stats
+
+# Durata della scrittura di ogni batch, operazioni per batch e durata delle query sull'executor
+flush_latency = Histogram()
+flush_batch_size = Histogram(bounds=[1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000])
+db_query_latency = Histogram()
+
 # Inizializzazione della cache
-memory_cache = LRUCache(max_items=MAX_CACHE_ITEMS, max_size_bytes=MAX_CACHE_SIZE_BYTES)
+# CACHE_SHARDS > 1 attiva la cache segmentata; CACHE_READ_PROMOTION sceglie tra "lru" e "clock"
+CACHE_SHARDS = int(os.environ.get("CACHE_SHARDS", 1))
+CACHE_READ_PROMOTION = os.environ.get("CACHE_READ_PROMOTION", "lru")
+if CACHE_READ_PROMOTION not in ("lru", "clock"):
+    logger.error(f"CACHE_READ_PROMOTION deve essere 'lru' o 'clock', ricevuto: {CACHE_READ_PROMOTION}")
+    CACHE_READ_PROMOTION = "lru"
+# CACHE_POLICY sceglie la politica di rimozione; CACHE_POLICY_COMPARE simula anche le altre
+CACHE_POLICY = os.environ.get("CACHE_POLICY", "lru")
+if CACHE_POLICY not in EVICTION_POLICIES:
+    logger.error(f"CACHE_POLICY deve essere una tra {list(EVICTION_POLICIES)}, ricevuto: {CACHE_POLICY}")
+    CACHE_POLICY = "lru"
+CACHE_POLICY_COMPARE = os.environ.get("CACHE_POLICY_COMPARE", "0") == "1"
+memory_cache = create_cache(shards=max(1, CACHE_SHARDS), max_items=MAX_CACHE_ITEMS,
+                            max_size_bytes=MAX_CACHE_SIZE_BYTES, read_promotion=CACHE_READ_PROMOTION,
+                            policy=CACHE_POLICY, compare_policies=CACHE_POLICY_COMPARE)
 
-def get_db_connection():
-    """Crea una connessione al database SQLite"""
+# Pool di connessioni SQLite: una connessione per thread, riutilizzata tra le richieste
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # bytes
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", 64 * 1024))  # KiB di page cache per connessione
+_db_local = threading.local()
+_db_connections: List[sqlite3.Connection] = []
+_db_connections_lock = threading.Lock()
+_db_generation = 0  # Incrementato alla chiusura del pool per invalidare le connessioni dei thread
+
+def _open_db_connection():
+    """Apre una nuova connessione al database SQLite con le pragma di prestazione"""
     # Assicurati che la directory del DB esista
     db_dir = os.path.dirname(DB_FILE)
     if db_dir and not os.path.exists(db_dir):
         os.makedirs(db_dir)
     
-    conn = sqlite3.connect(DB_FILE)
+    # check_same_thread=False serve solo per chiudere tutte le connessioni all'arresto:
+    # ogni connessione viene comunque usata da un solo thread
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # WAL: i lettori non vengono bloccati dalla scrittura del batch
+    conn.execute("PRAGMA journal_mode=WAL")
+    # In WAL, NORMAL esegue fsync solo ai checkpoint: il database resta consistente
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    # Un valore negativo indica la dimensione in KiB anziché in pagine
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    return conn
+
+def get_db_connection():
+    """Restituisce la connessione SQLite del thread corrente, creandola se necessario"""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None or _db_local.generation != _db_generation:
+        conn = _open_db_connection()
+        _db_local.conn = conn
+        _db_local.generation = _db_generation
+        with _db_connections_lock:
+            _db_connections.append(conn)
     return conn
 
+def close_db_connections():
+    """Chiude tutte le connessioni del pool"""
+    global _db_generation
+    with _db_connections_lock:
+        for conn in _db_connections:
+            conn.close()
+        _db_connections.clear()
+        # Le connessioni chiuse non devono più essere restituite ai thread
+        _db_generation += 1
+
 def init_db():
     """Inizializza il database creando la tabella se non esiste"""
     conn = get_db_connection()
     conn.execute('''
     CREATE TABLE IF NOT EXISTS kv_store (
         key TEXT PRIMARY KEY,
-        value TEXT,
+        value BLOB,
+        version INTEGER NOT NULL DEFAULT 1,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     ''')
     conn.execute('''
-    CREATE TABLE IF NOT EXISTS kv_store_history (
+    CREATE TABLE IF NOT EXISTS kv_store_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    ''')
+    # Scadenza opzionale (epoch in secondi), aggiunta anche ai database creati prima del TTL
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(kv_store)")}
+    if "expires_at" not in columns:
+        conn.execute("ALTER TABLE kv_store ADD COLUMN expires_at REAL")
+    # Versione di ogni chiave: le righe esistenti partono da 1 e l'orologio delle versioni da lì
+    if "version" not in columns:
+        conn.execute("ALTER TABLE kv_store ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+        conn.execute("INSERT INTO kv_store_counters (name, value) VALUES ('version', 1) "
+                     "ON CONFLICT(name) DO UPDATE SET value = MAX(value, 1)")
+    # Versione 1: valori in JSON canonico (BLOB). I valori testuali delle versioni precedenti
+    # erano str() del valore, il cui tipo originale non è recuperabile: diventano stringhe JSON
+    if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+        conn.execute("UPDATE kv_store SET value = CAST(json_quote(value) AS BLOB) WHERE typeof(value) = 'text'")
+        # I byte memorizzati cambiano: il contatore viene ricalcolato
+        conn.execute("DELETE FROM kv_store_counters WHERE name = 'bytes'")
+        conn.execute("PRAGMA user_version = 1")
+    # Indice per il riscaldamento della cache a partire dalle chiavi modificate più di recente
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kv_store_updated_at ON kv_store (updated_at)")
+    # Indice parziale per ricaricare all'avvio solo le chiavi con scadenza
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kv_store_expires_at ON kv_store (expires_at) WHERE expires_at IS NOT NULL")
+    conn.commit()
+    init_history(conn)
+    load_version_clock()
+
+# Cronologia delle operazioni, divisa in tabelle per intervallo di tempo: kv_store_history_<n>
+# contiene le operazioni sincronizzate con epoch // HISTORY_PARTITION_SECONDS == n.
+# Le partizioni oltre la retention vengono eliminate con un DROP TABLE invece che riga per riga
+HISTORY_PARTITION_SECONDS = int(os.environ.get("HISTORY_PARTITION_SECONDS", 86400))
+HISTORY_RETENTION_SECONDS = int(os.environ.get("HISTORY_RETENTION_SECONDS", 7 * 86400))  # 0: nessun limite
+HISTORY_MAX_PER_KEY = int(os.environ.get("HISTORY_MAX_PER_KEY", 100))  # 0: nessun limite
+HISTORY_COMPACT_INTERVAL = float(os.environ.get("HISTORY_COMPACT_INTERVAL", 60))  # secondi
+HISTORY_COMPACT_CHUNK = 500  # Chiavi compattate per transazione
+HISTORY_SCAN_CHUNK = 10000  # Righe lette per ogni intervallo di rowid della partizione corrente
+
+history_partitions: List[int] = []
+# Contatori aggiornati nella stessa transazione delle scritture ("keys" per kv_store,
+# "history:<tabella>" per ogni partizione): /stats non esegue COUNT(*)
+db_counters: Dict[str, int] = {}
+# Chiavi sincronizzate dopo l'ultima compattazione: solo queste possono superare HISTORY_MAX_PER_KEY
+history_dirty_keys = set()
+# Partizioni senza indice per chiave (la corrente): ultimo rowid letto e id delle righe rimaste per
+# chiave. Dopo ogni compattazione ogni chiave ha al più HISTORY_MAX_PER_KEY id, e ogni passaggio
+# legge solo le righe aggiunte dopo il precedente. Usato solo dal thread di compattazione
+history_scans: Dict[str, Dict[str, Any]] = {}
+history_stats: Dict[str, Any] = {
+    "compactions": 0,
+    "dropped_partitions": 0,
+    "compacted_rows": 0,
+    "last_compaction_ms": None
+}
+history_stop = threading.Event()
+
+def history_table(partition: int) -> str:
+    return f"kv_store_history_{partition}"
+
+def history_partition_for(timestamp: float) -> int:
+    """Partizione della cronologia che contiene l'istante indicato"""
+    return int(timestamp // HISTORY_PARTITION_SECONDS)
+
+def create_history_partition(conn, partition: int) -> str:
+    """Crea la tabella della partizione se non esiste e ne restituisce il nome"""
+    table = history_table(partition)
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {table} (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         key TEXT,
-        value TEXT,
+        value BLOB,
         operation TEXT,
         timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     ''')
-    conn.commit()
-    conn.close()
+    return table
+
+def history_partition_sealed(partition: int) -> bool:
+    """Una partizione è chiusa quando il suo intervallo di tempo è finito: non riceve più scritture"""
+    return partition < history_partition_for(time.time())
+
+def create_history_key_index(conn, table: str):
+    """Indice per la compattazione per chiave (righe di una chiave in ordine di inserimento)"""
+    # Solo sulle partizioni chiuse, una volta: sulla partizione corrente rallenterebbe ogni scrittura
+    # del batch, che viene invece compattata scorrendola per intervalli di rowid
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_key ON {table} (key, id)")
+
+def init_history(conn):
+    """Migra la vecchia tabella della cronologia, carica le partizioni e i contatori"""
+    legacy = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'kv_store_history'"
+    ).fetchone()
+    if legacy:
+        # La tabella unica diventa la partizione della sua operazione più recente
+        row = conn.execute(
+            "SELECT CAST(strftime('%s', MAX(timestamp)) AS INTEGER) AS last FROM kv_store_history"
+        ).fetchone()
+        table = create_history_partition(conn, history_partition_for(row["last"] or time.time()))
+        conn.execute(f"INSERT INTO {table} (key, value, operation, timestamp) "
+                     "SELECT key, value, operation, timestamp FROM kv_store_history ORDER BY id")
+        conn.execute("DROP TABLE kv_store_history")
+        conn.execute("DELETE FROM kv_store_counters WHERE name = ?", (f"history:{table}",))
+        conn.commit()
+        # La cronologia precedente non era limitata: tutte le chiavi vanno compattate
+        if HISTORY_MAX_PER_KEY > 0:
+            history_dirty_keys.update(row["key"] for row in conn.execute(f"SELECT DISTINCT key FROM {table}"))
+        logger.info(f"Cronologia migrata nella partizione {table}")
+    
+    history_partitions[:] = sorted(
+        int(row["name"][len("kv_store_history_"):]) for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'kv_store_history_[0-9]*'"
+        )
+    )
+    # Le versioni precedenti indicizzavano anche la partizione corrente
+    for partition in history_partitions:
+        if not history_partition_sealed(partition):
+            conn.execute(f"DROP INDEX IF EXISTS idx_{history_table(partition)}_key")
+    counters = {row["name"]: row["value"] for row in conn.execute("SELECT name, value FROM kv_store_counters")}
+    # Contatori mancanti (database precedenti o partizioni migrate): un solo conteggio completo
+    missing = {}
+    if "keys" not in counters or "bytes" not in counters:
+        row = conn.execute(f"SELECT COUNT(*) AS count, COALESCE(SUM({ROW_BYTES_SQL}), 0) AS bytes FROM kv_store").fetchone()
+        missing["keys"], missing["bytes"] = row["count"], row["bytes"]
+    for partition in history_partitions:
+        table = history_table(partition)
+        if f"history:{table}" not in counters:
+            missing[f"history:{table}"] = conn.execute(f"SELECT COUNT(*) AS count FROM {table}").fetchone()["count"]
+    if missing:
+        conn.executemany("INSERT OR REPLACE INTO kv_store_counters (name, value) VALUES (?, ?)", missing.items())
+        conn.commit()
+        counters.update(missing)
+    db_counters.clear()
+    db_counters.update(counters)
+
+def get_db_counts() -> Tuple[int, int, int]:
+    """Righe della tabella principale e della cronologia e byte memorizzati, dai contatori in memoria"""
+    history_count = sum(value for name, value in list(db_counters.items()) if name.startswith("history:"))
+    return db_counters.get("keys", 0), history_count, db_counters.get("bytes", 0)
+
+def get_synced_operations() -> Dict[str, int]:
+    """Operazioni scritte nel database dall'inizializzazione, per tipo"""
+    return {name[len("ops:"):]: value for name, value in list(db_counters.items()) if name.startswith("ops:")}
+
+# Byte occupati da una riga di kv_store (chiave e valore in UTF-8)
+ROW_BYTES_SQL = "length(CAST(key AS BLOB)) + COALESCE(length(CAST(value AS BLOB)), 0)"
 
-# Batch di operazioni per la sincronizzazione con il database
-pending_operations: List[Tuple[str, str, str]] = []
+# Byte delle righe di kv_store scritte dagli ultimi batch (None: riga eliminata). Solo _sync_batch scrive
+# kv_store, quindi i valori restano esatti; la mappa è limitata a ROW_FOOTPRINT_ITEMS chiavi (LRU)
+ROW_FOOTPRINT_ITEMS = int(os.environ.get("ROW_FOOTPRINT_ITEMS", 100000))
+row_footprints: "OrderedDict[str, Optional[int]]" = OrderedDict()
+
+def row_footprint(key: str, value: Optional[bytes]) -> Optional[int]:
+    """Byte occupati in kv_store dalla riga di una chiave (chiave e valore in UTF-8), None se non esiste"""
+    return len(key.encode("utf-8")) + len(value) if value is not None else None
+
+def db_rows_footprint(conn, keys: List[str]) -> Dict[str, Optional[int]]:
+    """Byte delle righe attuali delle chiavi in kv_store: dalla mappa degli ultimi batch e,
+    solo per le chiavi che non contiene, con una query sul database"""
+    footprints = {}
+    unknown = []
+    for key in keys:
+        if key in row_footprints:
+            footprints[key] = row_footprints[key]
+        else:
+            footprints[key] = None
+            unknown.append(key)
+    for i in range(0, len(unknown), IN_QUERY_CHUNK):
+        chunk = unknown[i:i + IN_QUERY_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        for row in conn.execute(f"SELECT key, {ROW_BYTES_SQL} AS bytes FROM kv_store WHERE key IN ({placeholders})", chunk):
+            footprints[row["key"]] = row["bytes"]
+    return footprints
+
+def remember_row_footprints(footprints: Dict[str, Optional[int]]):
+    """Registra i byte delle righe appena scritte, dimenticando le chiavi usate meno di recente"""
+    for key, size in footprints.items():
+        row_footprints[key] = size
+        row_footprints.move_to_end(key)
+    while len(row_footprints) > ROW_FOOTPRINT_ITEMS:
+        row_footprints.popitem(last=False)
+
+def drop_expired_history_partitions(now: Optional[float] = None) -> int:
+    """Elimina le partizioni interamente più vecchie della retention"""
+    if HISTORY_RETENTION_SECONDS <= 0:
+        return 0
+    now = time.time() if now is None else now
+    # Una partizione è scaduta quando anche la sua fine è oltre la retention
+    cutoff = history_partition_for(now - HISTORY_RETENTION_SECONDS)
+    dropped = 0
+    with _flush_lock:
+        conn = get_db_connection()
+        for partition in [partition for partition in history_partitions if partition < cutoff]:
+            table = history_table(partition)
+            # Contatore e tabella vengono eliminati nella stessa transazione
+            conn.execute("DELETE FROM kv_store_counters WHERE name = ?", (f"history:{table}",))
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.commit()
+            history_partitions.remove(partition)
+            db_counters.pop(f"history:{table}", None)
+            dropped += 1
+            logger.info(f"Eliminata la partizione della cronologia {table}")
+    return dropped
+
+def scan_history_ids(table: str) -> Dict[str, List[int]]:
+    """Id, in ordine crescente, delle righe di ogni chiave in una partizione senza indice per chiave.
+    Si leggono per intervalli di rowid solo le righe aggiunte dopo la lettura precedente"""
+    conn = get_db_connection()
+    state = history_scans.setdefault(table, {"last": 0, "ids": {}})
+    ids = state["ids"]
+    while True:
+        rows = conn.execute(f"SELECT id, key FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                            (state["last"], HISTORY_SCAN_CHUNK)).fetchall()
+        if not rows:
+            return ids
+        for row_id, key in rows:
+            ids.setdefault(key, []).append(row_id)
+        state["last"] = rows[-1][0]
+
+def compact_history_keys(keys: List[str], scanned: Dict[str, Dict[str, List[int]]]) -> int:
+    """Mantiene al più HISTORY_MAX_PER_KEY righe per chiave, eliminando le più vecchie. Le partizioni in
+    scanned (senza indice) usano gli id letti da scan_history_ids, le altre l'indice per chiave"""
+    removed: Dict[str, int] = {}
+    # Id eliminati dalle partizioni lette, tolti da history_scans solo dopo il commit
+    trimmed: List[Tuple[Dict[str, List[int]], str, int]] = []
+    with _flush_lock:
+        conn = get_db_connection()
+        # Dalla partizione più recente: le righe oltre il limite sono nelle partizioni più vecchie
+        # Una partizione creata dopo la lettura non ha indice ma contiene solo righe più recenti
+        tables = [history_table(partition) for partition in reversed(history_partitions)
+                  if history_partition_sealed(partition) or history_table(partition) in scanned]
+        for key in keys:
+            remaining = HISTORY_MAX_PER_KEY
+            for table in tables:
+                if table in scanned:
+                    # Le righe scritte dopo la lettura sono più recenti e restano comunque
+                    key_ids = scanned[table].get(key, [])
+                    excess = len(key_ids) - remaining
+                    remaining = max(0, -excess)
+                    if excess <= 0:
+                        continue
+                    cursor = conn.executemany(f"DELETE FROM {table} WHERE id = ?",
+                                              [(row_id,) for row_id in key_ids[:excess]])
+                    trimmed.append((scanned[table], key, excess))
+                elif remaining == 0:
+                    cursor = conn.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+                else:
+                    count = conn.execute(f"SELECT COUNT(*) AS count FROM {table} WHERE key = ?", (key,)).fetchone()["count"]
+                    if count <= remaining:
+                        remaining -= count
+                        continue
+                    cursor = conn.execute(
+                        f"DELETE FROM {table} WHERE id IN "
+                        f"(SELECT id FROM {table} WHERE key = ? ORDER BY id LIMIT ?)",
+                        (key, count - remaining)
+                    )
+                    remaining = 0
+                if cursor.rowcount > 0:
+                    removed[table] = removed.get(table, 0) + cursor.rowcount
+        if removed:
+            conn.executemany(
+                "UPDATE kv_store_counters SET value = value - ? WHERE name = ?",
+                [(count, f"history:{table}") for table, count in removed.items()]
+            )
+        conn.commit()
+        for table, count in removed.items():
+            db_counters[f"history:{table}"] -= count
+    for ids, key, excess in trimmed:
+        del ids[key][:excess]
+        if not ids[key]:
+            del ids[key]
+    return sum(removed.values())
+
+def compact_history():
+    """Applica la retention: elimina le partizioni scadute e le righe oltre il limite per chiave"""
+    start_time = time.perf_counter()
+    try:
+        dropped = drop_expired_history_partitions()
+        compacted = 0
+        if HISTORY_MAX_PER_KEY > 0:
+            with _flush_lock:
+                keys = list(history_dirty_keys)
+                history_dirty_keys.clear()
+                conn = get_db_connection()
+                unindexed = []
+                for partition in history_partitions:
+                    if history_partition_sealed(partition):
+                        # Creato una sola volta, quando la partizione smette di ricevere scritture
+                        create_history_key_index(conn, history_table(partition))
+                    else:
+                        unindexed.append(history_table(partition))
+                conn.commit()
+            # Le partizioni chiuse usano l'indice: gli id letti non servono più
+            for table in [table for table in history_scans if table not in unindexed]:
+                del history_scans[table]
+            # Lettura senza _flush_lock: in WAL i batch continuano a essere scritti
+            scanned = {table: scan_history_ids(table) for table in unindexed} if keys else {}
+            for i in range(0, len(keys), HISTORY_COMPACT_CHUNK):
+                compacted += compact_history_keys(keys[i:i + HISTORY_COMPACT_CHUNK], scanned)
+    except sqlite3.Error as e:
+        get_db_connection().rollback()
+        logger.error(f"Errore durante la compattazione della cronologia: {e}")
+        return
+    elapsed = time.perf_counter() - start_time
+    history_stats["compactions"] += 1
+    history_stats["dropped_partitions"] += dropped
+    history_stats["compacted_rows"] += compacted
+    history_stats["last_compaction_ms"] = round(elapsed * 1000, 3)
+    if dropped or compacted:
+        logger.info(f"Cronologia compattata: {dropped} partizioni e {compacted} righe eliminate")
+
+def _history_compactor_loop():
+    """Compatta la cronologia in background ogni HISTORY_COMPACT_INTERVAL secondi"""
+    while not history_stop.wait(HISTORY_COMPACT_INTERVAL):
+        compact_history()
+
+def get_history_stats():
+    """Statistiche della cronologia e della sua retention"""
+    return {
+        **history_stats,
+        "partitions": len(history_partitions),
+        "oldest_partition": history_table(history_partitions[0]) if history_partitions else None,
+        "pending_compaction_keys": len(history_dirty_keys),
+        "retention_seconds": HISTORY_RETENTION_SECONDS,
+        "max_per_key": HISTORY_MAX_PER_KEY,
+        "partition_seconds": HISTORY_PARTITION_SECONDS
+    }
+
+# Log append-only delle operazioni: PUT e DELETE vengono scritte qui prima della risposta,
+# così le operazioni confermate ma non ancora sincronizzate sopravvivono a un crash.
+# Ogni record è [lunghezza (4 byte)][crc32 (4 byte)][JSON di (key, value, operation, expires_at, compressed, version)],
+# con il valore inserito così com'è dal suo JSON canonico
+WRITE_LOG_ENABLED = os.environ.get("WRITE_LOG", "1") == "1"
+WRITE_LOG_FILE = os.environ.get("WRITE_LOG_FILE", os.path.join(os.path.dirname(DB_FILE), "kv_store.oplog"))
+WRITE_LOG_GROUP_DELAY_MS = float(os.environ.get("WRITE_LOG_GROUP_DELAY_MS", 0))  # Attesa prima di ogni fsync
+
+class WriteLog:
+    """Log append-only con fsync raggruppati: un solo fsync rende durevoli tutti i record scritti fino a quel momento"""
+    HEADER = struct.Struct(">II")
+    
+    def __init__(self, path, group_delay=0.0):
+        self.path = path
+        # Segmento già consegnato a _sync_batch: si elimina dopo il commit
+        self.sealed_path = path + ".sealed"
+        self.group_delay = group_delay
+        self.lock = threading.Lock()
+        self.fd: Optional[int] = None
+        self.written_seq = 0  # Ultimo record scritto
+        self.synced_seq = 0   # Ultimo record reso durevole
+        self.unsynced_fds: List[int] = []  # Descrittori dei segmenti sigillati in attesa di fsync
+        self.waiters: List[Tuple[int, asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread: Optional[threading.Thread] = None
+        self.stats = {"records": 0, "bytes": 0, "fsyncs": 0, "replayed": 0, "discarded_segments": 0}
+    
+    @classmethod
+    def encode(cls, key: str, value: Optional[bytes], operation: str, expires_at: Optional[float] = None,
+               version: Optional[int] = None) -> bytes:
+        compressed = value is not None and is_compressed(value)
+        if compressed:
+            # Un valore compresso non è JSON: si registra in base64, con il quinto campo come flag
+            value = encode_value(base64.b64encode(value[1:]).decode("ascii"))
+        payload = b"".join((
+            b"[", encode_value(key), b",", value if value is not None else b"null", b",",
+            encode_value(operation), b",", encode_value(expires_at), b",",
+            b"true" if compressed else b"false", b",", encode_value(version), b"]"
+        ))
+        return cls.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+    
+    @classmethod
+    def read_records(cls, path) -> List[Tuple[str, Optional[bytes], str, Optional[float], Optional[int]]]:
+        """Legge i record validi di un file, fermandosi al primo record troncato o corrotto"""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        records = []
+        offset = 0
+        while offset + cls.HEADER.size <= len(data):
+            length, crc = cls.HEADER.unpack_from(data, offset)
+            start = offset + cls.HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                logger.warning(f"Record incompleto nel log {path} all'offset {offset}: il resto del file viene ignorato")
+                break
+            # I record scritti prima del TTL non hanno la scadenza, quelli precedenti alle versioni la versione
+            key, value, operation, expires_at, compressed, version = (json.loads(payload) + [None] * 3)[:6]
+            if operation != "PUT":
+                value = None
+            elif compressed:
+                value = COMPRESSED_MARKER + base64.b64decode(value)
+            else:
+                # Il valore torna al suo JSON canonico; nei record precedenti era il testo salvato nel database
+                value = encode_value(value)
+            records.append((key, value, operation, expires_at, version))
+            offset = start + length
+        return records
+    
+    def open(self) -> List[Tuple[str, Optional[bytes], str, Optional[float], Optional[int]]]:
+        """Recupera i record rimasti dall'esecuzione precedente e apre il log per le nuove scritture"""
+        log_dir = os.path.dirname(self.path)
+        if log_dir and not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        
+        records = self.read_records(self.sealed_path) + self.read_records(self.path)
+        if records:
+            # Riscrive i soli record validi nel segmento sigillato: una coda troncata
+            # non deve precedere i record scritti da qui in avanti
+            tmp_path = self.sealed_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(b"".join(self.encode(*record) for record in records))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.sealed_path)
+        elif os.path.exists(self.sealed_path):
+            os.remove(self.sealed_path)
+        
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        self._fsync_dir()
+        self.stopping = False
+        self.stats["replayed"] = len(records)
+        self.thread = threading.Thread(target=self._sync_loop, name="write-log-sync", daemon=True)
+        self.thread.start()
+        return records
+    
+    def append(self, operations: List[Tuple[str, Optional[bytes], str, Optional[float], Optional[int]]]) -> int:
+        """Scrive i record delle operazioni (senza fsync) e restituisce il numero di sequenza dell'ultimo"""
+        data = b"".join(self.encode(*operation) for operation in operations)
+        with self.lock:
+            os.write(self.fd, data)
+            self.written_seq += len(operations)
+            self.stats["records"] += len(operations)
+            self.stats["bytes"] += len(data)
+            return self.written_seq
+    
+    async def wait_durable(self, seq: int):
+        """Attende che il record con numero di sequenza seq sia stato scritto su disco"""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if seq <= self.synced_seq:
+                return
+            future = loop.create_future()
+            self.waiters.append((seq, loop, future))
+        self.wakeup.set()
+        await future
+    
+    def seal(self):
+        """Sigilla il segmento corrente: i record fin qui scritti appartengono al batch in sincronizzazione"""
+        with self.lock:
+            if os.path.exists(self.sealed_path):
+                # Il batch precedente non è stato scritto nel database (ed è tornato in coda):
+                # il segmento corrente si accoda a quello sigillato
+                os.fsync(self.fd)
+                with open(self.path, "rb") as src, open(self.sealed_path, "ab") as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.ftruncate(self.fd, 0)
+                return
+            os.rename(self.path, self.sealed_path)
+            # Il descrittore resta valido dopo il rename: il thread di sync lo rende durevole e lo chiude
+            self.unsynced_fds.append(self.fd)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+    
+    def discard_sealed(self):
+        """Elimina il segmento sigillato dopo il commit (durevole) del batch nel database"""
+        with self.lock:
+            try:
+                os.remove(self.sealed_path)
+                self.stats["discarded_segments"] += 1
+            except FileNotFoundError:
+                return
+            # Senza fsync della directory il segmento potrebbe ricomparire dopo un crash e il
+            # replay riscriverebbe versioni vecchie sopra righe più recenti
+            self._fsync_dir()
+    
+    def _fsync_dir(self):
+        """Rende durevoli creazioni e rename dei file del log"""
+        dir_fd = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    
+    def _sync_loop(self):
+        """Esegue gli fsync: le scritture arrivate durante un fsync vengono rese durevoli dal successivo"""
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.group_delay:
+                time.sleep(self.group_delay)
+            
+            with self.lock:
+                target_seq = self.written_seq
+                sealed_fds = self.unsynced_fds
+                self.unsynced_fds = []
+                fds = sealed_fds + [self.fd]
+                stopping = self.stopping
+            
+            error = None
+            try:
+                for fd in fds:
+                    os.fsync(fd)
+                if sealed_fds:
+                    self._fsync_dir()
+            except OSError as e:
+                logger.error(f"Errore durante l'fsync del log delle operazioni: {e}")
+                error = e
+            for fd in sealed_fds:
+                os.close(fd)
+            
+            with self.lock:
+                if error is None:
+                    self.synced_seq = max(self.synced_seq, target_seq)
+                    self.stats["fsyncs"] += 1
+                ready = [w for w in self.waiters if error is not None or w[0] <= target_seq]
+                self.waiters = [w for w in self.waiters if w not in ready]
+            for _, loop, future in ready:
+                try:
+                    loop.call_soon_threadsafe(_resolve_future, future, error)
+                except RuntimeError:
+                    pass  # Event loop già chiuso
+            
+            if stopping:
+                break
+    
+    def close(self):
+        """Rende durevoli le ultime scritture e chiude il log"""
+        if self.thread is None:
+            return
+        with self.lock:
+            self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+        self.thread = None
+        os.close(self.fd)
+        self.fd = None
+    
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["records_per_fsync"] = round(stats["records"] / stats["fsyncs"], 2) if stats["fsyncs"] else None
+        stats["file"] = self.path
+        return stats
+
+def _resolve_future(future: asyncio.Future, error: Optional[Exception]):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+# Aperto nel lifespan se WRITE_LOG è attivo
+write_log: Optional[WriteLog] = None
+
+# Scadenza delle chiavi (TTL)
+# Le scadenze sono gestite da una timing wheel gerarchica: ogni livello ha TTL_WHEEL_SLOTS slot
+# e ogni slot copre TTL_WHEEL_SLOTS volte il tempo di uno slot del livello inferiore.
+# Ad ogni tick si esamina un solo slot, senza scansioni periodiche della tabella
+TTL_TICK_SECONDS = float(os.environ.get("TTL_TICK_SECONDS", 1.0))
+TTL_WHEEL_SLOTS = int(os.environ.get("TTL_WHEEL_SLOTS", 64))
+TTL_WHEEL_LEVELS = int(os.environ.get("TTL_WHEEL_LEVELS", 4))
+
+class TimingWheel:
+    """Timing wheel gerarchica: pianificazione e cancellazione O(1), scadenze raccolte slot per slot"""
+    def __init__(self, tick=1.0, slots=64, levels=4, now=None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        # Chiavi oltre l'orizzonte dell'ultimo livello, ricollocate a ogni giro di quel livello
+        self.overflow = set()
+        self.expiry: Dict[str, float] = {}  # chiave -> scadenza (epoch in secondi)
+        self.location: Dict[str, Any] = {}  # chiave -> insieme (slot o overflow) che la contiene
+        self.current_tick = int((time.time() if now is None else now) / tick)
+        self.lock = threading.Lock()
+    
+    def _place(self, key, expires_at, min_tick=None):
+        """Inserisce la chiave nello slot del livello più basso che copre la sua scadenza (sotto lock)"""
+        # Di norma il primo slot utile è il prossimo; durante la ricollocazione anche quello corrente,
+        # che viene esaminato subito dopo
+        min_tick = self.current_tick + 1 if min_tick is None else min_tick
+        target_tick = max(math.ceil(expires_at / self.tick), min_tick)
+        delta = target_tick - self.current_tick
+        span = 1
+        for level in range(self.levels):
+            if delta < span * self.slots:
+                bucket = self.wheels[level][(target_tick // span) % self.slots]
+                break
+            span *= self.slots
+        else:
+            bucket = self.overflow
+        bucket.add(key)
+        self.location[key] = bucket
+    
+    def schedule(self, key, expires_at):
+        """Pianifica (o ripianifica) la scadenza di una chiave"""
+        with self.lock:
+            self._remove(key)
+            self.expiry[key] = expires_at
+            self._place(key, expires_at)
+    
+    def cancel(self, key):
+        """Rimuove la scadenza di una chiave"""
+        with self.lock:
+            self._remove(key)
+    
+    def _remove(self, key):
+        bucket = self.location.pop(key, None)
+        if bucket is not None:
+            bucket.discard(key)
+        self.expiry.pop(key, None)
+    
+    def is_expired(self, key, now=None):
+        """Indica se la chiave ha una scadenza già passata (lettura senza lock)"""
+        expires_at = self.expiry.get(key)
+        return expires_at is not None and expires_at <= (time.time() if now is None else now)
+    
+    def get_expiry(self, key):
+        return self.expiry.get(key)
+    
+    def advance(self, now=None) -> List[str]:
+        """Avanza la ruota fino all'istante now e restituisce le chiavi scadute, togliendole dagli slot
+
+        La scadenza resta registrata (e la chiave invisibile alle letture) finché non viene cancellata
+        """
+        now = time.time() if now is None else now
+        target_tick = int(now / self.tick)
+        expired = []
+        with self.lock:
+            while self.current_tick < target_tick:
+                self.current_tick += 1
+                # Ad ogni giro completo dell'ultimo livello le chiavi oltre l'orizzonte rientrano nella ruota
+                if self.overflow and self.current_tick % (self.slots ** self.levels) == 0:
+                    cascade = self.overflow
+                    self.overflow = set()
+                    for key in cascade:
+                        self._place(key, self.expiry[key], self.current_tick)
+                # Ricolloca verso il basso gli slot dei livelli superiori che iniziano in questo tick,
+                # partendo dal livello più alto
+                for level in range(self.levels - 1, 0, -1):
+                    span = self.slots ** level
+                    if self.current_tick % span:
+                        continue
+                    bucket = self.wheels[level][(self.current_tick // span) % self.slots]
+                    cascade = list(bucket)
+                    bucket.clear()
+                    for key in cascade:
+                        self._place(key, self.expiry[key], self.current_tick)
+                
+                bucket = self.wheels[0][self.current_tick % self.slots]
+                for key in list(bucket):
+                    if self.expiry[key] <= now:
+                        bucket.discard(key)
+                        del self.location[key]
+                        expired.append(key)
+                    else:
+                        # Scadenza nella frazione successiva del tick: si riesamina al prossimo
+                        bucket.discard(key)
+                        self._place(key, self.expiry[key])
+        return expired
+    
+    def clear(self):
+        with self.lock:
+            for wheel in self.wheels:
+                for bucket in wheel:
+                    bucket.clear()
+            self.overflow.clear()
+            self.expiry.clear()
+            self.location.clear()
+    
+    def __len__(self):
+        return len(self.expiry)
+
+ttl_wheel = TimingWheel(tick=TTL_TICK_SECONDS, slots=TTL_WHEEL_SLOTS, levels=TTL_WHEEL_LEVELS)
+ttl_stats: Dict[str, Any] = {"expired_keys": 0, "last_reclaimed": 0, "loaded_keys": 0}
+ttl_stop = threading.Event()
+
+def expires_at_from_ttl(ttl: Optional[float]) -> Optional[float]:
+    """Converte un TTL in secondi nell'istante di scadenza"""
+    return time.time() + ttl if ttl is not None else None
+
+# Batch di operazioni per la sincronizzazione con il database (group commit)
+# Ogni operazione è (key, value, operation, expires_at, version); le DELETE non hanno versione
+pending_operations: List[Tuple[str, Optional[bytes], str, Optional[float], Optional[int]]] = []
 batch_lock = threading.RLock()
-batch_size_threshold = 10
-last_batch_time = time.time()
-batch_time_threshold = 60  # secondi
+# Il batch viene scritto quando raggiunge batch_size_threshold operazioni oppure quando
+# l'operazione più vecchia attende da batch_time_threshold secondi
+batch_size_threshold = int(os.environ.get("BATCH_SIZE_THRESHOLD", 10))
+batch_time_threshold = float(os.environ.get("BATCH_TIME_THRESHOLD", 1.0))  # secondi
+oldest_pending_time: Optional[float] = None
+batch_flush_event = threading.Event()
+batch_stop = threading.Event()
+# Serializza le scritture: due batch non possono essere applicati in ordine inverso
+_flush_lock = threading.Lock()
+# Indice delle operazioni non ancora nel database: chiave -> (valore, operazione, scadenza, versione)
+# dell'ultima operazione; una DELETE resta come tombstone. pending_index segue pending_operations,
+# flushing_index contiene il batch in scrittura fino al commit
+pending_index: Dict[str, Tuple[Optional[bytes], str, Optional[float], Optional[int]]] = {}
+flushing_index: Dict[str, Tuple[Optional[bytes], str, Optional[float], Optional[int]]] = {}
+# Incrementato (sotto batch_lock) ad ogni batch che lascia gli indici: una lettura dal database
+# fatta prima di un cambio di epoch può essere superata da quel batch
+flush_epoch = 0
+# Chiavi degli indici in ordine, per le scansioni per intervallo e per prefisso
+pending_keys: List[str] = []
+flushing_keys: List[str] = []
+batch_stats: Dict[str, Any] = {
+    "flushes": 0,
+    "flushed_operations": 0,
+    "coalesced_operations": 0,
+    "flush_seconds_total": 0.0,
+    "last_flush_size": 0,
+    "last_flush_ms": None
+}
+
+def add_to_batch(key: str, value: Optional[bytes], operation: str, expires_at: Optional[float] = None,
+                 version: Optional[int] = None) -> Optional[int]:
+    """Aggiunge un'operazione al batch e al log; restituisce il numero di sequenza del record nel log"""
+    return add_many_to_batch([(key, value, operation, expires_at, version)])
 
-def add_to_batch(key: str, value: Optional[str], operation: str):
-    """Aggiunge un'operazione al batch per la sincronizzazione con il database"""
+def add_many_to_batch(operations: List[Tuple[str, Optional[bytes], str, Optional[float], Optional[int]]]) -> Optional[int]:
+    """Aggiunge più operazioni al batch e al log come un'unica unità; restituisce la sequenza dell'ultimo record"""
+    global oldest_pending_time
+    seq = None
+    if not operations:
+        return seq
     with batch_lock:
-        pending_operations.append((key, value, operation))
-        current_time = time.time()
+        # Log e batch vengono aggiornati sotto lo stesso lock: l'ordine dei record coincide
+        if write_log is not None:
+            seq = write_log.append(operations)
+        was_empty = not pending_operations
+        if was_empty:
+            oldest_pending_time = time.time()
+        pending_operations.extend(operations)
+        for key, value, operation, expires_at, version in operations:
+            if key not in pending_index:
+                bisect.insort(pending_keys, key)
+            pending_index[key] = (value, operation, expires_at, version)
+            # Sotto batch_lock: il reaper non può accodare la scadenza di un valore appena sovrascritto
+            if expires_at is not None:
+                ttl_wheel.schedule(key, expires_at)
+            else:
+                ttl_wheel.cancel(key)
         
-        if (len(pending_operations) >= batch_size_threshold or 
-                current_time - last_batch_time >= batch_time_threshold):
-            return True
-    return False
+        # Sveglia il flusher: alla prima operazione per calcolare la scadenza,
+        # al raggiungimento della soglia per scrivere subito
+        if ((was_empty or len(pending_operations) >= batch_size_threshold)
+                and not batch_flush_event.is_set()):
+            batch_flush_event.set()
+    return seq
+
+def get_pending(key: str) -> Optional[Tuple[Optional[bytes], str, Optional[float], Optional[int]]]:
+    """Restituisce l'ultima operazione non ancora scritta nel database per la chiave, se esiste"""
+    with batch_lock:
+        return pending_index.get(key) or flushing_index.get(key)
+
+def get_pending_many(keys: List[str]) -> Dict[str, Tuple[Optional[bytes], str, Optional[float], Optional[int]]]:
+    """Come get_pending, per più chiavi con una sola acquisizione del lock"""
+    result = {}
+    with batch_lock:
+        for key in keys:
+            pending = pending_index.get(key) or flushing_index.get(key)
+            if pending is not None:
+                result[key] = pending
+    return result
+
+def settle_db_read(keys: List[str], rows: Dict[str, Tuple[bytes, int]], epoch: int) -> Dict[str, Tuple[bytes, int]]:
+    """Voci (valore, versione) di una lettura dal database iniziata a flush_epoch epoch. Una chiave scritta
+    durante la lettura prende l'operazione non sincronizzata; la cache viene riempita solo se nel frattempo
+    nessun batch è stato sincronizzato, altrimenti la riga letta potrebbe sovrascrivere un valore più recente"""
+    result = {}
+    with batch_lock:
+        fresh = epoch == flush_epoch
+        for key in keys:
+            pending = pending_index.get(key) or flushing_index.get(key)
+            if pending is not None:
+                if pending[1] == "PUT":
+                    result[key] = (pending[0], pending[3])
+            elif key in rows:
+                result[key] = rows[key]
+                if fresh:
+                    memory_cache.put(key, rows[key])
+    return result
+
+def _sorted_range(keys: List[str], low: str, low_inclusive: bool, high: Optional[str]) -> List[str]:
+    """Chiavi di una lista ordinata comprese tra low e high (escluso), con ricerca binaria"""
+    lo = bisect.bisect_left(keys, low) if low_inclusive else bisect.bisect_right(keys, low)
+    hi = len(keys) if high is None else bisect.bisect_left(keys, high)
+    return keys[lo:hi]
+
+def get_pending_range(low: str, low_inclusive: bool, high: Optional[str]) -> Dict[str, Tuple[Optional[bytes], str, Optional[float], Optional[int]]]:
+    """Operazioni non sincronizzate sulle chiavi comprese tra low e high (escluso)"""
+    result = {}
+    with batch_lock:
+        for key in _sorted_range(flushing_keys, low, low_inclusive, high):
+            result[key] = flushing_index[key]
+        # Le operazioni del batch corrente sono più recenti di quelle in scrittura
+        for key in _sorted_range(pending_keys, low, low_inclusive, high):
+            result[key] = pending_index[key]
+    return result
+
+def requeue_operations(operations: List[Tuple[str, Optional[bytes], str, Optional[float], Optional[int]]]):
+    """Rimette le operazioni in testa al batch (batch fallito o recuperato dal log)"""
+    global oldest_pending_time, pending_index, flushing_index, pending_keys, flushing_keys, flush_epoch
+    with batch_lock:
+        pending_operations[:0] = operations
+        oldest_pending_time = time.time()
+        # Percorso raro: l'indice viene ricostruito dall'intero batch
+        pending_index = {}
+        for key, value, operation, expires_at, version in pending_operations:
+            pending_index[key] = (value, operation, expires_at, version)
+        pending_keys = sorted(pending_index)
+        flushing_index = {}
+        flushing_keys = []
+        flush_epoch += 1
+
+# Versioni delle chiavi: un orologio unico del nodo, come le revisioni di etcd. Ogni PUT riceve il
+# valore successivo, quindi la versione di una chiave cresce sempre, anche dopo DELETE e nuova
+# creazione, e una PUT senza condizioni non deve leggere la versione precedente.
+# Una PUT con ?version= (replica inviata dal coordinatore) usa la versione indicata e fa avanzare l'orologio
+version_clock = 0
+# Con NODE_ID (da 0 a NODE_ID_SLOTS - 1) ogni versione assegnata dal nodo è contatore · NODE_ID_SLOTS + NODE_ID:
+# due nodi non assegnano mai la stessa versione, nemmeno dopo un cambio di primario, e a parità di
+# contatore vince il nodo con l'identificativo più alto. Senza NODE_ID le versioni sono 1, 2, 3, ...
+NODE_ID_SLOTS = 1024
+NODE_ID = os.environ.get("NODE_ID", "")
+if NODE_ID and not (NODE_ID.isdigit() and int(NODE_ID) < NODE_ID_SLOTS):
+    logger.error(f"NODE_ID deve essere un intero tra 0 e {NODE_ID_SLOTS - 1}, ricevuto: {NODE_ID}")
+    NODE_ID = ""
+VERSION_STEP = NODE_ID_SLOTS if NODE_ID else 1
+VERSION_OFFSET = int(NODE_ID) if NODE_ID else 0
+
+def load_version_clock():
+    """Riprende l'orologio delle versioni dal contatore persistito da _sync_batch"""
+    global version_clock
+    version_clock = db_counters.get("version", 0)
+
+def next_version(explicit: Optional[int] = None) -> int:
+    """Versione di una nuova scrittura (da chiamare sotto batch_lock)"""
+    global version_clock
+    if explicit is None:
+        version_clock = (version_clock // VERSION_STEP + 1) * VERSION_STEP + VERSION_OFFSET
+        return version_clock
+    version_clock = max(version_clock, explicit)
+    return explicit
+
+def _known_version(key: str) -> Optional[int]:
+    """Versione attuale senza accedere al database (sotto batch_lock): 0 se la chiave non esiste, None se non è nota"""
+    if ttl_wheel.is_expired(key):
+        return 0
+    pending = pending_index.get(key) or flushing_index.get(key)
+    if pending is not None:
+        return pending[3] if pending[1] == "PUT" else 0
+    entry = memory_cache.peek(key)
+    return entry[1] if entry is not None else None
+
+async def read_version(key: str) -> Tuple[int, int]:
+    """Versione attuale della chiave (0 se non esiste) e epoch del batch a cui si riferisce"""
+    with batch_lock:
+        epoch = flush_epoch
+        version = _known_version(key)
+    if version is None:
+        version = await run_db(db_get_version, key)
+    return version, epoch
+
+def confirm_version(key: str, version: int, epoch: int) -> Optional[int]:
+    """Sotto batch_lock: versione attuale della chiave, o None se quella letta dal database
+    può essere stata superata da un batch sincronizzato nel frattempo (va riletta)"""
+    known = _known_version(key)
+    if known is not None:
+        return known
+    return version if epoch == flush_epoch else None
+
+async def wait_durable(seq: Optional[int]):
+    """Attende che l'operazione sia scritta su disco nel log prima di rispondere"""
+    if seq is None or write_log is None:
+        return
+    try:
+        await write_log.wait_durable(seq)
+    except OSError:
+        raise HTTPException(status_code=500, detail="Write log unavailable")
 
 def sync_batch_to_db(background_tasks: BackgroundTasks):
     """Sincronizza il batch di operazioni con il database"""
     background_tasks.add_task(_sync_batch)
 
+def _batch_flusher_loop():
+    """Scrive il batch in background quando supera i limiti di dimensione o di latenza"""
+    while not batch_stop.is_set():
+        with batch_lock:
+            deadline = oldest_pending_time + batch_time_threshold if oldest_pending_time else None
+        timeout = batch_time_threshold if deadline is None else max(0.0, deadline - time.time())
+        batch_flush_event.wait(timeout)
+        batch_flush_event.clear()
+        if batch_stop.is_set():
+            break
+        
+        with batch_lock:
+            due = bool(pending_operations) and (
+                len(pending_operations) >= batch_size_threshold or
+                time.time() - oldest_pending_time >= batch_time_threshold
+            )
+        if due:
+            _sync_batch()
+
 def _sync_batch():
     """Funzione di sincronizzazione del batch che viene eseguita in background"""
-    global last_batch_time
-    operations_to_process = []
+    global oldest_pending_time, pending_index, flushing_index, pending_keys, flushing_keys, flush_epoch
     
-    with batch_lock:
-        if not pending_operations:
-            return
+    with _flush_lock:
+        with batch_lock:
+            if not pending_operations:
+                return
             
-        operations_to_process = pending_operations.copy()
-        pending_operations.clear()
-        last_batch_time = time.time()
-    
-    conn = get_db_connection()
-    try:
-        for key, value, operation in operations_to_process:
-            if operation == "PUT":
-                conn.execute(
-                    "INSERT INTO kv_store (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP) "
-                    "ON CONFLICT(key) DO UPDATE SET value = ?, updated_at = CURRENT_TIMESTAMP",
-                    (key, value, value)
-                )
-            elif operation == "DELETE":
-                conn.execute("DELETE FROM kv_store WHERE key = ?", (key,))
+            operations_to_process = pending_operations.copy()
+            pending_operations.clear()
+            oldest_pending_time = None
+            # Le letture continuano a vedere il batch finché non è nel database
+            flushing_index = pending_index
+            flushing_keys = pending_keys
+            pending_index = {}
+            pending_keys = []
+            if write_log is not None:
+                write_log.seal()
+        
+        # Coalescenza: per ogni chiave conta solo l'ultima operazione del batch
+        latest: Dict[str, Tuple[Optional[bytes], str, Optional[float], Optional[int]]] = {}
+        for key, value, operation, expires_at, version in operations_to_process:
+            latest[key] = (value, operation, expires_at, version)
+        upserts = [(key, value, expires_at, version)
+                   for key, (value, operation, expires_at, version) in latest.items() if operation == "PUT"]
+        deletes = [(key,) for key, (_, operation, _, _) in latest.items() if operation == "DELETE"]
+        max_version = max((version for _, _, _, version in upserts), default=None)
+        
+        start_time = time.perf_counter()
+        conn = get_db_connection()
+        if write_log is not None:
+            # Dopo il commit il segmento sigillato del log viene eliminato: in WAL con NORMAL il
+            # commit non esegue fsync, quindi il batch sarebbe l'unica copia e non ancora durevole
+            conn.execute("PRAGMA synchronous=FULL")
+        try:
+            # La partizione corrente della cronologia viene creata al primo batch del suo intervallo
+            partition = history_partition_for(time.time())
+            if partition in history_partitions:
+                history = history_table(partition)
+            else:
+                history = create_history_partition(conn, partition)
             
-            # Registra l'operazione nella cronologia
-            conn.execute(
-                "INSERT INTO kv_store_history (key, value, operation) VALUES (?, ?, ?)",
-                (key, value, operation)
+            # Righe e byte sostituiti o eliminati, per aggiornare i contatori senza scansioni: le chiavi
+            # scritte dagli ultimi batch sono già note, solo le altre vengono cercate nel database
+            previous = db_rows_footprint(conn, list(latest))
+            written = {key: row_footprint(key, value) for key, (value, _, _, _) in latest.items()}
+            conn.executemany(
+                "INSERT INTO kv_store (key, value, expires_at, version, updated_at) VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at, "
+                "version = excluded.version, updated_at = CURRENT_TIMESTAMP",
+                upserts
             )
+            conn.executemany("DELETE FROM kv_store WHERE key = ?", deletes)
+            
+            # Registra tutte le operazioni nella cronologia, comprese quelle coalescenti
+            conn.executemany(
+                f"INSERT INTO {history} (key, value, operation) VALUES (?, ?, ?)",
+                [(key, value, operation) for key, value, operation, _, _ in operations_to_process]
+            )
+            
+            counter_deltas = {
+                "keys": len(upserts) - sum(1 for size in previous.values() if size is not None),
+                "bytes": sum(size for size in written.values() if size is not None) -
+                         sum(size for size in previous.values() if size is not None),
+                f"history:{history}": len(operations_to_process)
+            }
+            for _, _, operation, _, _ in operations_to_process:
+                name = f"ops:{operation}"
+                counter_deltas[name] = counter_deltas.get(name, 0) + 1
+            # Nella stessa istruzione anche l'orologio delle versioni, che non è un contatore
+            # incrementale: si conserva il massimo
+            counter_rows = list(counter_deltas.items())
+            if max_version is not None:
+                counter_rows.append(("version", max_version))
+            conn.executemany(
+                "INSERT INTO kv_store_counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = "
+                "CASE WHEN name = 'version' THEN MAX(value, excluded.value) ELSE value + excluded.value END",
+                counter_rows
+            )
+            
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Errore durante la sincronizzazione del batch: {e}")
+            # Le operazioni tornano in testa al batch per il prossimo tentativo
+            requeue_operations(operations_to_process)
+            return
         
-        conn.commit()
-        logger.info(f"Sincronizzate {len(operations_to_process)} operazioni nel database")
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Errore durante la sincronizzazione del batch: {e}")
+        with batch_lock:
+            flushing_index = {}
+            flushing_keys = []
+            flush_epoch += 1
+        
+        remember_row_footprints(written)
+        if partition not in history_partitions:
+            bisect.insort(history_partitions, partition)
+        for name, delta in counter_deltas.items():
+            db_counters[name] = db_counters.get(name, 0) + delta
+        if max_version is not None:
+            db_counters["version"] = max(db_counters.get("version", 0), max_version)
+        if HISTORY_MAX_PER_KEY > 0:
+            history_dirty_keys.update(latest)
+        
+        # Le operazioni sono nel database: il segmento del log che le contiene non serve più
+        if write_log is not None:
+            write_log.discard_sealed()
+        
+        elapsed = time.perf_counter() - start_time
+        batch_stats["flushes"] += 1
+        batch_stats["flushed_operations"] += len(operations_to_process)
+        batch_stats["coalesced_operations"] += len(operations_to_process) - len(latest)
+        batch_stats["flush_seconds_total"] += elapsed
+        batch_stats["last_flush_size"] = len(operations_to_process)
+        batch_stats["last_flush_ms"] = round(elapsed * 1000, 3)
+        flush_latency.observe(elapsed)
+        flush_batch_size.observe(len(operations_to_process))
+        logger.info(f"Sincronizzate {len(operations_to_process)} operazioni nel database "
+                    f"({len(latest)} chiavi, {elapsed * 1000:.1f} ms)")
+
+def get_batch_stats():
+    """Restituisce le statistiche del group commit, con il throughput in operazioni al secondo"""
+    stats = dict(batch_stats)
+    total_seconds = stats.pop("flush_seconds_total")
+    stats["ops_per_second"] = round(stats["flushed_operations"] / total_seconds, 1) if total_seconds else None
+    stats["size_threshold"] = batch_size_threshold
+    stats["time_threshold_seconds"] = batch_time_threshold
+    return stats
+
+def replay_write_log() -> int:
+    """Apre il log delle operazioni e scrive nel database i record non sincronizzati prima dell'arresto"""
+    global write_log
+    write_log = WriteLog(WRITE_LOG_FILE, group_delay=WRITE_LOG_GROUP_DELAY_MS / 1000)
+    records = write_log.open()
+    if records:
+        # Le versioni dei record fanno avanzare l'orologio (non ancora persistite nel database);
+        # i record scritti prima delle versioni ne ricevono una nell'ordine del log
+        with batch_lock:
+            records = [
+                (key, value, operation, expires_at, next_version(version) if operation == "PUT" else None)
+                for key, value, operation, expires_at, version in records
+            ]
+        requeue_operations(records)
+        _sync_batch()
+        logger.info(f"Ripristinate {len(records)} operazioni dal log {WRITE_LOG_FILE}")
+    return len(records)
+
+def load_ttl_index() -> int:
+    """Pianifica nella timing wheel le scadenze presenti nel database e nelle operazioni non sincronizzate"""
+    ttl_wheel.clear()
+    # Solo le righe con scadenza, tramite l'indice parziale su expires_at
+    for row in get_db_connection().execute("SELECT key, expires_at FROM kv_store WHERE expires_at IS NOT NULL"):
+        ttl_wheel.schedule(row["key"], row["expires_at"])
+    with batch_lock:
+        for key, (_, operation, expires_at, _) in list(flushing_index.items()) + list(pending_index.items()):
+            if operation == "PUT" and expires_at is not None:
+                ttl_wheel.schedule(key, expires_at)
+            else:
+                ttl_wheel.cancel(key)
+    ttl_stats["loaded_keys"] = len(ttl_wheel)
+    return len(ttl_wheel)
+
+def _ttl_reaper_loop():
+    """Ad ogni tick raccoglie le chiavi scadute e le accoda come DELETE nel batch"""
+    while not ttl_stop.wait(TTL_TICK_SECONDS):
+        # Sotto batch_lock: una PUT concorrente non può finire tra la raccolta e la DELETE
+        with batch_lock:
+            expired = ttl_wheel.advance()
+            if not expired:
+                continue
+            for key in expired:
+                memory_cache.delete(key)
+            try:
+                # La DELETE cancella anche la scadenza registrata nella ruota
+                add_many_to_batch([(key, None, "DELETE", None, None) for key in expired])
+            except OSError as e:
+                # Le chiavi restano invisibili e vengono ripianificate al tick successivo
+                logger.error(f"Errore nell'accodare le chiavi scadute: {e}")
+                for key in expired:
+                    expires_at = ttl_wheel.get_expiry(key)
+                    if expires_at is not None:
+                        ttl_wheel.schedule(key, expires_at)
+                continue
+        ttl_stats["expired_keys"] += len(expired)
+        ttl_stats["last_reclaimed"] = len(expired)
+        logger.info(f"Scadute {len(expired)} chiavi")
+
+def get_ttl_stats():
+    """Statistiche della scadenza delle chiavi"""
+    return {
+        **ttl_stats,
+        "tracked_keys": len(ttl_wheel),
+        "overflow_keys": len(ttl_wheel.overflow),
+        "tick_seconds": ttl_wheel.tick,
+        "wheel_slots": ttl_wheel.slots,
+        "wheel_levels": ttl_wheel.levels
+    }
+
+# Riscaldamento della cache all'avvio
+# "hotkeys": ricarica le chiavi dell'ultima istantanea (se manca, come "recent");
+# "recent": carica le chiavi modificate più di recente fino al limite della cache; "none": cache vuota
+CACHE_WARMUP = os.environ.get("CACHE_WARMUP", "hotkeys")
+CACHE_WARMUP_CHUNK = int(os.environ.get("CACHE_WARMUP_CHUNK", 500))  # Righe lette per ogni fetch
+warmup_stats: Dict[str, Any] = {"mode": CACHE_WARMUP, "loaded_keys": 0, "scanned_rows": 0, "duration_seconds": None}
+
+# Istantanea delle chiavi calde (solo chiavi, dalla prossima da rimuovere alla più preziosa per la politica della cache)
+HOT_KEYS_FILE = os.environ.get("HOT_KEYS_FILE", os.path.join(os.path.dirname(DB_FILE), "hot_keys.json"))
+HOT_KEYS_SNAPSHOT_INTERVAL = int(os.environ.get("HOT_KEYS_SNAPSHOT_INTERVAL", 60))  # secondi
+hot_keys_stop = threading.Event()
+
+def save_hot_keys():
+    """Salva su file le chiavi presenti in cache nell'ordine di rimozione della sua politica"""
+    keys = memory_cache.hot_keys()
+    tmp_file = HOT_KEYS_FILE + ".tmp"
+    try:
+        # Scrittura su file temporaneo reso durevole prima del rename atomico: un crash non lascia
+        # file troncati né un rename che punta a dati non ancora scritti
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(keys, f, separators=(",", ":"), ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, HOT_KEYS_FILE)
+        logger.debug(f"Salvata l'istantanea di {len(keys)} chiavi calde in {HOT_KEYS_FILE}")
+    except OSError as e:
+        logger.error(f"Errore durante il salvataggio delle chiavi calde: {e}")
+
+def load_hot_keys() -> Optional[List[str]]:
+    """Legge l'ultima istantanea delle chiavi calde, se esiste"""
+    try:
+        with open(HOT_KEYS_FILE, encoding="utf-8") as f:
+            keys = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.error(f"Istantanea delle chiavi calde non leggibile: {e}")
+        return None
+    return [key for key in keys if isinstance(key, str)]
+
+def _hot_keys_snapshot_loop():
+    """Salva periodicamente l'istantanea delle chiavi calde fino all'arresto"""
+    while not hot_keys_stop.wait(HOT_KEYS_SNAPSHOT_INTERVAL):
+        save_hot_keys()
+
+def warm_up_cache():
+    """Popola la cache leggendo il database a blocchi, fermandosi al limite della cache"""
+    start_time = time.time()
+    selected: List[Tuple[str, Tuple[bytes, int], int]] = []
+    scanned_rows = 0
+    loaded_bytes = 0
+    
+    def select(key, value):
+        """Aggiunge una riga (valore e versione) alla selezione; restituisce False se il limite è raggiunto"""
+        nonlocal loaded_bytes
+        size = get_item_size(key, value)
+        if size > memory_cache.max_size_bytes or ttl_wheel.is_expired(key):
+            return True
+        if (len(selected) >= memory_cache.max_items or
+                loaded_bytes + size > memory_cache.max_size_bytes):
+            return False
+        selected.append((key, value, size))
+        loaded_bytes += size
+        return True
+    
+    mode = CACHE_WARMUP
+    hot_keys = load_hot_keys() if mode == "hotkeys" else None
+    if mode == "hotkeys" and hot_keys is None:
+        logger.info("Nessuna istantanea delle chiavi calde, riscaldamento dalle chiavi più recenti")
+        mode = "recent"
+    
+    conn = get_db_connection()
+    if mode == "hotkeys":
+        # Si parte dalle chiavi più preziose per la politica e si legge a blocchi con WHERE key IN (...)
+        hot_keys.reverse()
+        budget_reached = False
+        for i in range(0, len(hot_keys), CACHE_WARMUP_CHUNK):
+            chunk = hot_keys[i:i + CACHE_WARMUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(f"SELECT key, value, version FROM kv_store WHERE key IN ({placeholders})", chunk).fetchall()
+            values = {row["key"]: (row["value"], row["version"]) for row in rows}
+            for key in chunk:
+                if key not in values:
+                    continue
+                scanned_rows += 1
+                if not select(key, values[key]):
+                    budget_reached = True
+                    break
+            if budget_reached:
+                break
+    elif mode == "recent":
+        # Il cursore scorre l'indice su updated_at senza caricare l'intera tabella in memoria
+        cursor = conn.execute("SELECT key, value, version FROM kv_store ORDER BY updated_at DESC")
+        budget_reached = False
+        try:
+            while not budget_reached:
+                rows = cursor.fetchmany(CACHE_WARMUP_CHUNK)
+                if not rows:
+                    break
+                for row in rows:
+                    scanned_rows += 1
+                    if not select(row["key"], (row["value"], row["version"])):
+                        budget_reached = True
+                        break
+        finally:
+            # La connessione resta nel pool: si chiude solo il cursore lasciato a metà
+            cursor.close()
+    elif mode != "none":
+        logger.error(f"CACHE_WARMUP non valido: {mode}, la cache parte vuota")
+    
+    # Inserimento dalla chiave meno recente alla più recente, così l'ordine
+    # di utilizzo viene ricostruito
+    for key, value, size in reversed(selected):
+        memory_cache.put(key, value, size)
+    
+    warmup_stats.update(
+        mode=mode,
+        loaded_keys=len(selected),
+        scanned_rows=scanned_rows,
+        duration_seconds=round(time.time() - start_time, 3)
+    )
+
+# Accesso al database fuori dall'event loop
+# Le query SQLite sono sincrone: vengono eseguite su un executor dedicato, così
+# le richieste servite dalla cache non attendono i cache miss in corso
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", 4))
+DB_QUEUE_SIZE = int(os.environ.get("DB_QUEUE_SIZE", 256))  # Operazioni sul database in attesa o in corso
+db_executor: Optional[ThreadPoolExecutor] = None
+_db_slots = threading.BoundedSemaphore(DB_QUEUE_SIZE)
+
+async def run_db(func, *args):
+    """Esegue una funzione sul database nell'executor dedicato, con limite sulle operazioni in coda"""
+    # Backpressure: se la coda è piena la richiesta viene rifiutata invece di accumularsi
+    if not _db_slots.acquire(blocking=False):
+        raise HTTPException(status_code=503, detail="Database sovraccarico, riprovare più tardi")
+    try:
+        return await asyncio.get_running_loop().run_in_executor(db_executor, _timed_db_call, func, *args)
     finally:
-        conn.close()
+        _db_slots.release()
+
+def _timed_db_call(func, *args):
+    """Esegue la funzione sul thread dell'executor misurando solo la durata della query, senza l'attesa in coda"""
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        db_query_latency.observe(time.perf_counter() - start)
+
+def db_get_value(key: str) -> Optional[Tuple[bytes, int]]:
+    """Legge il valore di una chiave dal database, con la sua versione"""
+    row = get_db_connection().execute("SELECT value, version FROM kv_store WHERE key = ?", (key,)).fetchone()
+    return (row["value"], row["version"]) if row else None
+
+def db_get_version(key: str) -> int:
+    """Legge la versione di una chiave dal database (0 se non esiste)"""
+    row = get_db_connection().execute("SELECT version FROM kv_store WHERE key = ?", (key,)).fetchone()
+    return row["version"] if row else 0
+
+# Numero massimo di chiavi per ogni query WHERE key IN (...)
+IN_QUERY_CHUNK = 500
+
+def db_get_values(keys: List[str]) -> Dict[str, Tuple[bytes, int]]:
+    """Legge dal database valori e versioni di più chiavi, con una query IN per blocco di chiavi"""
+    conn = get_db_connection()
+    result = {}
+    for i in range(0, len(keys), IN_QUERY_CHUNK):
+        chunk = keys[i:i + IN_QUERY_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        for row in conn.execute(f"SELECT key, value, version FROM kv_store WHERE key IN ({placeholders})", chunk):
+            result[row["key"]] = (row["value"], row["version"])
+    return result
+
+def db_key_exists(key: str) -> bool:
+    """Verifica se una chiave è presente nel database"""
+    return get_db_connection().execute("SELECT 1 FROM kv_store WHERE key = ?", (key,)).fetchone() is not None
+
+def db_existing_keys(keys: List[str]) -> Set[str]:
+    """Chiavi presenti nel database, senza leggerne i valori (la query usa solo l'indice della chiave)"""
+    conn = get_db_connection()
+    result = set()
+    for i in range(0, len(keys), IN_QUERY_CHUNK):
+        chunk = keys[i:i + IN_QUERY_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        result.update(row["key"] for row in conn.execute(f"SELECT key FROM kv_store WHERE key IN ({placeholders})", chunk))
+    return result
+
+def db_get_keys_page(after: str, limit: int, with_values: bool,
+                     start: Optional[str] = None, end: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Legge dal database le prime limit chiavi successive ad after (e in [start, end)), in ordine di chiave primaria"""
+    columns = "key, value, version, updated_at" if with_values else "key"
+    # Le condizioni sulla chiave diventano una ricerca per intervallo sul B-tree della chiave primaria
+    conditions = ["key > ?"]
+    params: List[Any] = [after]
+    if start is not None:
+        conditions.append("key >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("key < ?")
+        params.append(end)
+    params.append(limit)
+    rows = get_db_connection().execute(
+        f"SELECT {columns} FROM kv_store WHERE {' AND '.join(conditions)} ORDER BY key LIMIT ?", params
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+# Paginazione delle chiavi: il cursore è l'ultima chiave della pagina precedente
+KEYS_PAGE_LIMIT = int(os.environ.get("KEYS_PAGE_LIMIT", 1000))
+KEYS_PAGE_MAX = int(os.environ.get("KEYS_PAGE_MAX", 10000))
+
+async def get_keys_page(after: str, limit: int, with_values: bool, start: Optional[str] = None,
+                        end: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Restituisce una pagina di chiavi dal database unita alle operazioni non sincronizzate e il cursore successivo"""
+    # Le operazioni non sincronizzate vengono lette prima della query: una sincronizzata nel frattempo è già nel database
+    if start is not None and start > after:
+        pending = get_pending_range(start, True, end)
+    else:
+        pending = get_pending_range(after, False, end)
+    rows = await run_db(db_get_keys_page, after, limit, with_values, start, end)
+    
+    # Se il database ha altre righe, la pagina copre solo le chiavi fino all'ultima letta
+    upper = rows[-1]["key"] if len(rows) == limit else None
+    items = {row["key"]: row for row in rows}
+    for key, (value, operation, _, version) in pending.items():
+        if upper is not None and key > upper:
+            continue
+        if operation == "DELETE":
+            items.pop(key, None)
+        elif with_values:
+            # updated_at è assegnato dal database alla sincronizzazione
+            items[key] = {"key": key, "value": value, "version": version, "updated_at": None}
+        else:
+            items[key] = {"key": key}
+    
+    # Le chiavi scadute non ancora eliminate dal reaper restano invisibili
+    page = [items[key] for key in sorted(items) if not ttl_wheel.is_expired(key)]
+    next_after = upper
+    if len(page) > limit:
+        page = page[:limit]
+        next_after = page[-1]["key"]
+    if with_values:
+        for item in page:
+            item["value"] = decode_value(item["value"]) if item["value"] is not None else None
+    return page, next_after
+
+def prefix_upper_bound(prefix: str) -> Optional[str]:
+    """Restituisce la prima stringa maggiore di tutte le chiavi con il prefisso (None se non esiste)"""
+    for i in range(len(prefix) - 1, -1, -1):
+        code = ord(prefix[i]) + 1
+        if 0xD800 <= code <= 0xDFFF:
+            # I surrogati non sono codificabili in UTF-8
+            code = 0xE000
+        if code <= sys.maxunicode:
+            return prefix[:i] + chr(code)
+    return None
+
+def keys_page_response(page: List[Dict[str, Any]], next_after: Optional[str], with_values: bool) -> Dict[str, Any]:
+    """Corpo della risposta di una pagina di chiavi"""
+    response = {"keys": [item["key"] for item in page], "next_after": next_after}
+    if with_values:
+        response["items"] = page
+    return response
+
+# Versioni nelle risposte: l'ETag di un valore è la sua versione
+def version_etag(version: int) -> str:
+    return f'"{version}"'
+
+def etag_matches(request: Request, version: int) -> bool:
+    """Indica se l'ETag della versione è tra quelli di If-None-Match"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    etag = version_etag(version)
+    return any(tag.strip() in (etag, "W/" + etag, "*") for tag in header.split(","))
+
+def value_response(request: Request, key: str, value: bytes, version: int) -> Response:
+    """Risposta di una lettura: 304 senza corpo se il client ha già questa versione, altrimenti
+    il valore già serializzato (decompresso solo se memorizzato in forma compressa)"""
+    headers = {"ETag": version_etag(version)}
+    if etag_matches(request, version):
+        return Response(status_code=304, headers=headers)
+    return encoded_response(request, [
+        ("key", encode_value(key)), ("value", expand_value(value)), ("version", encode_value(version))
+    ], headers)
+
+# Operazioni multi-chiave
+BULK_MAX_KEYS = int(os.environ.get("BULK_MAX_KEYS", 10000))
+
+def check_bulk_size(count: int):
+    """Rifiuta le richieste multi-chiave oltre il limite configurato"""
+    if count > BULK_MAX_KEYS:
+        raise HTTPException(status_code=413, detail=f"Too many keys: {count} (max {BULK_MAX_KEYS})")
+
+# Latenza delle richieste per route
+# Un istogramma per (metodo, percorso della route)
+route_latency: Dict[Tuple[str, str], Histogram] = {}
+
+class RouteLatencyMiddleware:
+    """Middleware ASGI che registra la durata di ogni richiesta nell'istogramma della sua route"""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # La route viene assegnata allo scope durante il routing; il template del percorso
+            # (es. /key/{key}) evita un istogramma per ogni chiave
+            route = scope.get("route")
+            name = (scope["method"], route.path if route is not None else "unmatched")
+            histogram = route_latency.get(name)
+            if histogram is None:
+                histogram = route_latency.setdefault(name, Histogram())
+            histogram.observe(time.perf_counter() - start)
+
+def get_route_latency_stats() -> Dict[str, Dict[str, Any]]:
+    return {f"{method} {path}": histogram.get_stats() for (method, path), histogram in sorted(route_latency.items())}
+
+# Metriche nel formato testuale di Prometheus, calcolate al momento della lettura
+# dai contatori già mantenuti: nessun costo aggiuntivo sul percorso delle richieste
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _metric_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+def _format_metric_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+def render_metrics() -> str:
+    """Costruisce il corpo di /metrics"""
+    lines: List[str] = []
+    
+    def metric(name, kind, help_text, samples):
+        """samples: lista di (etichette, valore)"""
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_metric_labels(labels)} {_format_metric_value(value)}")
+    
+    def histogram(name, help_text, series):
+        """series: lista di (etichette, Histogram)"""
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, hist in series:
+            counts, count, total = hist.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(hist.bounds, counts):
+                cumulative += bucket_count
+                le = format(bound, ".6g")
+                lines.append(f"{name}_bucket{_metric_labels({**labels, 'le': le})} {cumulative}")
+            lines.append(f"{name}_bucket{_metric_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{name}_sum{_metric_labels(labels)} {_format_metric_value(total)}")
+            lines.append(f"{name}_count{_metric_labels(labels)} {count}")
+    
+    cache_stats = memory_cache.get_stats()
+    metric("kvs_cache_hits_total", "counter", "Letture servite dalla cache", [({}, cache_stats["hits"])])
+    metric("kvs_cache_misses_total", "counter", "Letture non trovate in cache", [({}, cache_stats["misses"])])
+    metric("kvs_cache_evictions_total", "counter", "Elementi rimossi dalla cache per rispettare i limiti",
+           [({}, cache_stats["evictions"])])
+    metric("kvs_cache_items", "gauge", "Elementi in cache", [({}, cache_stats["items_count"])])
+    metric("kvs_cache_size_bytes", "gauge", "Dimensione stimata della cache", [({}, cache_stats["size_bytes"])])
+    
+    db_size, history_count, db_bytes = get_db_counts()
+    metric("kvs_db_keys", "gauge", "Chiavi nel database", [({}, db_size)])
+    metric("kvs_db_bytes", "gauge", "Byte di chiavi e valori nel database", [({}, db_bytes)])
+    metric("kvs_history_rows", "gauge", "Righe nella cronologia delle operazioni", [({}, history_count)])
+    metric("kvs_synced_operations_total", "counter", "Operazioni scritte nel database",
+           [({"operation": operation}, count) for operation, count in sorted(get_synced_operations().items())])
+    
+    with batch_lock:
+        pending_count = len(pending_operations)
+    metric("kvs_pending_operations", "gauge", "Operazioni in attesa di sincronizzazione", [({}, pending_count)])
+    metric("kvs_batch_flushes_total", "counter", "Batch scritti nel database", [({}, batch_stats["flushes"])])
+    histogram("kvs_batch_flush_size", "Operazioni per batch scritto", [({}, flush_batch_size)])
+    histogram("kvs_batch_flush_duration_seconds", "Durata della scrittura di un batch", [({}, flush_latency)])
+    histogram("kvs_db_query_duration_seconds", "Durata delle query SQLite sull'executor", [({}, db_query_latency)])
+    
+    if write_log is not None:
+        log_stats = write_log.stats
+        metric("kvs_write_log_records_total", "counter", "Record scritti nel log delle operazioni", [({}, log_stats["records"])])
+        metric("kvs_write_log_fsyncs_total", "counter", "fsync del log delle operazioni", [({}, log_stats["fsyncs"])])
+    metric("kvs_compressed_values_total", "counter", "Valori memorizzati in forma compressa",
+           [({}, compression_stats["compressed_values"])])
+    metric("kvs_compression_bytes_total", "counter", "Byte dei valori compressi, prima e dopo la compressione",
+           [({"stage": "input"}, compression_stats["input_bytes"]), ({"stage": "output"}, compression_stats["output_bytes"])])
+    metric("kvs_compression_cpu_seconds_total", "counter", "Tempo di CPU speso in compressione e decompressione",
+           [({"operation": "compress"}, compression_stats["compress_cpu_seconds"]),
+            ({"operation": "decompress"}, compression_stats["decompress_cpu_seconds"])])
+    metric("kvs_ttl_expired_keys_total", "counter", "Chiavi scadute", [({}, ttl_stats["expired_keys"])])
+    metric("kvs_ttl_tracked_keys", "gauge", "Chiavi con scadenza", [({}, len(ttl_wheel))])
+    
+    histogram("kvs_request_duration_seconds", "Durata delle richieste HTTP per route",
+              [({"method": method, "route": path}, hist) for (method, path), hist in sorted(route_latency.items())])
+    return "\n".join(lines) + "\n"
 
 # Lifespan (sostituzione di on_event)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Codice di startup
+    global db_executor, write_log
     init_db()
+    # Le operazioni confermate ma non sincronizzate prima dell'arresto vanno nel database
+    # prima del riscaldamento della cache
+    if WRITE_LOG_ENABLED:
+        replay_write_log()
+    load_ttl_index()
+    db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="kvs-db")
     
-    # Carica i dati dal database nella cache
-    conn = get_db_connection()
-    rows = conn.execute("SELECT key, value FROM kv_store").fetchall()
-    conn.close()
+    # Riscalda la cache prima di accettare richieste: il server risulta
+    # pronto solo al termine del caricamento
+    warm_up_cache()
+    
+    # Avvia il salvataggio periodico delle chiavi calde
+    hot_keys_stop.clear()
+    snapshot_thread = threading.Thread(target=_hot_keys_snapshot_loop, name="hot-keys-snapshot", daemon=True)
+    snapshot_thread.start()
+    
+    # Avvia il flusher del batch
+    batch_stop.clear()
+    flusher_thread = threading.Thread(target=_batch_flusher_loop, name="batch-flusher", daemon=True)
+    flusher_thread.start()
     
-    for row in rows:
-        memory_cache.put(row["key"], row["value"])
+    # Avvia la raccolta delle chiavi scadute
+    ttl_stop.clear()
+    reaper_thread = threading.Thread(target=_ttl_reaper_loop, name="ttl-reaper", daemon=True)
+    reaper_thread.start()
+    
+    # Avvia la compattazione della cronologia
+    history_stop.clear()
+    compactor_thread = threading.Thread(target=_history_compactor_loop, name="history-compactor", daemon=True)
+    compactor_thread.start()
     
     logger.info(f"Inizializzato il key-value store con {len(memory_cache.keys())} chiavi dalla persistenza")
     logger.info(f"Configurazione: MAX_CACHE_ITEMS={MAX_CACHE_ITEMS}, MAX_CACHE_SIZE_BYTES={MAX_CACHE_SIZE_BYTES}, DB_FILE={DB_FILE}")
@@ -237,15 +2660,30 @@ async def lifespan(app: FastAPI):
     yield  # Questo punto è dove l'applicazione viene eseguita
     
     # Codice di shutdown
-    # Forza la sincronizzazione all'arresto
-    background_tasks = BackgroundTasks()
-    sync_batch_to_db(background_tasks)
-    # Esegue la sincronizzazione in modo sincrono dato che il server sta per arrestarsi
+    ttl_stop.set()
+    reaper_thread.join()
+    history_stop.set()
+    compactor_thread.join()
+    # Ferma il flusher e forza la sincronizzazione all'arresto
+    batch_stop.set()
+    batch_flush_event.set()
+    flusher_thread.join()
     _sync_batch()
+    if write_log is not None:
+        write_log.close()
+        write_log = None
+    db_executor.shutdown(wait=True)
+    
+    # Ultima istantanea delle chiavi calde per il prossimo avvio
+    hot_keys_stop.set()
+    snapshot_thread.join()
+    save_hot_keys()
+    close_db_connections()
     logger.info("Key-value store arrestato correttamente")
 
 # Inizializzazione FastAPI con lifespan
 app = FastAPI(title="Key-Value Store Distribuito", lifespan=lifespan)
+app.add_middleware(RouteLatencyMiddleware)
 
 # Routes
 @app.get("/")
@@ -253,70 +2691,226 @@ async def root():
     return {"message": "Key-Value Store"}
 
 @app.get("/keys")
-async def get_all_keys():
-    """Ottiene tutte le chiavi presenti nel key-value store"""
-    return {"keys": memory_cache.keys()}
+async def get_all_keys(after: str = "", limit: int = Query(KEYS_PAGE_LIMIT, ge=1, le=KEYS_PAGE_MAX),
+                       with_values: bool = False):
+    """Ottiene le chiavi in ordine, una pagina alla volta: next_after è il cursore della pagina successiva"""
+    page, next_after = await get_keys_page(after, limit, with_values)
+    return keys_page_response(page, next_after, with_values)
+
+@app.get("/scan")
+async def scan_keys(prefix: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None,
+                    after: str = "", limit: int = Query(KEYS_PAGE_LIMIT, ge=1, le=KEYS_PAGE_MAX),
+                    with_values: bool = False):
+    """Elenca in ordine le chiavi con un prefisso (?prefix=) o nell'intervallo [start, end), una pagina alla volta"""
+    if prefix is not None:
+        if start is not None or end is not None:
+            raise HTTPException(status_code=400, detail="Use either prefix or start/end")
+        start, end = prefix, prefix_upper_bound(prefix)
+    page, next_after = await get_keys_page(after, limit, with_values, start, end)
+    return keys_page_response(page, next_after, with_values)
+
+@app.get("/keys/stream")
+async def stream_all_keys(after: str = "", with_values: bool = False):
+    """Trasmette tutte le chiavi in NDJSON (un oggetto per riga), leggendo il database a pagine"""
+    async def generate():
+        cursor = after
+        while cursor is not None:
+            page, cursor = await get_keys_page(cursor, KEYS_PAGE_LIMIT, with_values)
+            if page:
+                yield "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in page)
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 @app.get("/key/{key}")
-async def get_value(key: str):
+async def get_value(key: str, request: Request):
     """Ottiene il valore associato a una chiave"""
-    logger.info(f"GET request for key: {key}")
+    logger.debug("GET request for key: %s", key)
     
-    value = memory_cache.get(key)
-    if value is not None:
-        return {"key": key, "value": value}
+    if ttl_wheel.is_expired(key):
+        raise HTTPException(status_code=404, detail=f"Key '{key}' not found")
     
-    # Se non è in cache, prova a cercarlo nel database
-    conn = get_db_connection()
-    db_value = conn.execute("SELECT value FROM kv_store WHERE key = ?", (key,)).fetchone()
-    conn.close()
+    # La cache contiene (valore serializzato, versione): il valore viene inserito nella risposta così com'è
+    entry = memory_cache.get(key)
+    if entry is not None:
+        return value_response(request, key, *entry)
+    
+    # Le operazioni non ancora sincronizzate sono più recenti del database
+    with batch_lock:
+        epoch = flush_epoch
+        pending = get_pending(key)
+    if pending is not None:
+        value, operation, _, version = pending
+        if operation == "DELETE":
+            raise HTTPException(status_code=404, detail=f"Key '{key}' not found")
+        memory_cache.put(key, (value, version))
+        return value_response(request, key, value, version)
     
-    if db_value:
-        # Aggiorna la cache
-        value = db_value["value"]
-        memory_cache.put(key, value)
-        return {"key": key, "value": value}
+    # Se non è in cache, prova a cercarlo nel database; la cache viene aggiornata
+    # solo se la chiave non è stata scritta durante la lettura
+    row = await run_db(db_get_value, key)
+    entry = settle_db_read([key], {key: row} if row is not None else {}, epoch).get(key)
+    
+    if entry is not None:
+        return value_response(request, key, *entry)
     
     raise HTTPException(status_code=404, detail=f"Key '{key}' not found")
 
 @app.put("/key/{key}")
-async def put_value(key: str, item: KeyValue, background_tasks: BackgroundTasks):
-    """Inserisce o aggiorna un valore associato a una chiave"""
-    logger.info(f"PUT request for key: {key} with value: {item.value}")
+async def put_value(key: str, request: Request, ttl: Optional[float] = Query(None, gt=0),
+                    if_version: Optional[int] = Query(None, ge=0), version: Optional[int] = Query(None, ge=1)):
+    """Inserisce o aggiorna un valore associato a una chiave, con scadenza opzionale dopo ttl secondi.
+    if_version: scrive solo se la versione attuale coincide (0: la chiave non deve esistere);
+    version: versione assegnata dal coordinatore alle repliche, rifiutata (409) solo se quella attuale è più recente"""
+    body = await read_body(request)
+    if not isinstance(body, dict) or "value" not in body:
+        raise HTTPException(status_code=422, detail="Body must be an object with a 'value' field")
+    # Formattazione differita: il valore viene convertito in stringa solo con LOG_LEVEL=DEBUG
+    logger.debug("PUT request for key: %s with value: %s", key, body["value"])
+    
+    # Il valore viene serializzato (ed eventualmente compresso) una sola volta:
+    # cache, batch, log e database condividono gli stessi byte
+    data = encode_request_value(body["value"])
+    value = compress_value(data)
+    expires_at = expires_at_from_ttl(ttl)
     
-    # Aggiorna la cache
-    value_str = str(item.value)
-    cache_result = memory_cache.put(key, item.value)
+    # Controllo della versione, assegnazione della nuova e accodamento avvengono sotto batch_lock:
+    # nessun'altra scrittura della chiave può inserirsi tra il confronto e la scrittura
+    conditional = if_version is not None or version is not None
+    while True:
+        if conditional:
+            current, epoch = await read_version(key)
+        with batch_lock:
+            if conditional:
+                current = confirm_version(key, current, epoch)
+                if current is None:
+                    # Un batch sincronizzato durante la lettura può aver cambiato la versione
+                    continue
+                if if_version is not None and current != if_version:
+                    raise HTTPException(status_code=412, detail=f"Version mismatch for key '{key}': current version is {current}",
+                                        headers={"ETag": version_etag(current)})
+                if version is not None and version < current:
+                    raise HTTPException(status_code=409, detail=f"Key '{key}' already has a newer version ({current})",
+                                        headers={"ETag": version_etag(current)})
+            new_version = next_version(version)
+            cache_result = memory_cache.put(key, (value, new_version))
+            # Aggiunge l'operazione al batch e al log; una PUT senza ttl rimuove la scadenza precedente
+            seq = add_to_batch(key, value, "PUT", expires_at, new_version)
+        break
     if not cache_result:
-        logger.warning(f"Valore troppo grande per la cache, memorizzato solo nel database: {key}")
+        logger.warning("Valore troppo grande per la cache, memorizzato solo nel database: %s", key)
     
-    # Aggiunge l'operazione al batch
-    if add_to_batch(key, value_str, "PUT"):
-        sync_batch_to_db(background_tasks)
+    # Risponde solo dopo l'fsync del log
+    await wait_durable(seq)
     
-    return {"key": key, "value": item.value}
+    fields = [("key", encode_value(key)), ("value", data), ("version", encode_value(new_version))]
+    if expires_at is not None:
+        fields.append(("expires_at", encode_value(expires_at)))
+    return encoded_response(request, fields, {"ETag": version_etag(new_version)})
 
 @app.delete("/key/{key}")
-async def delete_value(key: str, background_tasks: BackgroundTasks):
+async def delete_value(key: str):
     """Elimina una chiave e il suo valore associato"""
-    logger.info(f"DELETE request for key: {key}")
+    logger.debug("DELETE request for key: %s", key)
+    
+    if ttl_wheel.is_expired(key):
+        raise HTTPException(status_code=404, detail=f"Key '{key}' not found")
     
     # Rimuove dalla cache
     if not memory_cache.delete(key):
-        # Verifica se esiste nel database
-        conn = get_db_connection()
-        db_value = conn.execute("SELECT value FROM kv_store WHERE key = ?", (key,)).fetchone()
-        conn.close()
-        
-        if not db_value:
+        # Verifica se esiste tra le operazioni non sincronizzate o nel database
+        pending = get_pending(key)
+        if pending is not None:
+            exists = pending[1] == "PUT"
+        else:
+            exists = await run_db(db_key_exists, key)
+        if not exists:
             raise HTTPException(status_code=404, detail=f"Key '{key}' not found")
     
-    # Aggiunge l'operazione al batch
-    if add_to_batch(key, None, "DELETE"):
-        sync_batch_to_db(background_tasks)
+    # Aggiunge l'operazione al batch e al log, rispondendo solo dopo l'fsync
+    await wait_durable(add_to_batch(key, None, "DELETE"))
     
     return {"status": "success", "message": f"Key '{key}' deleted"}
 
+@app.post("/mget")
+async def multi_get(body: KeysRequest, request: Request):
+    """Ottiene i valori di più chiavi: cache e operazioni non sincronizzate, poi una sola query per i miss"""
+    keys = list(dict.fromkeys(body.keys))
+    check_bulk_size(len(keys))
+    logger.debug("MGET request for %d keys", len(keys))
+    
+    # Le chiavi scadute risultano mancanti
+    live_keys = [key for key in keys if not ttl_wheel.is_expired(key)]
+    # Voci (valore, versione)
+    entries = memory_cache.get_many(live_keys)
+    with batch_lock:
+        epoch = flush_epoch
+        pending = get_pending_many([key for key in live_keys if key not in entries])
+    for key, (value, operation, _, version) in pending.items():
+        if operation == "PUT":
+            memory_cache.put(key, (value, version))
+            entries[key] = (value, version)
+    
+    # Come in get_value: le righe lette non sovrascrivono in cache le scritture arrivate durante la query
+    db_keys = [key for key in live_keys if key not in entries and key not in pending]
+    if db_keys:
+        entries.update(settle_db_read(db_keys, await run_db(db_get_values, db_keys), epoch))
+    
+    found = [key for key in keys if key in entries]
+    return encoded_response(request, [
+        ("values", raw_json_object([(key, expand_value(entries[key][0])) for key in found])),
+        ("versions", encode_value({key: entries[key][1] for key in found})),
+        ("missing", encode_value([key for key in keys if key not in entries]))
+    ])
+
+@app.post("/mput")
+async def multi_put(request: Request, ttl: Optional[float] = Query(None, gt=0)):
+    """Inserisce o aggiorna più chiavi, accodate nel batch e nel log come un'unica unità; ttl vale per tutte"""
+    body = await read_body(request)
+    items = body.get("items") if isinstance(body, dict) else None
+    if not isinstance(items, dict):
+        raise HTTPException(status_code=422, detail="Body must be an object with an 'items' object")
+    if "" in items:
+        # La chiave vuota non sarebbe raggiungibile da /key/{key} né elencata dai cursori (key > after)
+        raise HTTPException(status_code=422, detail="Keys must not be empty")
+    check_bulk_size(len(items))
+    logger.debug("MPUT request for %d keys", len(items))
+    
+    expires_at = expires_at_from_ttl(ttl)
+    values = [(key, compress_value(encode_request_value(item))) for key, item in items.items()]
+    operations = []
+    with batch_lock:
+        for key, value in values:
+            version = next_version()
+            memory_cache.put(key, (value, version))
+            operations.append((key, value, "PUT", expires_at, version))
+        # Una sola scrittura nel log per l'intera richiesta e un solo fsync da attendere
+        seq = add_many_to_batch(operations)
+    await wait_durable(seq)
+    
+    return {"status": "success", "count": len(operations),
+            "versions": {key: version for key, _, _, _, version in operations}}
+
+@app.post("/mdelete")
+async def multi_delete(request: KeysRequest):
+    """Elimina più chiavi; le chiavi inesistenti vengono riportate in missing"""
+    keys = list(dict.fromkeys(request.keys))
+    check_bulk_size(len(keys))
+    logger.debug("MDELETE request for %d keys", len(keys))
+    
+    live_keys = [key for key in keys if not ttl_wheel.is_expired(key)]
+    existing = {key for key in live_keys if memory_cache.delete(key)}
+    pending = get_pending_many([key for key in live_keys if key not in existing])
+    existing.update(key for key, (_, operation, _, _) in pending.items() if operation == "PUT")
+    
+    db_keys = [key for key in live_keys if key not in existing and key not in pending]
+    if db_keys:
+        existing.update(await run_db(db_existing_keys, db_keys))
+    
+    deleted = [key for key in keys if key in existing]
+    await wait_durable(add_many_to_batch([(key, None, "DELETE", None, None) for key in deleted]))
+    
+    return {"deleted": deleted, "missing": [key for key in keys if key not in existing]}
+
 @app.post("/force-sync")
 async def force_sync(background_tasks: BackgroundTasks):
     """Forza la sincronizzazione del batch di operazioni con il database"""
@@ -328,21 +2922,41 @@ async def get_stats():
     """Ottiene le statistiche del key-value store"""
     cache_stats = memory_cache.get_stats()
     
-    conn = get_db_connection()
-    db_size = conn.execute("SELECT COUNT(*) as count FROM kv_store").fetchone()["count"]
-    history_count = conn.execute("SELECT COUNT(*) as count FROM kv_store_history").fetchone()["count"]
-    conn.close()
+    db_size, history_count, db_bytes = get_db_counts()
     
     with batch_lock:
         pending_count = len(pending_operations)
     
+    # Confronto tra la dimensione stimata della cache e la memoria reale del processo
+    rss_bytes = get_process_rss_bytes()
+    memory_stats = {
+        "estimated_cache_bytes": cache_stats["size_bytes"],
+        "process_rss_bytes": rss_bytes,
+        "cache_to_rss_ratio": round(cache_stats["size_bytes"] / rss_bytes, 4) if rss_bytes else None
+    }
+    
     return {
         "cache": cache_stats,
+        "memory": memory_stats,
+        "warmup": warmup_stats,
+        "batch": get_batch_stats(),
+        "write_log": write_log.get_stats() if write_log is not None else None,
+        "ttl": get_ttl_stats(),
+        "compression": get_compression_stats(),
+        "history": get_history_stats(),
         "db_size": db_size,
+        "db_bytes": db_bytes,
         "history_count": history_count,
+        "synced_operations": get_synced_operations(),
+        "requests": get_route_latency_stats(),
         "pending_operations": pending_count
     }
 
+@app.get("/metrics")
+async def get_metrics():
+    """Espone le metriche nel formato testuale di Prometheus"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.post("/clear-cache")
 async def clear_cache():
     """Svuota la cache"""
@@ -74,6 +74,7 @@ for i in $(seq 1 $NODES); do
       - MAX_CACHE_SIZE_BYTES=10485760  # 10 MB
       - DB_FILE=/app/data/kv_store.db
       - LOG_FILE=/app/data/kv_store.log
+      - NODE_ID=$i
 
 EOL
 done
@@ -103,17 +103,24 @@ def main():
     
     elif args.command == "keys":
         try:
-            response = requests.get(f"{base_url}/keys")
-            if response.status_code == 200:
+            # Le chiavi arrivano a pagine: next_after è il cursore della pagina successiva
+            after = ""
+            total = 0
+            while after is not None:
+                response = requests.get(f"{base_url}/keys", params={"after": after})
+                if response.status_code != 200:
+                    print_colored(f"Errore: {response.status_code} - {response.text}", "red")
+                    break
                 data = response.json()
-                if data['keys']:
+                if data['keys'] and total == 0:
                     print_colored("Chiavi presenti:", "blue")
-                    for key in data['keys']:
-                        print(f"  - {key}")
-                else:
-                    print_colored("Nessuna chiave presente nel sistema", "yellow")
+                for key in data['keys']:
+                    print(f"  - {key}")
+                total += len(data['keys'])
+                after = data['next_after']
             else:
-                print_colored(f"Errore: {response.status_code} - {response.text}", "red")
+                if total == 0:
+                    print_colored("Nessuna chiave presente nel sistema", "yellow")
         except Exception as e:
             print_colored(f"Errore: {str(e)}", "red")
     
@@ -136,6 +143,7 @@ def main():
                         print(f"    - Dimensione cache: {cache['size_bytes']}/{cache['max_size_bytes']} bytes")
                         print(f"    - Utilizzo: {cache['utilization_percent']}%")
                     print(f"    - Elementi nel DB: {stats.get('db_size', 'N/A')}")
+                    print(f"    - Byte nel DB: {stats.get('db_bytes', 'N/A')}")
                     print(f"    - Elementi nella cronologia: {stats.get('history_count', 'N/A')}")
                     print(f"    - Operazioni in attesa: {stats.get('pending_operations', 'N/A')}")
             else:
@@ -0,0 +1,760 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark per i componenti del Key-Value Store Distribuito con Sharding
+"""
+
+import argparse
+import asyncio
+import bisect
+import contextvars
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# I moduli del nodo scrivono log e database: in modalità benchmark si usa una directory temporanea
+BENCH_DIR = tempfile.mkdtemp(prefix="kvs_bench_")
+os.environ.setdefault("DB_FILE", os.path.join(BENCH_DIR, "kv_store.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(BENCH_DIR, "kv_store.log"))
+os.environ.setdefault("COORDINATOR_LOG_FILE", os.path.join(BENCH_DIR, "coordinator.log"))
+
+import kvs_limited_cache as kvs
+
+def run_threads(threads, target):
+    """Esegue target(indice_thread) su più thread e restituisce il tempo trascorso"""
+    workers = [threading.Thread(target=target, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+def percentile(samples, fraction):
+    """Restituisce il percentile indicato (0.0-1.0) di una lista di campioni"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def print_latencies(name, samples):
+    """Stampa le latenze (in microsecondi) di una serie di misure"""
+    print(f"{name:<44} {statistics.mean(samples) * 1e6:>9.1f} {percentile(samples, 0.5) * 1e6:>9.1f} "
+          f"{percentile(samples, 0.99) * 1e6:>9.1f}")
+
+def bench_cache(args):
+    """Confronta LRUCache e ShardedLRUCache con letture concorrenti su chiavi calde"""
+    keys = [f"key_{i}" for i in range(args.keys)]
+    configurations = [
+        ("LRUCache (lru)", lambda: kvs.LRUCache(max_items=args.keys)),
+        ("LRUCache (clock)", lambda: kvs.LRUCache(max_items=args.keys, read_promotion="clock")),
+        (f"ShardedLRUCache x{args.shards} (lru)",
+         lambda: kvs.ShardedLRUCache(shards=args.shards, max_items=args.keys * 2)),
+        (f"ShardedLRUCache x{args.shards} (clock)",
+         lambda: kvs.ShardedLRUCache(shards=args.shards, max_items=args.keys * 2, read_promotion="clock")),
+    ]
+
+    print(f"{'cache':<32} {'thread':>6} {'ops/s':>12}")
+    for name, factory in configurations:
+        for threads in (1, 4, 16):
+            cache = factory()
+            for key in keys:
+                cache.put(key, kvs.encode_value(f"value_{key}"))
+            ops_per_thread = args.ops // threads
+
+            def reader(index):
+                rnd = random.Random(index)
+                # 90% letture, 10% scritture, distribuzione sbilanciata verso poche chiavi calde
+                hot = keys[:max(1, len(keys) // 20)]
+                for _ in range(ops_per_thread):
+                    key = rnd.choice(hot) if rnd.random() < 0.8 else rnd.choice(keys)
+                    if rnd.random() < 0.9:
+                        cache.get(key)
+                    else:
+                        cache.put(key, "updated")
+
+            elapsed = run_threads(threads, reader)
+            print(f"{name:<32} {threads:>6} {ops_per_thread * threads / elapsed:>12,.0f}")
+
+def bench_policies(args):
+    """Confronta l'hit ratio delle politiche di rimozione su traffico Zipf con scansioni periodiche"""
+    rnd = random.Random(42)
+    # Pesi Zipf: la chiave di rango i ha probabilità proporzionale a 1 / i^s
+    weights = [1.0 / (rank ** args.skew) for rank in range(1, args.keys + 1)]
+    trace = rnd.choices(range(args.keys), weights=weights, k=args.ops)
+    if args.scan_every:
+        # Simula /rebalance: ogni scan_every letture si legge un blocco di chiavi fredde in sequenza
+        scanned = []
+        for index, key in enumerate(trace):
+            scanned.append(key)
+            if index % args.scan_every == args.scan_every - 1:
+                start = rnd.randrange(args.keys)
+                scanned.extend((start + i) % args.keys for i in range(args.capacity))
+        trace = scanned
+
+    print(f"{'politica':<10} {'hit ratio':>10}")
+    for name in kvs.EVICTION_POLICIES:
+        cache = kvs.PolicyCache(policy=name, max_items=args.capacity, max_size_bytes=1 << 40)
+        for key in trace:
+            if not cache.touch(key):
+                cache.put(key, None, size=1)
+        print(f"{name:<10} {cache.get_stats()['hit_ratio']:>10.4f}")
+
+def bench_sqlite(args):
+    """Latenza del percorso di cache miss: connessione per richiesta vs pool con WAL"""
+    legacy_db = os.path.join(BENCH_DIR, "legacy.db")
+    rows = [(f"key_{i}", f"value_{i}" * 8) for i in range(args.keys)]
+
+    # Database "prima": journal di default, una connessione aperta e chiusa a ogni lettura
+    conn = sqlite3.connect(legacy_db)
+    conn.execute("CREATE TABLE IF NOT EXISTS kv_store (key TEXT PRIMARY KEY, value TEXT)")
+    conn.executemany("INSERT OR REPLACE INTO kv_store VALUES (?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+    # Database "dopo": tabelle e pragma del nodo, connessione del pool
+    kvs.init_db()
+    conn = kvs.get_db_connection()
+    conn.executemany("INSERT OR REPLACE INTO kv_store (key, value) VALUES (?, ?)", rows)
+    conn.commit()
+
+    def legacy_read(key):
+        conn = sqlite3.connect(legacy_db)
+        conn.row_factory = sqlite3.Row
+        conn.execute("SELECT value FROM kv_store WHERE key = ?", (key,)).fetchone()
+        conn.close()
+
+    def pooled_read(key):
+        kvs.get_db_connection().execute("SELECT value FROM kv_store WHERE key = ?", (key,)).fetchone()
+
+    def writer(db_file, stop, pooled):
+        # Simula _sync_batch: batch di scritture con commit ripetuti
+        conn = kvs.get_db_connection() if pooled else sqlite3.connect(db_file)
+        i = 0
+        while not stop.is_set():
+            conn.executemany("INSERT OR REPLACE INTO kv_store (key, value) VALUES (?, ?)",
+                             [(f"key_{(i + j) % args.keys}", "updated") for j in range(50)])
+            conn.commit()
+            i += 50
+
+    print(f"{'percorso di miss (us)':<44} {'media':>9} {'p50':>9} {'p99':>9}")
+    rnd = random.Random(1)
+    for name, read, db_file, pooled in (("connessione per richiesta", legacy_read, legacy_db, False),
+                                        ("pool per thread + WAL", pooled_read, kvs.DB_FILE, True)):
+        stop = threading.Event()
+        writer_thread = None
+        if args.writer:
+            writer_thread = threading.Thread(target=writer, args=(db_file, stop, pooled))
+            writer_thread.start()
+        samples = []
+        for _ in range(args.ops):
+            key = f"key_{rnd.randrange(args.keys)}"
+            start = time.perf_counter()
+            try:
+                read(key)
+            except sqlite3.OperationalError:
+                # "database is locked": il lettore è stato bloccato dallo scrittore
+                pass
+            samples.append(time.perf_counter() - start)
+        stop.set()
+        if writer_thread:
+            writer_thread.join()
+        print_latencies(name + (" (con scrittore)" if args.writer else ""), samples)
+
+def bench_storm(args):
+    """Latenza dei cache hit mentre un'ondata di richieste colpisce il database"""
+    import httpx
+
+    def with_io_latency(func):
+        # Simula la latenza di un disco sotto carico (time.sleep rilascia il GIL come il vero I/O)
+        def wrapper(*args):
+            time.sleep(args_latency)
+            return func(*args)
+        return wrapper
+
+    args_latency = args.io_latency / 1000
+    kvs.db_get_value = with_io_latency(kvs.db_get_value)
+
+    async def inline_db(func, *args):
+        # Comportamento precedente: la query viene eseguita direttamente nell'event loop
+        return func(*args)
+
+    async def measure(run_db_impl):
+        kvs.run_db = run_db_impl
+        transport = httpx.ASGITransport(app=kvs.app)
+        async with kvs.lifespan(kvs.app):
+            async with httpx.AsyncClient(transport=transport, base_url="http://kvstore") as client:
+                await client.put("/key/hot", json={"value": "hot"})
+                stop = asyncio.Event()
+
+                async def storm_worker(index):
+                    i = 0
+                    while not stop.is_set():
+                        # Miss su chiavi inesistenti: ognuno esegue una query sul database
+                        await client.get(f"/key/missing_{index}_{i}")
+                        i += 1
+                        # Con ASGITransport non c'è I/O di rete: si cede il controllo come farebbe il socket
+                        await asyncio.sleep(0)
+
+                workers = [asyncio.create_task(storm_worker(i)) for i in range(args.concurrency)]
+                await asyncio.sleep(0.1)
+                samples = []
+                for _ in range(args.ops):
+                    start = time.perf_counter()
+                    # L'arrivo di una richiesta passa sempre dall'event loop
+                    await asyncio.sleep(0)
+                    await client.get("/key/hot")
+                    samples.append(time.perf_counter() - start)
+                stop.set()
+                await asyncio.gather(*workers, return_exceptions=True)
+        return samples
+
+    print(f"{'latenza cache hit (us)':<44} {'media':>9} {'p50':>9} {'p99':>9}")
+    executor_run_db = kvs.run_db
+    print_latencies("query nell'event loop", asyncio.run(measure(inline_db)))
+    print_latencies("query sull'executor dedicato", asyncio.run(measure(executor_run_db)))
+    kvs.run_db = executor_run_db
+
+def bench_batch(args):
+    """Throughput della sincronizzazione del batch: un execute per operazione vs group commit"""
+    kvs.init_db()
+    conn = kvs.get_db_connection()
+    conn.execute("CREATE TABLE IF NOT EXISTS legacy_history (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                 "key TEXT, value BLOB, operation TEXT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    rnd = random.Random(7)
+    operations = [(f"key_{rnd.randrange(args.keys)}", kvs.encode_value(f"value_{i}"), "PUT", None, i + 1)
+                  for i in range(args.ops)]
+
+    def legacy_flush(batch):
+        # Implementazione precedente: due execute per ogni operazione
+        for key, value, operation, _, _ in batch:
+            conn.execute(
+                "INSERT INTO kv_store (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP) "
+                "ON CONFLICT(key) DO UPDATE SET value = ?, updated_at = CURRENT_TIMESTAMP",
+                (key, value, value)
+            )
+            conn.execute("INSERT INTO legacy_history (key, value, operation) VALUES (?, ?, ?)",
+                         (key, value, operation))
+        conn.commit()
+
+    def group_commit_flush(batch):
+        kvs.pending_operations.extend(batch)
+        start = time.perf_counter()
+        kvs._sync_batch()
+        return time.perf_counter() - start
+
+    def timed_legacy_flush(batch):
+        start = time.perf_counter()
+        legacy_flush(batch)
+        return time.perf_counter() - start
+
+    # Si misura solo la scrittura del batch, non l'accodamento delle operazioni
+    print(f"{'sincronizzazione':<28} {'batch':>6} {'ops/s':>12}")
+    for batch_size in (10, 100, 1000):
+        for name, flush in (("un execute per operazione", timed_legacy_flush), ("group commit", group_commit_flush)):
+            elapsed = sum(flush(operations[i:i + batch_size]) for i in range(0, len(operations), batch_size))
+            print(f"{name:<28} {batch_size:>6} {len(operations) / elapsed:>12,.0f}")
+
+def bench_history(args):
+    """Costo dei conteggi di /stats: COUNT(*) sulla cronologia vs contatori incrementali; durata della compattazione"""
+    kvs.init_db()
+    rnd = random.Random(11)
+    for start in range(0, args.rows, 10000):
+        count = min(10000, args.rows - start)
+        kvs.pending_operations.extend((f"key_{rnd.randrange(args.keys)}", kvs.encode_value("value"), "PUT", None, start + i + 1)
+                                      for i in range(count))
+        kvs._sync_batch()
+
+    conn = kvs.get_db_connection()
+    table = kvs.history_table(kvs.history_partitions[-1])
+
+    def measure(func):
+        samples = []
+        for _ in range(args.ops):
+            start = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    print(f"{'conteggi di /stats (us)':<44} {'media':>9} {'p50':>9} {'p99':>9}")
+    print_latencies(f"COUNT(*) su {args.rows:,} righe",
+                    measure(lambda: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()))
+    print_latencies("contatori incrementali", measure(kvs.get_db_counts))
+
+    start = time.perf_counter()
+    kvs.compact_history()
+    elapsed = time.perf_counter() - start
+    print(f"compattazione a {kvs.HISTORY_MAX_PER_KEY} righe per chiave: {kvs.history_stats['compacted_rows']:,} "
+          f"righe eliminate in {elapsed * 1000:.1f} ms, {kvs.get_db_counts()[1]:,} rimaste")
+
+def bench_bulk(args):
+    """Throughput delle operazioni multi-chiave (/mput, /mget) rispetto alle rotte a chiave singola"""
+    import httpx
+
+    keys = [f"key_{i}" for i in range(args.keys)]
+    chunks = [keys[i:i + args.chunk] for i in range(0, len(keys), args.chunk)]
+
+    async def measure():
+        results = []
+        transport = httpx.ASGITransport(app=kvs.app)
+        async with kvs.lifespan(kvs.app):
+            async with httpx.AsyncClient(transport=transport, base_url="http://kvstore") as client:
+                start = time.perf_counter()
+                for key in keys:
+                    await client.put(f"/key/{key}", json={"value": f"single_{key}"})
+                results.append(("PUT /key/{key}", time.perf_counter() - start))
+
+                start = time.perf_counter()
+                for chunk in chunks:
+                    await client.post("/mput", json={"items": {key: f"bulk_{key}" for key in chunk}})
+                results.append((f"POST /mput ({args.chunk} chiavi)", time.perf_counter() - start))
+
+                start = time.perf_counter()
+                for key in keys:
+                    await client.get(f"/key/{key}")
+                results.append(("GET /key/{key}", time.perf_counter() - start))
+
+                start = time.perf_counter()
+                for chunk in chunks:
+                    await client.post("/mget", json={"keys": chunk})
+                results.append((f"POST /mget ({args.chunk} chiavi)", time.perf_counter() - start))
+        return results
+
+    print(f"{'operazione':<32} {'chiavi/s':>12}")
+    for name, elapsed in asyncio.run(measure()):
+        print(f"{name:<32} {len(keys) / elapsed:>12,.0f}")
+
+def bench_compression(args):
+    """Valori che entrano in una cache di dimensione fissa e CPU per valore, senza e con compressione"""
+    rnd = random.Random(13)
+    documents = [
+        {"id": i, "items": [{"sku": f"sku_{rnd.randrange(1000)}", "qty": rnd.randrange(10),
+                             "status": rnd.choice(("new", "paid", "shipped"))} for _ in range(args.items)]}
+        for i in range(args.keys)
+    ]
+    encoded = [kvs.encode_value(document) for document in documents]
+    max_size_bytes = args.cache_mb * 1024 * 1024
+
+    print(f"{'configurazione':<24} {'valori in cache':>16} {'byte/valore':>12} {'compr. us':>10} {'decompr. us':>12}")
+    for name, threshold, level in (("senza compressione", 0, 6), ("zlib livello 1", args.threshold, 1),
+                                   ("zlib livello 6", args.threshold, 6), ("zlib livello 9", args.threshold, 9)):
+        kvs.COMPRESSION_THRESHOLD_BYTES = threshold
+        kvs.COMPRESSION_LEVEL = level
+        start = time.perf_counter()
+        stored = [kvs.compress_value(data) for data in encoded]
+        compress_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for data in stored:
+            kvs.expand_value(data)
+        decompress_seconds = time.perf_counter() - start
+
+        cache = kvs.LRUCache(max_items=len(stored), max_size_bytes=max_size_bytes)
+        for i, data in enumerate(stored):
+            cache.put(f"key_{i}", data)
+        print(f"{name:<24} {len(cache.cache):>16,} {sum(map(len, stored)) / len(stored):>12,.0f} "
+              f"{compress_seconds / len(stored) * 1e6:>10.1f} {decompress_seconds / len(stored) * 1e6:>12.1f}")
+
+def free_port():
+    """Restituisce una porta TCP libera sull'interfaccia locale"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_nodes(count):
+    """Avvia count nodi KV store in processi separati, ognuno con database e log propri"""
+    import httpx
+
+    processes, nodes = [], []
+    for i in range(count):
+        node_dir = tempfile.mkdtemp(prefix=f"node{i}_", dir=BENCH_DIR)
+        port = free_port()
+        env = dict(os.environ, DB_FILE=os.path.join(node_dir, "kv_store.db"), LOG_FILE=os.path.join(node_dir, "kv_store.log"))
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "kvs_limited_cache:app", "--port", str(port), "--log-level", "warning",
+             "--app-dir", os.path.dirname(os.path.abspath(__file__))],
+            cwd=node_dir, env=env))
+        nodes.append(f"127.0.0.1:{port}")
+    for node in nodes:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                httpx.get(f"http://{node}/", timeout=1)
+                break
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Il nodo {node} non risponde")
+                time.sleep(0.1)
+    return processes, nodes
+
+# Client della richiesta corrente per la simulazione di un AsyncClient per richiesta
+request_client = contextvars.ContextVar("request_client")
+
+class PerRequestClient:
+    """Simula il comportamento precedente: ogni richiesta al coordinatore usa un AsyncClient nuovo
+    (e quindi nuove connessioni TCP verso i nodi), chiuso al termine della richiesta"""
+    def __getattr__(self, name):
+        return getattr(request_client.get(), name)
+
+def bench_coordinator(args):
+    """Latenza e throughput di GET e PUT sul coordinatore: client per richiesta vs client condiviso"""
+    import httpx
+
+    processes, nodes = start_nodes(args.nodes)
+    try:
+        os.environ["KVS_NODES"] = ",".join(nodes)
+        import coordinator
+
+        def per_request_app(app):
+            async def wrapper(scope, receive, send):
+                async with httpx.AsyncClient(timeout=coordinator.REQUEST_TIMEOUT) as client:
+                    token = request_client.set(client)
+                    try:
+                        await app(scope, receive, send)
+                    finally:
+                        request_client.reset(token)
+            return wrapper
+
+        async def run(app, method):
+            latencies = []
+            keys = iter(range(args.ops))
+
+            async def worker(client):
+                for i in keys:
+                    key = f"key_{i % args.keys}"
+                    start = time.perf_counter()
+                    if method == "PUT":
+                        response = await client.put(f"/key/{key}", json={"value": f"value_{i}"})
+                    else:
+                        response = await client.get(f"/key/{key}")
+                    latencies.append(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        raise RuntimeError(f"{method} {key}: {response.status_code} {response.text}")
+
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://coordinator") as client:
+                start = time.perf_counter()
+                await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+                return len(latencies) / (time.perf_counter() - start), latencies
+
+        async def measure(name, app, shared):
+            coordinator.http_client = coordinator.create_http_client() if shared else PerRequestClient()
+            try:
+                for method in ("PUT", "GET"):
+                    throughput, latencies = await run(app, method)
+                    print(f"{name:<32} {method:<4} {throughput:>9,.0f} {statistics.mean(latencies) * 1e3:>9.2f} "
+                          f"{percentile(latencies, 0.5) * 1e3:>9.2f} {percentile(latencies, 0.99) * 1e3:>9.2f}")
+            finally:
+                if shared:
+                    await coordinator.http_client.aclose()
+
+        print(f"{args.nodes} nodi, {args.concurrency} richieste concorrenti")
+        print(f"{'client verso i nodi':<32} {'op':<4} {'req/s':>9} {'media ms':>9} {'p50 ms':>9} {'p99 ms':>9}")
+        asyncio.run(measure("AsyncClient per richiesta", per_request_app(coordinator.app), shared=False))
+        asyncio.run(measure("AsyncClient condiviso (keep-alive)", coordinator.app, shared=True))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+def bench_ring(args):
+    """Ricerche sull'hash ring e aggiunta di un nodo: scansione lineare vs bisect con successori precalcolati"""
+    os.environ.setdefault("KVS_NODES", "127.0.0.1:8001")
+    import coordinator
+
+    def legacy_get_nodes(ring, hash_key, count):
+        # Implementazione precedente: scansione lineare dell'anello e dei nodi già raccolti
+        start_idx = 0
+        for i, (position, _) in enumerate(ring):
+            if position >= hash_key:
+                start_idx = i
+                break
+        result_nodes = []
+        current_idx = start_idx
+        while len(result_nodes) < count:
+            node = ring[current_idx][1]
+            if node not in result_nodes:
+                result_nodes.append(node)
+            current_idx = (current_idx + 1) % len(ring)
+            if current_idx == start_idx:
+                break
+        return result_nodes
+
+    def legacy_add_node(ring_obj, ring, node):
+        # Implementazione precedente: lista delle posizioni ricostruita per ogni nodo virtuale
+        for i in range(ring_obj.virtual_nodes):
+            position = ring_obj._hash(f"{node}:{i}")
+            index = bisect.bisect_left([pos for pos, _ in ring], position)
+            ring.insert(index, (position, node))
+
+    rnd = random.Random(17)
+    keys = [f"key_{rnd.randrange(args.keys)}" for _ in range(args.ops)]
+    print(f"{'nodi':>6} {'nodi virt.':>10} {'get_nodes lineare/s':>20} {'get_nodes bisect/s':>19} "
+          f"{'add_node lineare ms':>20} {'add_node merge ms':>18}")
+    for count in (10, 100, 1000):
+        ring_obj = coordinator.ConsistentHashRing([f"10.0.{i // 256}.{i % 256}:8000" for i in range(count)], args.virtual_nodes)
+        replicas = min(args.replicas, count)
+        ring = ring_obj.ring
+
+        # La scansione lineare è misurata su un campione: a 1000 nodi ogni ricerca percorre decine di migliaia di voci
+        legacy_keys = keys[:min(args.ops, 200000 // count)]
+        start = time.perf_counter()
+        for key in legacy_keys:
+            legacy_get_nodes(ring, ring_obj._hash(key), replicas)
+        legacy_rate = len(legacy_keys) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for key in keys:
+            ring_obj.get_nodes(key, replicas)
+        bisect_rate = len(keys) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        legacy_add_node(ring_obj, list(ring), "10.255.0.1:8000")
+        legacy_add_ms = (time.perf_counter() - start) * 1e3
+        start = time.perf_counter()
+        ring_obj.add_node("10.255.0.1:8000")
+        add_ms = (time.perf_counter() - start) * 1e3
+
+        print(f"{count:>6} {len(ring):>10} {legacy_rate:>20,.0f} {bisect_rate:>19,.0f} {legacy_add_ms:>20.1f} {add_ms:>18.1f}")
+
+def bench_placement(args):
+    """Costo e uniformità del posizionamento delle chiavi con le diverse funzioni di hash dell'anello"""
+    import hashlib
+    os.environ.setdefault("KVS_NODES", "127.0.0.1:8001")
+    import coordinator
+
+    keys = [f"user:{i}:profile".encode("utf-8") for i in range(args.keys)]
+    functions = [("md5 (hexdigest, precedente)", lambda data: int(hashlib.md5(data).hexdigest(), 16))]
+    functions += [(name, function) for name, function in coordinator.HASH_FUNCTIONS.items()
+                  if name != "xxh3" or coordinator.xxhash is not None]
+    nodes = [f"10.0.{i // 256}.{i % 256}:8000" for i in range(args.nodes)]
+
+    print(f"{args.nodes} nodi, {args.virtual_nodes} nodi virtuali per nodo, {args.keys:,} chiavi")
+    print(f"{'funzione di hash':<28} {'hash/s':>12} {'get_node/s':>12} {'chiavi max/media':>17}")
+    for name, function in functions:
+        start = time.perf_counter()
+        for data in keys:
+            function(data)
+        hash_rate = len(keys) / (time.perf_counter() - start)
+
+        if name not in coordinator.HASH_FUNCTIONS:
+            print(f"{name:<28} {hash_rate:>12,.0f}")
+            continue
+        ring = coordinator.ConsistentHashRing(nodes, args.virtual_nodes, name)
+        text_keys = [data.decode("utf-8") for data in keys]
+        load = dict.fromkeys(nodes, 0)
+        start = time.perf_counter()
+        for key in text_keys:
+            load[ring.get_node(key)] += 1
+        lookup_rate = len(keys) / (time.perf_counter() - start)
+        print(f"{name:<28} {hash_rate:>12,.0f} {lookup_rate:>12,.0f} {max(load.values()) / (len(keys) / len(nodes)):>17.2f}")
+
+def bench_strategies(args):
+    """Strategie di posizionamento: costruzione, ricerche, uniformità del carico e chiavi spostate
+    aggiungendo un nodo"""
+    os.environ.setdefault("KVS_NODES", "127.0.0.1:8001")
+    import coordinator
+
+    keys = [f"key_{i}" for i in range(args.keys)]
+    print(f"{'strategia':<18} {'nodi':>5} {'voci':>8} {'costruz. ms':>12} {'get_nodes/s':>12} "
+          f"{'carico max/media':>17} {'spostate +1 nodo':>17}")
+    for count in args.nodes:
+        nodes = [f"10.0.{i // 256}.{i % 256}:8000" for i in range(count)]
+        factories = [
+            ("ring (10 vnodi)", lambda: coordinator.ConsistentHashRing(nodes, 10)),
+            ("ring (100 vnodi)", lambda: coordinator.ConsistentHashRing(nodes, 100)),
+            ("jump", lambda: coordinator.JumpHashPlacement(nodes)),
+            ("rendezvous", lambda: coordinator.RendezvousPlacement(nodes)),
+        ]
+        for name, factory in factories:
+            start = time.perf_counter()
+            placement = factory()
+            build_ms = (time.perf_counter() - start) * 1e3
+            entries = len(placement.positions) if isinstance(placement, coordinator.ConsistentHashRing) else 0
+
+            # Il rendezvous calcola un hash per nodo a ogni ricerca: a molti nodi si misura un campione
+            sample = keys if name != "rendezvous" else keys[:max(1000, len(keys) * 10 // count)]
+            load = dict.fromkeys(nodes, 0)
+            start = time.perf_counter()
+            primaries = {}
+            for key in sample:
+                replicas = placement.get_nodes(key, args.replicas)
+                primaries[key] = replicas[0]
+                load[replicas[0]] += 1
+            lookup_rate = len(sample) / (time.perf_counter() - start)
+            # Con poche chiavi per nodo il massimo misura solo il rumore del campione
+            imbalance = f"{max(load.values()) / (len(sample) / count):.2f}" if len(sample) >= 50 * count else "-"
+
+            placement.add_node("10.255.0.1:8000")
+            moved = sum(1 for key in sample if placement.get_node(key) != primaries[key])
+            print(f"{name:<18} {count:>5} {entries:>8} {build_ms:>12.1f} {lookup_rate:>12,.0f} "
+                  f"{imbalance:>17} {moved / len(sample):>16.1%}")
+
+def bench_bounded(args):
+    """Letture Zipf con nodi simulati a capacità limitata: tutte le repliche, una replica casuale
+    e consistent hashing con carichi limitati a diversi ε"""
+    os.environ.setdefault("KVS_NODES", "127.0.0.1:8001")
+    import coordinator
+
+    nodes = [f"10.0.0.{i}:8000" for i in range(args.nodes)]
+    placement = coordinator.ConsistentHashRing(nodes, 100)
+    rnd = random.Random(42)
+    weights = [1.0 / (rank ** args.skew) for rank in range(1, args.keys + 1)]
+    trace = [f"key_{key}" for key in rnd.choices(range(args.keys), weights=weights, k=args.ops)]
+    replicas = {key: placement.get_nodes(key, args.replicas) for key in set(trace)}
+    coordinator.KVS_NODES = nodes
+
+    async def run(mode, epsilon):
+        coordinator.BOUNDED_LOAD_EPSILON = epsilon
+        coordinator.node_loads.clear()
+        coordinator.bounded_load_stats.update(assignments=0, overflows=0, saturated=0)
+        slots = {node: asyncio.Semaphore(args.slots) for node in nodes}
+        served = dict.fromkeys(nodes, 0)
+        latencies = []
+
+        async def request(node, reserved=False):
+            # Stessa contabilità di request_node: la richiesta in coda sul nodo conta già come in
+            # corso, e con i carichi limitati è già stata contata alla scelta del nodo
+            load = coordinator.node_load(node)
+            if not reserved:
+                load["in_flight"] += 1
+            try:
+                async with slots[node]:
+                    await asyncio.sleep(args.service_ms / 1e3)
+                    served[node] += 1
+            finally:
+                load["in_flight"] -= 1
+
+        async def worker(worker_trace):
+            for key in worker_trace:
+                candidates = replicas[key]
+                start = time.perf_counter()
+                if mode == "all":
+                    await asyncio.gather(*(request(node) for node in candidates))
+                elif mode == "random":
+                    await request(rnd.choice(candidates))
+                else:
+                    await request(coordinator.bounded_load_node(candidates), reserved=True)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(trace[i::args.concurrency]) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        stats = coordinator.bounded_load_stats
+        overflow = f"{stats['overflows'] / stats['assignments']:.1%}" if stats["assignments"] else "-"
+        saturated = f"{stats['saturated'] / stats['assignments']:.1%}" if stats["assignments"] else "-"
+        return (len(trace) / elapsed, percentile(latencies, 0.99) * 1e3,
+                max(served.values()) / (sum(served.values()) / len(nodes)), overflow, saturated)
+
+    modes = [("tutte le repliche", "all", 0.0), ("replica casuale", "random", 0.0)]
+    modes += [(f"carichi ε={epsilon:g}", "bounded", epsilon) for epsilon in args.epsilon]
+    print(f"{'lettura':<20} {'letture/s':>10} {'p99 ms':>8} {'carico max/media':>17} {'overflow':>9} {'saturate':>9}")
+    for name, mode, epsilon in modes:
+        throughput, p99, imbalance, overflow, saturated = asyncio.run(run(mode, epsilon))
+        print(f"{name:<20} {throughput:>10,.0f} {p99:>8.1f} {imbalance:>17.2f} {overflow:>9} {saturated:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark del Key-Value Store Distribuito con Sharding")
+    subparsers = parser.add_subparsers(dest="command", help="Benchmark disponibili")
+
+    cache_parser = subparsers.add_parser("cache", help="Throughput della cache a 1/4/16 thread")
+    cache_parser.add_argument("--keys", type=int, default=1000, help="Numero di chiavi in cache")
+    cache_parser.add_argument("--ops", type=int, default=200000, help="Operazioni totali per esecuzione")
+    cache_parser.add_argument("--shards", type=int, default=8, help="Segmenti della cache partizionata")
+
+    policies_parser = subparsers.add_parser("policies", help="Hit ratio delle politiche di rimozione")
+    policies_parser.add_argument("--keys", type=int, default=100000, help="Numero di chiavi distinte")
+    policies_parser.add_argument("--capacity", type=int, default=1000, help="Capacità della cache (elementi)")
+    policies_parser.add_argument("--ops", type=int, default=200000, help="Letture simulate")
+    policies_parser.add_argument("--skew", type=float, default=0.9, help="Esponente della distribuzione Zipf")
+    policies_parser.add_argument("--scan-every", type=int, default=20000, help="Letture tra due scansioni (0 = nessuna)")
+
+    sqlite_parser = subparsers.add_parser("sqlite", help="Latenza del percorso di cache miss su SQLite")
+    sqlite_parser.add_argument("--keys", type=int, default=10000, help="Righe nella tabella")
+    sqlite_parser.add_argument("--ops", type=int, default=5000, help="Letture misurate")
+    sqlite_parser.add_argument("--writer", action="store_true", help="Scrittore concorrente durante le letture")
+
+    storm_parser = subparsers.add_parser("storm", help="Latenza dei cache hit durante un'ondata di miss")
+    storm_parser.add_argument("--concurrency", type=int, default=16, help="Richieste concorrenti sul database")
+    storm_parser.add_argument("--ops", type=int, default=300, help="Cache hit misurati")
+    storm_parser.add_argument("--io-latency", type=float, default=2.0, help="Latenza di I/O simulata per query (ms)")
+
+    batch_parser = subparsers.add_parser("batch", help="Throughput della sincronizzazione del batch")
+    batch_parser.add_argument("--keys", type=int, default=200, help="Chiavi distinte scritte")
+    batch_parser.add_argument("--ops", type=int, default=20000, help="Operazioni PUT da sincronizzare")
+
+    history_parser = subparsers.add_parser("history", help="Conteggi di /stats e compattazione della cronologia")
+    history_parser.add_argument("--rows", type=int, default=200000, help="Operazioni nella cronologia")
+    history_parser.add_argument("--keys", type=int, default=1000, help="Chiavi distinte")
+    history_parser.add_argument("--ops", type=int, default=200, help="Conteggi misurati")
+
+    bulk_parser = subparsers.add_parser("bulk", help="Throughput di /mput e /mget rispetto alle rotte a chiave singola")
+    bulk_parser.add_argument("--keys", type=int, default=10000, help="Chiavi scritte e lette")
+    bulk_parser.add_argument("--chunk", type=int, default=100, help="Chiavi per richiesta multi-chiave")
+
+    compression_parser = subparsers.add_parser("compression", help="Capacità della cache e costo di CPU della compressione")
+    compression_parser.add_argument("--keys", type=int, default=50000, help="Valori JSON generati")
+    compression_parser.add_argument("--items", type=int, default=40, help="Elementi per documento JSON")
+    compression_parser.add_argument("--cache-mb", type=int, default=10, help="Dimensione massima della cache (MB)")
+    compression_parser.add_argument("--threshold", type=int, default=1024, help="Soglia di compressione (byte)")
+
+    coordinator_parser = subparsers.add_parser("coordinator", help="Latenza di GET e PUT sul coordinatore con e senza client condiviso")
+    coordinator_parser.add_argument("--nodes", type=int, default=3, help="Nodi KV store avviati")
+    coordinator_parser.add_argument("--keys", type=int, default=1000, help="Chiavi distinte")
+    coordinator_parser.add_argument("--ops", type=int, default=2000, help="Richieste per operazione")
+    coordinator_parser.add_argument("--concurrency", type=int, default=16, help="Richieste concorrenti")
+
+    ring_parser = subparsers.add_parser("ring", help="Ricerche sull'hash ring del coordinatore a 10/100/1000 nodi")
+    ring_parser.add_argument("--virtual-nodes", type=int, default=100, help="Nodi virtuali per nodo fisico")
+    ring_parser.add_argument("--replicas", type=int, default=3, help="Nodi restituiti da get_nodes")
+    ring_parser.add_argument("--keys", type=int, default=10000, help="Chiavi distinte cercate")
+    ring_parser.add_argument("--ops", type=int, default=100000, help="Ricerche misurate")
+
+    placement_parser = subparsers.add_parser("placement", help="Costo e uniformità delle funzioni di hash dell'anello")
+    placement_parser.add_argument("--nodes", type=int, default=100, help="Nodi fisici")
+    placement_parser.add_argument("--virtual-nodes", type=int, default=100, help="Nodi virtuali per nodo fisico")
+    placement_parser.add_argument("--keys", type=int, default=500000, help="Chiavi posizionate")
+
+    strategies_parser = subparsers.add_parser("strategies", help="Confronto tra ring, jump hash e rendezvous hashing")
+    strategies_parser.add_argument("--nodes", type=int, nargs="+", default=[10, 100, 1000], help="Numeri di nodi fisici")
+    strategies_parser.add_argument("--replicas", type=int, default=3, help="Nodi restituiti da get_nodes")
+    strategies_parser.add_argument("--keys", type=int, default=100000, help="Chiavi posizionate")
+
+    bounded_parser = subparsers.add_parser("bounded", help="Letture Zipf con e senza consistent hashing a carichi limitati")
+    bounded_parser.add_argument("--nodes", type=int, default=10, help="Nodi simulati")
+    bounded_parser.add_argument("--replicas", type=int, default=3, help="Repliche per chiave")
+    bounded_parser.add_argument("--keys", type=int, default=10000, help="Chiavi distinte")
+    bounded_parser.add_argument("--ops", type=int, default=20000, help="Letture simulate")
+    bounded_parser.add_argument("--skew", type=float, default=1.1, help="Esponente della distribuzione Zipf")
+    bounded_parser.add_argument("--concurrency", type=int, default=64, help="Letture concorrenti")
+    bounded_parser.add_argument("--slots", type=int, default=4, help="Richieste servite in parallelo da ogni nodo")
+    bounded_parser.add_argument("--service-ms", type=float, default=2.0, help="Tempo di servizio per richiesta (ms)")
+    bounded_parser.add_argument("--epsilon", type=float, nargs="+", default=[0.25, 1.0], help="Valori di ε provati")
+
+    args = parser.parse_args()
+    commands = {
+        "cache": bench_cache,
+        "policies": bench_policies,
+        "sqlite": bench_sqlite,
+        "storm": bench_storm,
+        "batch": bench_batch,
+        "history": bench_history,
+        "bulk": bench_bulk,
+        "compression": bench_compression,
+        "coordinator": bench_coordinator,
+        "ring": bench_ring,
+        "placement": bench_placement,
+        "strategies": bench_strategies,
+        "bounded": bench_bounded,
+    }
+    if args.command not in commands:
+        parser.print_help()
+        return
+    commands[args.command](args)
+
+if __name__ == "__main__":
+    main()
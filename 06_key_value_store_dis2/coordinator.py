@@ -2,18 +2,36 @@ import asyncio
 import os
 import logging
 import random
+from contextlib import asynccontextmanager
 import hashlib
 import bisect
+import heapq
+import math
 from typing import Dict, List, Any, Optional, Tuple, Set
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Query
+from urllib.parse import urlencode
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Query, Request, Response
 from pydantic import BaseModel
 import httpx
 
+# h2 è opzionale: senza il pacchetto il client verso i nodi usa solo HTTP/1.1
+try:
+    import h2  # noqa: F401
+    H2_AVAILABLE = True
+except ImportError:
+    H2_AVAILABLE = False
+
+# xxhash è opzionale: senza il pacchetto RING_HASH=xxh3 ripiega su blake2b
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 # Configurazione del logger
+LOG_FILE = os.environ.get("COORDINATOR_LOG_FILE", "coordinator.log")
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='coordinator.log'
+    filename=LOG_FILE
 )
 logger = logging.getLogger("coordinator")
 
@@ -30,16 +48,21 @@ class NodeResponse(BaseModel):
     success: bool
     value: Optional[Any] = None
     error: Optional[str] = None
+    status_code: Optional[int] = None
 
 class KeyValueResponse(BaseModel):
     key: str
     value: Any
+    version: Optional[int] = None
     replicas: int
     responses: List[NodeResponse]
 
 class ShardingConfig(BaseModel):
     replication_factor: float  # Percentuale di nodi su cui replicare (0.0-1.0)
     virtual_nodes: int  # Numero di nodi virtuali per nodo fisico
+    hash_function: Optional[str] = None  # Funzione di hash dell'anello (None: invariata)
+    strategy: Optional[str] = None  # Strategia di posizionamento: ring, jump o rendezvous (None: invariata)
+    weights: Optional[Dict[str, float]] = None  # Pesi dei nodi per rendezvous (None: invariati)
 
 class HashRingNode(BaseModel):
     node: str
@@ -50,6 +73,10 @@ class ShardingInfo(BaseModel):
     replication_factor: float
     virtual_nodes_per_node: int 
     total_virtual_nodes: int
+    strategy: str
+    hash_function: str
+    previous_strategy: Optional[str] = None  # Posizionamento precedente ancora letto durante la migrazione
+    previous_hash_function: Optional[str] = None
     key_distribution: Dict[str, int]  # nodo -> conteggio chiavi
 
 # Configurazione
@@ -58,87 +85,166 @@ KVS_NODES = os.environ.get("KVS_NODES", "").split(",")
 REPLICATION_FACTOR = float(os.environ.get("REPLICATION_FACTOR", "0.5"))
 # Ogni nodo fisico avrà questo numero di nodi virtuali nell'hash ring
 VIRTUAL_NODES = int(os.environ.get("VIRTUAL_NODES", "100"))
+# Funzione di hash per le posizioni sull'anello: md5 (128 bit, posizionamento originale),
+# blake2b (64 bit, libreria standard) o xxh3 (64 bit, richiede il pacchetto xxhash)
+RING_HASH = os.environ.get("RING_HASH", "md5")
+# Funzione di hash precedente durante un cambio: letture e cancellazioni raggiungono anche
+# i nodi del vecchio posizionamento finché /rebalance non ha spostato le chiavi
+RING_HASH_PREVIOUS = os.environ.get("RING_HASH_PREVIOUS", "")
+# Strategia di posizionamento delle chiavi: ring (nodi virtuali), jump (jump consistent hash)
+# o rendezvous (rendezvous hashing pesato); la precedente serve durante una migrazione
+PLACEMENT_STRATEGY = os.environ.get("PLACEMENT_STRATEGY", "ring")
+PLACEMENT_STRATEGY_PREVIOUS = os.environ.get("PLACEMENT_STRATEGY_PREVIOUS", "")
+# Pesi dei nodi per la strategia rendezvous, nel formato "nodo=peso,nodo=peso" (peso predefinito 1)
+NODE_WEIGHTS = {
+    node.strip(): float(weight)
+    for node, _, weight in (item.partition("=") for item in os.environ.get("NODE_WEIGHTS", "").split(",") if item)
+}
 REQUEST_TIMEOUT = int(os.environ.get("REQUEST_TIMEOUT", 10))  # secondi
+KEYS_PAGE_SIZE = int(os.environ.get("KEYS_PAGE_SIZE", 1000))  # Chiavi richieste ai nodi per pagina
+# Pagina massima accettata dai nodi (KEYS_PAGE_MAX del nodo): oltre, i nodi rispondono 422
+KEYS_PAGE_MAX = int(os.environ.get("KEYS_PAGE_MAX", 10000))
+# Client HTTP condiviso verso i nodi: le connessioni restano aperte (keep-alive) tra una richiesta e l'altra
+NODE_MAX_CONNECTIONS = int(os.environ.get("NODE_MAX_CONNECTIONS", 50))  # Richieste contemporanee per nodo
+NODE_KEEPALIVE_CONNECTIONS = int(os.environ.get("NODE_KEEPALIVE_CONNECTIONS", 10))  # Connessioni inattive mantenute per nodo
+KEEPALIVE_EXPIRY = float(os.environ.get("KEEPALIVE_EXPIRY", 30))  # secondi prima di chiudere una connessione inattiva
+CONNECT_TIMEOUT = float(os.environ.get("CONNECT_TIMEOUT", 2))  # secondi per aprire una connessione
+HTTP2 = os.environ.get("HTTP2", "0") == "1"
+# Consistent hashing con carichi limitati: con un valore maggiore di 0 ogni lettura va a una sola
+# replica, la prima in ordine di anello con richieste in corso sotto (1 + ε) volte la media; 0 disattiva
+BOUNDED_LOAD_EPSILON = float(os.environ.get("BOUNDED_LOAD_EPSILON", "0"))
 
 # Validazione della configurazione
 if REPLICATION_FACTOR <= 0 or REPLICATION_FACTOR > 1:
     logger.error(f"REPLICATION_FACTOR deve essere tra 0 e 1, ricevuto: {REPLICATION_FACTOR}")
     REPLICATION_FACTOR = max(0.1, min(1.0, REPLICATION_FACTOR))  # Fallback a un valore valido
+if KEYS_PAGE_SIZE < 1 or KEYS_PAGE_SIZE > KEYS_PAGE_MAX:
+    logger.error(f"KEYS_PAGE_SIZE deve essere tra 1 e KEYS_PAGE_MAX ({KEYS_PAGE_MAX}), ricevuto: {KEYS_PAGE_SIZE}")
+    KEYS_PAGE_SIZE = max(1, min(KEYS_PAGE_MAX, KEYS_PAGE_SIZE))  # Fallback a un valore valido
+if BOUNDED_LOAD_EPSILON < 0:
+    logger.error(f"BOUNDED_LOAD_EPSILON deve essere maggiore o uguale a 0, ricevuto: {BOUNDED_LOAD_EPSILON}")
+    BOUNDED_LOAD_EPSILON = 0.0
 
 logger.info(f"Configurato coordinatore con {len(KVS_NODES)} nodi, fattore di replica {REPLICATION_FACTOR}")
 logger.info(f"Nodi configurati: {KVS_NODES}")
 
+# Funzioni di hash dell'anello: restituiscono direttamente interi a larghezza fissa
+def md5_hash(data: bytes) -> int:
+    """MD5 a 128 bit: lo stesso posizionamento di int(hexdigest, 16), senza passare dalla stringa esadecimale"""
+    return int.from_bytes(hashlib.md5(data).digest(), "big")
+
+def blake2b_hash(data: bytes) -> int:
+    """BLAKE2b con digest di 8 byte (64 bit), disponibile nella libreria standard"""
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+def xxh3_hash(data: bytes) -> int:
+    """XXH3 a 64 bit (pacchetto xxhash)"""
+    return xxhash.xxh3_64_intdigest(data)
+
+HASH_FUNCTIONS = {"md5": md5_hash, "blake2b": blake2b_hash, "xxh3": xxh3_hash}
+
+def resolve_hash_function(name: str) -> str:
+    """Restituisce la funzione di hash effettivamente usabile per un nome configurato"""
+    if name not in HASH_FUNCTIONS:
+        logger.error(f"Funzione di hash sconosciuta: {name}, uso md5")
+        return "md5"
+    if name == "xxh3" and xxhash is None:
+        logger.warning("Funzione di hash xxh3 richiesta ma il pacchetto xxhash non è installato: uso blake2b")
+        return "blake2b"
+    return name
+
+RING_HASH = resolve_hash_function(RING_HASH)
+RING_HASH_PREVIOUS = resolve_hash_function(RING_HASH_PREVIOUS) if RING_HASH_PREVIOUS else ""
+
 # Consistent Hashing Ring
 class ConsistentHashRing:
-    def __init__(self, nodes: List[str], virtual_nodes: int = 100):
-        self.ring: List[Tuple[int, str]] = []  # (position, node)
+    strategy = "ring"
+    
+    def __init__(self, nodes: List[str], virtual_nodes: int = 100, hash_function: str = "md5"):
+        # L'anello è tenuto in due liste parallele ordinate per posizione: le ricerche sono
+        # una bisect sulle posizioni invece di una scansione dei nodi virtuali
+        self.positions: List[int] = []
+        self.owners: List[str] = []
+        # Nodi fisici distinti che seguono ogni segmento dell'anello (indice del primo nodo virtuale
+        # con posizione >= hash della chiave), calcolati al primo uso e azzerati ad ogni modifica
+        self._successors: Dict[int, List[str]] = {}
         self.virtual_nodes = virtual_nodes
+        self.hash_function = hash_function
+        self._hash_bytes = HASH_FUNCTIONS[hash_function]
         self.nodes = set(nodes)
         
         self._build_ring()
     
+    @property
+    def ring(self) -> List[Tuple[int, str]]:
+        """L'anello come lista di (posizione, nodo)"""
+        return list(zip(self.positions, self.owners))
+    
+    def _virtual_positions(self, node: str) -> List[Tuple[int, str]]:
+        """Posizioni dei nodi virtuali di un nodo fisico"""
+        return [(self._hash(f"{node}:{i}"), node) for i in range(self.virtual_nodes)]
+    
+    def _set_ring(self, entries: List[Tuple[int, str]]):
+        """Sostituisce l'anello con le voci (posizione, nodo) già ordinate"""
+        self.positions = [position for position, _ in entries]
+        self.owners = [node for _, node in entries]
+        self._successors = {}
+    
     def _build_ring(self):
         """Costruisce l'hash ring con nodi virtuali"""
-        self.ring = []
+        entries = []
         for node in self.nodes:
-            for i in range(self.virtual_nodes):
-                key = f"{node}:{i}"
-                position = self._hash(key)
-                self.ring.append((position, node))
+            entries.extend(self._virtual_positions(node))
         
         # Ordina l'anello per posizione
-        self.ring.sort(key=lambda x: x[0])
-        logger.info(f"Hash ring costruito con {len(self.ring)} nodi virtuali")
+        entries.sort(key=lambda x: x[0])
+        self._set_ring(entries)
+        logger.info(f"Hash ring costruito con {len(self.positions)} nodi virtuali ({self.hash_function})")
     
     def _hash(self, key: str) -> int:
-        """Calcola l'hash di una chiave"""
-        return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)
+        """Calcola l'hash di una chiave con la funzione dell'anello"""
+        return self._hash_bytes(key.encode('utf-8'))
+    
+    def _segment(self, key: str) -> int:
+        """Indice del primo nodo virtuale con posizione >= hash della chiave (giro circolare dopo l'ultimo)"""
+        index = bisect.bisect_left(self.positions, self._hash(key))
+        return index if index < len(self.positions) else 0
     
     def get_node(self, key: str) -> str:
         """Trova il nodo responsabile per una chiave"""
-        if not self.ring:
+        if not self.positions:
             raise ValueError("Hash ring vuoto")
         
-        hash_key = self._hash(key)
-        
-        # Trova il primo nodo con posizione >= hash_key
-        for position, node in self.ring:
-            if position >= hash_key:
-                return node
-        
-        # Se non trovato, torna al primo nodo (giro circolare)
-        return self.ring[0][1]
+        return self.owners[self._segment(key)]
     
     def get_nodes(self, key: str, count: int) -> List[str]:
         """Trova 'count' nodi responsabili per una chiave, iniziando dal nodo primario"""
-        if not self.ring:
+        if not self.positions:
             raise ValueError("Hash ring vuoto")
         
         if count > len(self.nodes):
             count = len(self.nodes)
         
-        hash_key = self._hash(key)
-        
-        # Trova l'indice del primo nodo con posizione >= hash_key
-        start_idx = 0
-        for i, (position, _) in enumerate(self.ring):
-            if position >= hash_key:
-                start_idx = i
-                break
-        
-        # Raccoglie i nodi unici, procedendo circolarmente nell'anello
-        result_nodes: Set[str] = set()
-        current_idx = start_idx
-        
-        while len(result_nodes) < count:
-            result_nodes.add(self.ring[current_idx][1])
-            current_idx = (current_idx + 1) % len(self.ring)
-            
-            # Se abbiamo fatto il giro completo senza trovare abbastanza nodi unici
-            if current_idx == start_idx:
-                break
-        
-        return list(result_nodes)
+        segment = self._segment(key)
+        successors = self._successors.get(segment)
+        if successors is None or len(successors) < count:
+            successors = self._successors[segment] = self._distinct_successors(segment, count)
+        return successors[:count]
+    
+    def _distinct_successors(self, start: int, count: int) -> List[str]:
+        """Raccoglie i primi 'count' nodi fisici distinti procedendo in senso orario da start:
+        l'ordine è quello dell'anello, il primo è il nodo primario"""
+        result_nodes: List[str] = []
+        seen: Set[str] = set()
+        size = len(self.owners)
+        for step in range(size):
+            node = self.owners[(start + step) % size]
+            if node not in seen:
+                seen.add(node)
+                result_nodes.append(node)
+                if len(result_nodes) == count:
+                    break
+        return result_nodes
     
     def add_node(self, node: str):
         """Aggiunge un nodo all'hash ring"""
@@ -146,12 +252,11 @@ class ConsistentHashRing:
             return
         
         self.nodes.add(node)
-        for i in range(self.virtual_nodes):
-            key = f"{node}:{i}"
-            position = self._hash(key)
-            # Insertion sort per mantenere l'ordine
-            index = bisect.bisect_left([pos for pos, _ in self.ring], position)
-            self.ring.insert(index, (position, node))
+        # Le nuove posizioni ordinate vengono unite all'anello: l'ordinamento di due sequenze
+        # già ordinate costa O(n)
+        entries = self.ring + sorted(self._virtual_positions(node), key=lambda x: x[0])
+        entries.sort(key=lambda x: x[0])
+        self._set_ring(entries)
     
     def remove_node(self, node: str):
         """Rimuove un nodo dall'hash ring"""
@@ -159,50 +264,376 @@ class ConsistentHashRing:
             return
         
         self.nodes.remove(node)
-        self.ring = [(pos, n) for pos, n in self.ring if n != node]
+        self._set_ring([(pos, n) for pos, n in self.ring if n != node])
     
     def get_ring(self) -> List[HashRingNode]:
         """Restituisce l'anello come lista di nodi"""
         return [HashRingNode(node=node, position=position) for position, node in self.ring]
     
+    def describe(self) -> Dict[str, Any]:
+        """Parametri che determinano il posizionamento delle chiavi"""
+        return {"strategy": self.strategy, "hash_function": self.hash_function, "virtual_nodes": self.virtual_nodes}
+    
     def get_node_distribution(self) -> Dict[str, int]:
         """Restituisce la distribuzione dei nodi nell'anello"""
         result = {}
-        for _, node in self.ring:
+        for node in self.owners:
             if node in result:
                 result[node] += 1
             else:
                 result[node] = 1
         return result
 
-# Inizializzazione dell'hash ring
-hash_ring = ConsistentHashRing(KVS_NODES, VIRTUAL_NODES)
+# Le strategie alternative all'anello espongono la stessa interfaccia di ConsistentHashRing
+# (get_node, get_nodes, add_node, remove_node, get_ring, get_node_distribution, describe)
+HASH_MASK_64 = (1 << 64) - 1
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping e Veach): bucket in [0, buckets) per una chiave a 64 bit"""
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941143 + 1) & HASH_MASK_64
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+class JumpHashPlacement:
+    """Jump consistent hash: nessuna struttura in memoria e carico uniforme tra i nodi, numerati
+    nell'ordine di aggiunta; le repliche sono i nodi con i numeri successivi al primario"""
+    strategy = "jump"
+    
+    def __init__(self, nodes: List[str], hash_function: str = "md5"):
+        self.buckets: List[str] = list(dict.fromkeys(nodes))
+        self.nodes = set(self.buckets)
+        self.hash_function = hash_function
+        self._hash_bytes = HASH_FUNCTIONS[hash_function]
+        logger.info(f"Jump hash con {len(self.buckets)} nodi ({hash_function})")
+    
+    def get_node(self, key: str) -> str:
+        """Trova il nodo responsabile per una chiave"""
+        return self.get_nodes(key, 1)[0]
+    
+    def get_nodes(self, key: str, count: int) -> List[str]:
+        """Trova 'count' nodi responsabili per una chiave, iniziando dal nodo primario"""
+        if not self.buckets:
+            raise ValueError("Nessun nodo per il jump hash")
+        
+        size = len(self.buckets)
+        primary = jump_hash(self._hash_bytes(key.encode('utf-8')) & HASH_MASK_64, size)
+        return [self.buckets[(primary + i) % size] for i in range(min(count, size))]
+    
+    def add_node(self, node: str):
+        """Aggiunge un nodo come ultimo bucket: si spostano solo le chiavi che vanno al nuovo nodo"""
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        self.buckets.append(node)
+    
+    def remove_node(self, node: str):
+        """Rimuove un nodo: l'ultimo bucket prende il suo numero, quindi si spostano solo le chiavi
+        del nodo rimosso e quelle dell'ultimo bucket"""
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        index = self.buckets.index(node)
+        last = self.buckets.pop()
+        if index < len(self.buckets):
+            self.buckets[index] = last
+    
+    def get_ring(self) -> List[HashRingNode]:
+        """Il jump hash non ha un anello"""
+        return []
+    
+    def get_node_distribution(self) -> Dict[str, int]:
+        """Un bucket per nodo"""
+        return {node: 1 for node in self.buckets}
+    
+    def describe(self) -> Dict[str, Any]:
+        """Parametri che determinano il posizionamento delle chiavi"""
+        return {"strategy": self.strategy, "hash_function": self.hash_function, "buckets": list(self.buckets)}
+
+class RendezvousPlacement:
+    """Rendezvous hashing (HRW) pesato: ogni chiave va ai nodi con il punteggio più alto e ogni nodo
+    riceve una quota di chiavi proporzionale al suo peso (capacità diverse tra i nodi)"""
+    strategy = "rendezvous"
+    
+    def __init__(self, nodes: List[str], hash_function: str = "md5", weights: Optional[Dict[str, float]] = None):
+        self.weights = dict(weights or {})
+        self.nodes = set(nodes)
+        self.hash_function = hash_function
+        self._hash_bytes = HASH_FUNCTIONS[hash_function]
+        logger.info(f"Rendezvous hashing con {len(self.nodes)} nodi ({hash_function})")
+    
+    def _score(self, node: str, key: str) -> float:
+        """Punteggio logaritmico pesato: -peso / ln(u), con u uniforme in (0, 1) dall'hash di nodo e chiave"""
+        u = ((self._hash_bytes(f"{node}:{key}".encode('utf-8')) & HASH_MASK_64) + 0.5) / (1 << 64)
+        return -self.weights.get(node, 1.0) / math.log(u)
+    
+    def get_node(self, key: str) -> str:
+        """Trova il nodo responsabile per una chiave"""
+        return self.get_nodes(key, 1)[0]
+    
+    def get_nodes(self, key: str, count: int) -> List[str]:
+        """Trova 'count' nodi responsabili per una chiave, in ordine di punteggio (il primo è il primario)"""
+        if not self.nodes:
+            raise ValueError("Nessun nodo per il rendezvous hashing")
+        
+        return heapq.nlargest(min(count, len(self.nodes)), self.nodes, key=lambda node: self._score(node, key))
+    
+    def add_node(self, node: str, weight: Optional[float] = None):
+        """Aggiunge un nodo: si spostano solo le chiavi per cui il nuovo nodo ha il punteggio più alto"""
+        self.nodes.add(node)
+        if weight is not None:
+            self.weights[node] = weight
+    
+    def remove_node(self, node: str):
+        """Rimuove un nodo: si spostano solo le sue chiavi"""
+        self.nodes.discard(node)
+        self.weights.pop(node, None)
+    
+    def get_ring(self) -> List[HashRingNode]:
+        """Il rendezvous hashing non ha un anello"""
+        return []
+    
+    def get_node_distribution(self) -> Dict[str, float]:
+        """Peso di ogni nodo"""
+        return {node: self.weights.get(node, 1.0) for node in sorted(self.nodes)}
+    
+    def describe(self) -> Dict[str, Any]:
+        """Parametri che determinano il posizionamento delle chiavi"""
+        return {"strategy": self.strategy, "hash_function": self.hash_function,
+                "weights": self.get_node_distribution()}
+
+PLACEMENT_STRATEGIES = ("ring", "jump", "rendezvous")
+
+def create_placement(strategy: str, nodes: List[str], hash_function: str,
+                     weights: Optional[Dict[str, float]] = None):
+    """Crea la strategia di posizionamento indicata sui nodi dati"""
+    if strategy == "jump":
+        return JumpHashPlacement(nodes, hash_function)
+    if strategy == "rendezvous":
+        return RendezvousPlacement(nodes, hash_function, weights)
+    return ConsistentHashRing(nodes, VIRTUAL_NODES, hash_function)
+
+if PLACEMENT_STRATEGY not in PLACEMENT_STRATEGIES:
+    logger.error(f"Strategia di posizionamento sconosciuta: {PLACEMENT_STRATEGY}, uso ring")
+    PLACEMENT_STRATEGY = "ring"
+if PLACEMENT_STRATEGY_PREVIOUS and PLACEMENT_STRATEGY_PREVIOUS not in PLACEMENT_STRATEGIES:
+    logger.error(f"Strategia di posizionamento precedente sconosciuta: {PLACEMENT_STRATEGY_PREVIOUS}, ignorata")
+    PLACEMENT_STRATEGY_PREVIOUS = ""
+
+# Inizializzazione del posizionamento (l'hash ring salvo PLACEMENT_STRATEGY diversa)
+hash_ring = create_placement(PLACEMENT_STRATEGY, KVS_NODES, RING_HASH, NODE_WEIGHTS)
+# Posizionamento precedente, presente solo durante una migrazione
+previous_ring = (
+    create_placement(PLACEMENT_STRATEGY_PREVIOUS or PLACEMENT_STRATEGY, KVS_NODES, RING_HASH_PREVIOUS or RING_HASH, NODE_WEIGHTS)
+    if RING_HASH_PREVIOUS or PLACEMENT_STRATEGY_PREVIOUS else None
+)
+
+# Client HTTP verso i nodi, creato nel lifespan e condiviso da tutte le richieste
+http_client: Optional[httpx.AsyncClient] = None
+# Limite di richieste contemporanee per nodo: un nodo lento non occupa tutte le connessioni del pool
+node_slots: Dict[str, asyncio.Semaphore] = {}
+# Serializza riconfigurazioni e ribilanciamenti, che leggono e sostituiscono hash_ring e previous_ring
+sharding_lock = asyncio.Lock()
+
+def create_http_client() -> httpx.AsyncClient:
+    """Crea il client condiviso: pool di connessioni keep-alive, timeout separato per la connessione
+    e HTTP/2 opzionale"""
+    http2 = HTTP2 and H2_AVAILABLE
+    if HTTP2 and not H2_AVAILABLE:
+        logger.warning("HTTP2=1 ma il pacchetto h2 non è installato: il client usa HTTP/1.1")
+    logger.info(f"Client verso i nodi: {NODE_MAX_CONNECTIONS} richieste contemporanee per nodo, "
+                f"keep-alive {KEEPALIVE_EXPIRY}s, {'HTTP/2' if http2 else 'HTTP/1.1'}")
+    limits = httpx.Limits(
+        max_connections=None,  # Limitate per nodo da node_slots
+        max_keepalive_connections=NODE_KEEPALIVE_CONNECTIONS * max(len(KVS_NODES), 1),
+        keepalive_expiry=KEEPALIVE_EXPIRY
+    )
+    timeout = httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
+
+# Carico osservato per nodo: richieste in corso e totali, fallimenti (eccezioni ed errori 5xx)
+node_loads: Dict[str, Dict[str, int]] = {}
+# Letture instradate con i carichi limitati: spostate oltre la prima replica o con tutte le repliche oltre il limite
+bounded_load_stats = {"assignments": 0, "overflows": 0, "saturated": 0}
+
+def node_load(node: str) -> Dict[str, int]:
+    """Contatori di carico di un nodo"""
+    load = node_loads.get(node)
+    if load is None:
+        load = node_loads[node] = {"in_flight": 0, "requests": 0, "failures": 0}
+    return load
+
+def bounded_load_capacity() -> int:
+    """Richieste in corso ammesse per nodo: ceil((1 + ε) · media), contando anche la richiesta da assegnare"""
+    total = sum(node_load(node)["in_flight"] for node in KVS_NODES) + 1
+    return math.ceil((1 + BOUNDED_LOAD_EPSILON) * total / max(len(KVS_NODES), 1))
 
-# Inizializzazione FastAPI
-app = FastAPI(title="KV Store Coordinator con Sharding")
+def bounded_load_node(candidates: List[str]) -> str:
+    """Sceglie tra i nodi, in ordine di anello, il primo sotto il limite di carico; se lo superano
+    tutti, il meno carico. La richiesta è contata sul nodo già alla scelta: va poi eseguita con
+    request_node(..., reserved=True)"""
+    capacity = bounded_load_capacity()
+    bounded_load_stats["assignments"] += 1
+    chosen = next((node for node in candidates if node_load(node)["in_flight"] < capacity), None)
+    if chosen is None:
+        # Tutte le repliche sono al limite: si legge comunque una sola replica, la meno carica.
+        # Leggerle tutte aggiungerebbe carico proprio ai nodi saturi; il caso è contato a parte
+        bounded_load_stats["saturated"] += 1
+        chosen = min(candidates, key=lambda node: node_load(node)["in_flight"])
+    if chosen != candidates[0]:
+        bounded_load_stats["overflows"] += 1
+    # Prenota il posto prima di qualunque await: le letture concorrenti scelgono vedendo già
+    # questa richiesta, invece di vedere tutte lo stesso carico e finire sullo stesso nodo
+    node_load(chosen)["in_flight"] += 1
+    return chosen
+
+def node_slot(node: str) -> asyncio.Semaphore:
+    """Semaforo che limita le richieste contemporanee verso un nodo"""
+    slot = node_slots.get(node)
+    if slot is None:
+        slot = node_slots[node] = asyncio.Semaphore(NODE_MAX_CONNECTIONS)
+    return slot
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    http_client = create_http_client()
+    
+    yield
+    
+    await http_client.aclose()
+    http_client = None
+
+# Inizializzazione FastAPI con lifespan
+app = FastAPI(title="KV Store Coordinator con Sharding", lifespan=lifespan)
 
 # Funzioni di utilità
 async def request_node(client: httpx.AsyncClient, node: str, method: str, endpoint: str, 
-                      json: Dict = None) -> NodeResponse:
-    """Esegue una richiesta a un nodo specifico del KV store"""
+                      json: Dict = None, params: Dict = None, reserved: bool = False) -> NodeResponse:
+    """Esegue una richiesta a un nodo specifico del KV store. Con reserved la richiesta è già
+    contata tra quelle in corso (bounded_load_node)"""
+    load = node_load(node)
+    if not reserved:
+        load["in_flight"] += 1
+    load["requests"] += 1
     try:
-        if method.upper() == "GET":
-            response = await client.get(f"http://{node}{endpoint}", timeout=REQUEST_TIMEOUT)
-        elif method.upper() == "PUT":
-            response = await client.put(f"http://{node}{endpoint}", json=json, timeout=REQUEST_TIMEOUT)
-        elif method.upper() == "DELETE":
-            response = await client.delete(f"http://{node}{endpoint}", timeout=REQUEST_TIMEOUT)
-        else:
-            return NodeResponse(node=node, success=False, error=f"Metodo non supportato: {method}")
+        async with node_slot(node):
+            if method.upper() == "GET":
+                response = await client.get(f"http://{node}{endpoint}", params=params)
+            elif method.upper() == "PUT":
+                response = await client.put(f"http://{node}{endpoint}", json=json, params=params)
+            elif method.upper() == "DELETE":
+                response = await client.delete(f"http://{node}{endpoint}", params=params)
+            elif method.upper() == "POST":
+                response = await client.post(f"http://{node}{endpoint}", json=json, params=params)
+            else:
+                return NodeResponse(node=node, success=False, error=f"Metodo non supportato: {method}")
         
         if response.status_code >= 200 and response.status_code < 300:
-            return NodeResponse(node=node, success=True, value=response.json())
+            return NodeResponse(node=node, success=True, value=response.json(), status_code=response.status_code)
         else:
-            return NodeResponse(node=node, success=False, error=f"Errore {response.status_code}: {response.text}")
+            if response.status_code >= 500:
+                load["failures"] += 1
+            return NodeResponse(node=node, success=False, error=f"Errore {response.status_code}: {response.text}",
+                                status_code=response.status_code)
     
     except Exception as e:
         logger.error(f"Errore durante la richiesta al nodo {node}: {str(e)}")
+        load["failures"] += 1
         return NodeResponse(node=node, success=False, error=str(e))
+    finally:
+        load["in_flight"] -= 1
+
+def newest_response(responses: List[NodeResponse]) -> NodeResponse:
+    """Tra le risposte positive, quella con la versione più alta: una replica che ha perso
+    delle scritture ha una versione minore. A parità di versione (nodi senza NODE_ID, dopo un
+    cambio di primario) vince il nodo con il nome più alto, così lettura e ribilanciamento
+    scelgono la stessa copia"""
+    return max(responses, key=lambda response: (response.value.get("version") or 0, response.node))
+
+def not_modified(request: Request, version: Optional[int]) -> Optional[Response]:
+    """Risposta 304 se il client ha già la versione indicata (If-None-Match con il suo ETag)"""
+    header = request.headers.get("if-none-match")
+    if version is None or not header:
+        return None
+    etag = f'"{version}"'
+    if any(tag.strip() in (etag, "W/" + etag, "*") for tag in header.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+async def replicated_put(client: httpx.AsyncClient, nodes: List[str], key: str, value: Any,
+                         if_version: Optional[int] = None) -> Tuple[Optional[int], int, List[NodeResponse]]:
+    """Scrive prima su un nodo primario, che controlla if_version e assegna la versione, poi invia
+    la stessa versione alle altre repliche: tutte le copie di una scrittura hanno la stessa versione.
+    Restituisce versione, numero di repliche aggiornate e risposte dei nodi"""
+    node_responses = []
+    params = {"if_version": if_version} if if_version is not None else None
+    version = None
+    for index, node in enumerate(nodes):
+        response = await request_node(client, node, "PUT", f"/key/{key}", json={"value": value}, params=params)
+        node_responses.append(response)
+        if response.success:
+            version = response.value.get("version")
+            break
+        if response.status_code == 412:
+            raise HTTPException(status_code=412, detail=f"Versione della chiave '{key}' non corrispondente: {response.error}")
+    else:
+        return None, 0, node_responses
+    
+    # Le repliche applicano la versione solo se più recente: 409 indica una copia già aggiornata
+    tasks = [request_node(client, node, "PUT", f"/key/{key}", json={"value": value}, params={"version": version})
+             for node in nodes[index + 1:]]
+    responses = await asyncio.gather(*tasks)
+    node_responses.extend(responses)
+    successful_writes = 1 + sum(1 for response in responses if response.success or response.status_code == 409)
+    return version, successful_writes, node_responses
+
+async def fetch_keys_page(client: httpx.AsyncClient, after: str, limit: int,
+                          unreachable: Optional[Set[str]] = None) -> Tuple[List[str], Optional[str]]:
+    """Unisce le pagine di chiavi dei nodi (ognuna in ordine) e restituisce il cursore della pagina successiva;
+    se nessun nodo risponde solleva un errore invece di restituire una pagina vuota. I nodi che non
+    rispondono vengono aggiunti a unreachable: le loro chiavi della pagina mancano dal risultato"""
+    # Il cursore vuoto della prima pagina precede ogni chiave: i nodi rifiutano le chiavi vuote
+    endpoint = "/keys?" + urlencode({"after": after, "limit": limit})
+    responses = await asyncio.gather(*[request_node(client, node, "GET", endpoint) for node in KVS_NODES])
+    
+    keys = set()
+    # Oltre il cursore più basso tra i nodi con altre pagine, le chiavi di quei nodi non sono ancora note
+    bound = None
+    answered = 0
+    for response in responses:
+        if response.success and response.value and "keys" in response.value:
+            answered += 1
+            keys.update(response.value["keys"])
+            node_next = response.value.get("next_after")
+            if node_next is not None and (bound is None or node_next < bound):
+                bound = node_next
+        else:
+            logger.warning(f"Pagina di chiavi non ottenuta dal nodo {response.node}: {response.error}")
+            if unreachable is not None:
+                unreachable.add(response.node)
+    
+    if not answered:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Nessun nodo ha restituito le chiavi: {responses[0].error if responses else 'nessun nodo configurato'}"
+        )
+    
+    merged = sorted(key for key in keys if bound is None or key <= bound)
+    if len(merged) > limit:
+        return merged[:limit], merged[limit - 1]
+    return merged, bound
+
+async def iter_all_keys(client: httpx.AsyncClient, unreachable: Optional[Set[str]] = None):
+    """Scorre tutte le chiavi distinte dei nodi una pagina alla volta, senza caricarle tutte in memoria;
+    in unreachable i nodi che non hanno restituito almeno una pagina"""
+    after = ""
+    while after is not None:
+        keys, after = await fetch_keys_page(client, after, KEYS_PAGE_SIZE, unreachable)
+        for key in keys:
+            yield key
 
 def get_replica_nodes(key: str) -> List[str]:
     """Determina quali nodi dovrebbero contenere una chiave in base al consistent hashing"""
@@ -210,6 +641,15 @@ def get_replica_nodes(key: str) -> List[str]:
     replica_count = max(1, round(len(KVS_NODES) * REPLICATION_FACTOR))
     return hash_ring.get_nodes(key, replica_count)
 
+def get_read_nodes(key: str) -> List[str]:
+    """Nodi da interrogare per leggere o cancellare una chiave: le repliche attuali e, durante una
+    migrazione, anche quelle del posizionamento precedente"""
+    nodes = get_replica_nodes(key)
+    if previous_ring is not None:
+        replica_count = max(1, round(len(KVS_NODES) * REPLICATION_FACTOR))
+        nodes += [node for node in previous_ring.get_nodes(key, replica_count) if node not in nodes]
+    return nodes
+
 # Routes
 @app.get("/")
 async def root():
@@ -217,7 +657,9 @@ async def root():
         "message": "KV Store Coordinator con Sharding",
         "nodes": KVS_NODES, 
         "replication_factor": REPLICATION_FACTOR,
-        "virtual_nodes": VIRTUAL_NODES
+        "virtual_nodes": VIRTUAL_NODES,
+        "strategy": hash_ring.strategy,
+        "hash_function": hash_ring.hash_function
     }
 
 @app.get("/sharding/info")
@@ -226,16 +668,8 @@ async def get_sharding_info():
     # Costruisci una mappa di distribuzione delle chiavi
     keys_distribution = {node: 0 for node in KVS_NODES}
     
-    # Ottieni tutte le chiavi
-    all_keys = set()
-    async with httpx.AsyncClient() as client:
-        for node in KVS_NODES:
-            response = await request_node(client, node, "GET", "/keys")
-            if response.success and response.value and "keys" in response.value:
-                all_keys.update(response.value["keys"])
-    
-    # Calcola la distribuzione delle chiavi
-    for key in all_keys:
+    # Calcola la distribuzione scorrendo le chiavi di tutti i nodi a pagine
+    async for key in iter_all_keys(http_client):
         replica_nodes = get_replica_nodes(key)
         for node in replica_nodes:
             if node in keys_distribution:
@@ -246,24 +680,22 @@ async def get_sharding_info():
         replication_factor=REPLICATION_FACTOR,
         virtual_nodes_per_node=VIRTUAL_NODES,
         total_virtual_nodes=len(hash_ring.get_ring()),
+        strategy=hash_ring.strategy,
+        hash_function=hash_ring.hash_function,
+        previous_strategy=previous_ring.strategy if previous_ring is not None else None,
+        previous_hash_function=previous_ring.hash_function if previous_ring is not None else None,
         key_distribution=keys_distribution
     )
 
 @app.get("/keys")
-async def get_all_keys():
-    """Ottiene tutte le chiavi da tutti i nodi"""
-    all_keys = set()
+async def get_all_keys(after: str = "", limit: int = Query(KEYS_PAGE_SIZE, ge=1, le=KEYS_PAGE_MAX)):
+    """Ottiene le chiavi di tutti i nodi in ordine, una pagina alla volta: next_after è il cursore della pagina successiva"""
+    keys, next_after = await fetch_keys_page(http_client, after, limit)
     
-    async with httpx.AsyncClient() as client:
-        for node in KVS_NODES:
-            response = await request_node(client, node, "GET", "/keys")
-            if response.success and response.value and "keys" in response.value:
-                all_keys.update(response.value["keys"])
-    
-    return {"keys": list(all_keys)}
+    return {"keys": keys, "next_after": next_after}
 
 @app.get("/key/{key}")
-async def get_value(key: str):
+async def get_value(key: str, request: Request, response: Response):
     """Ottiene il valore associato a una chiave dai nodi replicati"""
     if not KVS_NODES:
         raise HTTPException(status_code=500, detail="Nessun nodo KV Store configurato")
@@ -274,21 +706,29 @@ async def get_value(key: str):
     if not replica_nodes:
         raise HTTPException(status_code=500, detail="Impossibile determinare i nodi per la chiave")
     
-    # Mischia i nodi replica per distribuire il carico
-    nodes = random.sample(replica_nodes, len(replica_nodes))
+    # Con i carichi limitati si legge una sola replica, la prima sotto il limite: non si
+    # confrontano le versioni tra le repliche, quindi una replica rimasta indietro può restituire
+    # un valore vecchio fino al prossimo /rebalance. Altrimenti si mischiano i nodi replica per
+    # distribuire il carico (durante una migrazione anche quelli del posizionamento precedente)
+    # e vince la versione più recente
+    read_nodes = get_read_nodes(key)
+    if BOUNDED_LOAD_EPSILON > 0 and previous_ring is None:
+        node = bounded_load_node(read_nodes)
+        nodes = [node]
+        # Attesa diretta, senza task: la richiesta parte subito e rilascia sempre il posto prenotato
+        responses = [await request_node(http_client, node, "GET", f"/key/{key}", reserved=True)]
+    else:
+        nodes = random.sample(read_nodes, len(read_nodes))
+        tasks = [request_node(http_client, node, "GET", f"/key/{key}") for node in nodes]
+        responses = await asyncio.gather(*tasks)
     successful_responses = []
     node_responses = []
-    
-    async with httpx.AsyncClient() as client:
-        tasks = [request_node(client, node, "GET", f"/key/{key}") for node in nodes]
-        responses = await asyncio.gather(*tasks)
         
-        for response in responses:
-            node_responses.append(response)
-            if response.success:
-                successful_responses.append(response)
-                # Se abbiamo ottenuto almeno una risposta positiva, possiamo interrompere
-                break
+    # Le risposte arrivano tutte insieme: si tengono tutte per scegliere la versione più recente
+    for node_response in responses:
+        node_responses.append(node_response)
+        if node_response.success:
+            successful_responses.append(node_response)
     
     # Verifica se abbiamo trovato il valore
     if not successful_responses:
@@ -296,17 +736,15 @@ async def get_value(key: str):
         # Questo può accadere se la configurazione dei nodi è cambiata dopo che la chiave è stata scritta
         other_nodes = [node for node in KVS_NODES if node not in nodes]
         if other_nodes:
-            async with httpx.AsyncClient() as client:
-                tasks = [request_node(client, node, "GET", f"/key/{key}") for node in other_nodes]
-                responses = await asyncio.gather(*tasks)
+            tasks = [request_node(http_client, node, "GET", f"/key/{key}") for node in other_nodes]
+            responses = await asyncio.gather(*tasks)
                 
-                for response in responses:
-                    node_responses.append(response)
-                    if response.success:
-                        successful_responses.append(response)
-                        # Trovata la chiave in un nodo non previsto
-                        logger.warning(f"Chiave '{key}' trovata in un nodo non previsto: {response.node}")
-                        break
+            for node_response in responses:
+                node_responses.append(node_response)
+                if node_response.success:
+                    successful_responses.append(node_response)
+                    # Trovata la chiave in un nodo non previsto
+                    logger.warning(f"Chiave '{key}' trovata in un nodo non previsto: {node_response.node}")
         
         if not successful_responses:
             raise HTTPException(
@@ -314,18 +752,26 @@ async def get_value(key: str):
                 detail=f"Chiave '{key}' non trovata in alcun nodo."
             )
     
-    # Estrai il valore dal primo nodo che ha risposto con successo
-    value = successful_responses[0].value["value"]
+    # Tra le repliche che hanno risposto vince quella con la versione più recente
+    newest = newest_response(successful_responses).value
+    version = newest.get("version")
+    cached = not_modified(request, version)
+    if cached is not None:
+        return cached
+    if version is not None:
+        response.headers["ETag"] = f'"{version}"'
     
     return KeyValueResponse(
         key=key,
-        value=value,
+        value=newest["value"],
+        version=version,
         replicas=len(replica_nodes),
         responses=node_responses
     )
 
 @app.put("/key/{key}")
-async def put_value(key: str, item: KeyValue, background_tasks: BackgroundTasks):
+async def put_value(key: str, item: KeyValue, background_tasks: BackgroundTasks,
+                    if_version: Optional[int] = Query(None, ge=0, description="Scrive solo se la versione attuale è questa (0: la chiave non deve esistere)")):
     """Inserisce o aggiorna un valore sui nodi replicati"""
     if not KVS_NODES:
         raise HTTPException(status_code=500, detail="Nessun nodo KV Store configurato")
@@ -336,17 +782,7 @@ async def put_value(key: str, item: KeyValue, background_tasks: BackgroundTasks)
     if not replica_nodes:
         raise HTTPException(status_code=500, detail="Impossibile determinare i nodi per la chiave")
     
-    successful_writes = 0
-    node_responses = []
-    
-    async with httpx.AsyncClient() as client:
-        tasks = [request_node(client, node, "PUT", f"/key/{key}", json={"value": item.value}) for node in replica_nodes]
-        responses = await asyncio.gather(*tasks)
-        
-        for response in responses:
-            node_responses.append(response)
-            if response.success:
-                successful_writes += 1
+    version, successful_writes, node_responses = await replicated_put(http_client, replica_nodes, key, item.value, if_version)
     
     # Verifica se la scrittura è avvenuta con successo su almeno un nodo
     if successful_writes == 0:
@@ -362,6 +798,7 @@ async def put_value(key: str, item: KeyValue, background_tasks: BackgroundTasks)
     return KeyValueResponse(
         key=key,
         value=item.value,
+        version=version,
         replicas=successful_writes,
         responses=node_responses
     )
@@ -381,27 +818,27 @@ async def delete_value(key: str):
     successful_deletes = 0
     node_responses = []
     
-    async with httpx.AsyncClient() as client:
-        tasks = [request_node(client, node, "DELETE", f"/key/{key}") for node in replica_nodes]
-        responses = await asyncio.gather(*tasks)
+    # Durante una migrazione si cancellano anche le copie del posizionamento precedente
+    replica_nodes = get_read_nodes(key)
+    tasks = [request_node(http_client, node, "DELETE", f"/key/{key}") for node in replica_nodes]
+    responses = await asyncio.gather(*tasks)
         
-        for response in responses:
-            node_responses.append(response)
-            if response.success:
-                successful_deletes += 1
+    for response in responses:
+        node_responses.append(response)
+        if response.success:
+            successful_deletes += 1
     
     # Se non abbiamo trovato la chiave in nessun nodo previsto, cerchiamo in tutti gli altri
     if successful_deletes == 0:
         other_nodes = [node for node in KVS_NODES if node not in replica_nodes]
         if other_nodes:
-            async with httpx.AsyncClient() as client:
-                tasks = [request_node(client, node, "DELETE", f"/key/{key}") for node in other_nodes]
-                responses = await asyncio.gather(*tasks)
+            tasks = [request_node(http_client, node, "DELETE", f"/key/{key}") for node in other_nodes]
+            responses = await asyncio.gather(*tasks)
                 
-                for response in responses:
-                    node_responses.append(response)
-                    if response.success:
-                        successful_deletes += 1
+            for response in responses:
+                node_responses.append(response)
+                if response.success:
+                    successful_deletes += 1
     
     if successful_deletes == 0:
         raise HTTPException(
@@ -414,10 +851,41 @@ async def delete_value(key: str):
         message=f"Chiave '{key}' cancellata con successo da {successful_deletes} nodi."
     )
 
+async def movement_report(old_placement, new_placement, old_count: int, new_count: int) -> Dict[str, Any]:
+    """Confronta due posizionamenti sulle chiavi presenti nei nodi: chiavi che cambiano nodo primario
+    o insieme di repliche, copie da creare e chiavi acquisite o perse da ogni nodo"""
+    total_keys = moved_primary = moved_replicas = copies_to_move = 0
+    gained = {node: 0 for node in KVS_NODES}
+    lost = {node: 0 for node in KVS_NODES}
+    
+    async for key in iter_all_keys(http_client):
+        total_keys += 1
+        old_nodes = old_placement.get_nodes(key, old_count)
+        new_nodes = new_placement.get_nodes(key, new_count)
+        if old_nodes[0] != new_nodes[0]:
+            moved_primary += 1
+        if set(old_nodes) != set(new_nodes):
+            moved_replicas += 1
+        for node in set(new_nodes) - set(old_nodes):
+            copies_to_move += 1
+            gained[node] = gained.get(node, 0) + 1
+        for node in set(old_nodes) - set(new_nodes):
+            lost[node] = lost.get(node, 0) + 1
+    
+    return {
+        "total_keys": total_keys,
+        "moved_primary": moved_primary,
+        "moved_replicas": moved_replicas,
+        "moved_fraction": round(moved_replicas / total_keys, 4) if total_keys else 0.0,
+        "copies_to_move": copies_to_move,
+        "gained_by_node": gained,
+        "lost_by_node": lost
+    }
+
 @app.post("/sharding/reconfigure")
 async def reconfigure_sharding(config: ShardingConfig):
-    """Riconfigura lo sharding (fattore di replica e nodi virtuali)"""
-    global REPLICATION_FACTOR, VIRTUAL_NODES, hash_ring
+    """Riconfigura lo sharding (fattore di replica, nodi virtuali, funzione di hash, strategia e pesi)"""
+    global REPLICATION_FACTOR, VIRTUAL_NODES, hash_ring, previous_ring
     
     # Validazione
     if config.replication_factor <= 0 or config.replication_factor > 1:
@@ -432,28 +900,82 @@ async def reconfigure_sharding(config: ShardingConfig):
             detail=f"virtual_nodes deve essere almeno 1, ricevuto: {config.virtual_nodes}"
         )
     
-    # Aggiorna la configurazione
-    old_replication = REPLICATION_FACTOR
-    old_virtual_nodes = VIRTUAL_NODES
+    if config.hash_function is not None and config.hash_function not in HASH_FUNCTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"hash_function deve essere una tra {', '.join(HASH_FUNCTIONS)}, ricevuto: {config.hash_function}"
+        )
+    
+    if config.strategy is not None and config.strategy not in PLACEMENT_STRATEGIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"strategy deve essere una tra {', '.join(PLACEMENT_STRATEGIES)}, ricevuto: {config.strategy}"
+        )
+    
+    if config.weights is not None and any(weight <= 0 for weight in config.weights.values()):
+        raise HTTPException(status_code=400, detail="I pesi dei nodi devono essere positivi")
     
-    REPLICATION_FACTOR = config.replication_factor
-    VIRTUAL_NODES = config.virtual_nodes
+    # Controllo, calcolo dello spostamento (con await) e assegnazione avvengono sotto lo stesso lock:
+    # due riconfigurazioni concorrenti non possono superare entrambe il controllo
+    async with sharding_lock:
+        # Si tiene un solo posizionamento precedente: una seconda riconfigurazione lo sovrascriverebbe
+        # e le chiavi scritte con il primo non sarebbero più raggiungibili da get_read_nodes
+        if previous_ring is not None:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Migrazione da {previous_ring.describe()} in corso: eseguire /rebalance prima di riconfigurare"
+            )
     
-    # Ricostruisci l'hash ring
-    hash_ring = ConsistentHashRing(KVS_NODES, VIRTUAL_NODES)
+        # Aggiorna la configurazione
+        old_replication = REPLICATION_FACTOR
+        old_virtual_nodes = VIRTUAL_NODES
+        old_count = max(1, round(len(KVS_NODES) * old_replication))
     
-    logger.info(f"Sharding riconfigurato: replication_factor da {old_replication} a {REPLICATION_FACTOR}, "
-                f"virtual_nodes da {old_virtual_nodes} a {VIRTUAL_NODES}")
+        REPLICATION_FACTOR = config.replication_factor
+        VIRTUAL_NODES = config.virtual_nodes
     
-    return {
-        "status": "success",
-        "message": "Configurazione sharding aggiornata",
-        "old_config": {"replication_factor": old_replication, "virtual_nodes": old_virtual_nodes},
-        "new_config": {"replication_factor": REPLICATION_FACTOR, "virtual_nodes": VIRTUAL_NODES}
-    }
+        old_config = hash_ring.describe()
+        hash_function = resolve_hash_function(config.hash_function) if config.hash_function is not None else hash_ring.hash_function
+        strategy = config.strategy if config.strategy is not None else hash_ring.strategy
+        if config.weights is not None:
+            weights = config.weights
+        else:
+            weights = hash_ring.weights if isinstance(hash_ring, RendezvousPlacement) else NODE_WEIGHTS
+    
+        # Ricostruisci il posizionamento; se cambia, il precedente resta in lettura
+        # fino al prossimo /rebalance completato senza errori
+        # Il jump hash numera i nodi: si mantiene la numerazione attuale, che dopo una rimozione
+        # può differire dall'ordine di KVS_NODES
+        nodes = hash_ring.buckets if isinstance(hash_ring, JumpHashPlacement) else KVS_NODES
+        new_ring = create_placement(strategy, nodes, hash_function, weights)
+        new_config = new_ring.describe()
+        movement = await movement_report(hash_ring, new_ring, old_count, max(1, round(len(KVS_NODES) * REPLICATION_FACTOR)))
+        if new_config != old_config:
+            previous_ring = hash_ring
+        hash_ring = new_ring
+    
+        logger.info(f"Sharding riconfigurato: replication_factor da {old_replication} a {REPLICATION_FACTOR}, "
+                    f"virtual_nodes da {old_virtual_nodes} a {VIRTUAL_NODES}, posizionamento da {old_config} a {new_config}; "
+                    f"{movement['moved_replicas']}/{movement['total_keys']} chiavi da spostare")
+    
+        return {
+            "status": "success",
+            "message": "Configurazione sharding aggiornata",
+            "old_config": {"replication_factor": old_replication, "virtual_nodes": old_virtual_nodes, **old_config},
+            "new_config": {"replication_factor": REPLICATION_FACTOR, "virtual_nodes": VIRTUAL_NODES, **new_config},
+            "migrating_from": previous_ring.describe() if previous_ring is not None else None,
+            "movement": movement
+        }
+
+def add_placement_node(placement, node: str, weight: Optional[float]):
+    """Aggiunge un nodo a un posizionamento; il peso vale solo per il rendezvous hashing"""
+    if isinstance(placement, RendezvousPlacement):
+        placement.add_node(node, weight)
+    else:
+        placement.add_node(node)
 
 @app.post("/sharding/add-node/{node}")
-async def add_node(node: str):
+async def add_node(node: str, weight: Optional[float] = Query(None, gt=0, description="Peso del nodo (strategia rendezvous)")):
     """Aggiunge un nodo al sistema di sharding"""
     if node in KVS_NODES:
         return {"status": "warning", "message": f"Il nodo {node} è già nel sistema"}
@@ -461,8 +983,11 @@ async def add_node(node: str):
     # Aggiungi il nodo alla lista
     KVS_NODES.append(node)
     
-    # Aggiungi il nodo all'hash ring
-    hash_ring.add_node(node)
+    # Aggiungi il nodo all'hash ring e, durante una migrazione, anche al posizionamento
+    # precedente, con lo stesso peso: le letture lo consultano ancora
+    add_placement_node(hash_ring, node, weight)
+    if previous_ring is not None:
+        add_placement_node(previous_ring, node, weight)
     
     logger.info(f"Aggiunto nodo {node} al sistema di sharding")
     
@@ -479,6 +1004,8 @@ async def remove_node(node: str):
     
     # Rimuovi il nodo dall'hash ring
     hash_ring.remove_node(node)
+    if previous_ring is not None:
+        previous_ring.remove_node(node)
     
     logger.info(f"Rimosso nodo {node} dal sistema di sharding")
     
@@ -508,25 +1035,25 @@ async def get_ring():
     }
 
 @app.get("/sharding/node-keys/{node}")
-async def get_node_keys(node: str):
-    """Ottiene le chiavi presenti su un nodo specifico"""
+async def get_node_keys(node: str, after: str = "", limit: int = Query(KEYS_PAGE_SIZE, ge=1, le=KEYS_PAGE_MAX)):
+    """Ottiene una pagina delle chiavi presenti su un nodo specifico"""
     if node not in KVS_NODES:
         raise HTTPException(status_code=404, detail=f"Nodo '{node}' non trovato")
     
-    async with httpx.AsyncClient() as client:
-        response = await request_node(client, node, "GET", "/keys")
+    response = await request_node(http_client, node, "GET", "/keys?" + urlencode({"after": after, "limit": limit}))
         
-        if not response.success:
-            raise HTTPException(
-                status_code=500, 
-                detail=f"Errore durante il recupero delle chiavi dal nodo {node}: {response.error}"
-            )
+    if not response.success:
+        raise HTTPException(
+            status_code=500, 
+            detail=f"Errore durante il recupero delle chiavi dal nodo {node}: {response.error}"
+        )
     
     node_keys = response.value.get("keys", [])
     return {
         "node": node,
         "keys_count": len(node_keys),
-        "keys": node_keys
+        "keys": node_keys,
+        "next_after": response.value.get("next_after")
     }
 
 @app.get("/stats")
@@ -534,13 +1061,12 @@ async def get_stats():
     """Ottiene le statistiche da tutti i nodi"""
     node_stats = {}
     
-    async with httpx.AsyncClient() as client:
-        tasks = [request_node(client, node, "GET", "/stats") for node in KVS_NODES]
-        responses = await asyncio.gather(*tasks)
+    tasks = [request_node(http_client, node, "GET", "/stats") for node in KVS_NODES]
+    responses = await asyncio.gather(*tasks)
         
-        for response in responses:
-            if response.success:
-                node_stats[response.node] = response.value
+    for response in responses:
+        if response.success:
+            node_stats[response.node] = response.value
     
     # Calcola metriche di sharding
     ring_stats = hash_ring.get_node_distribution()
@@ -553,8 +1079,18 @@ async def get_stats():
             "virtual_nodes": VIRTUAL_NODES
         },
         "sharding": {
+            "placement": hash_ring.describe(),
+            "previous_placement": previous_ring.describe() if previous_ring is not None else None,
             "virtual_node_distribution": ring_stats
         },
+        "load": {
+            "bounded_load_epsilon": BOUNDED_LOAD_EPSILON,
+            "capacity": bounded_load_capacity() if BOUNDED_LOAD_EPSILON > 0 else None,
+            **bounded_load_stats,
+            "overflow_rate": bounded_load_stats["overflows"] / max(bounded_load_stats["assignments"], 1),
+            "saturated_rate": bounded_load_stats["saturated"] / max(bounded_load_stats["assignments"], 1),
+            "nodes": {node: dict(node_load(node)) for node in KVS_NODES}
+        },
         "nodes": node_stats
     }
 
@@ -563,12 +1099,11 @@ async def force_sync():
     """Forza la sincronizzazione su tutti i nodi"""
     results = []
     
-    async with httpx.AsyncClient() as client:
-        tasks = [request_node(client, node, "POST", "/force-sync") for node in KVS_NODES]
-        responses = await asyncio.gather(*tasks)
+    tasks = [request_node(http_client, node, "POST", "/force-sync") for node in KVS_NODES]
+    responses = await asyncio.gather(*tasks)
         
-        for response in responses:
-            results.append(response)
+    for response in responses:
+        results.append(response)
     
     return {
         "status": "completed",
@@ -579,79 +1114,102 @@ async def force_sync():
 @app.post("/rebalance")
 async def rebalance_shards():
     """Ribilancia le chiavi tra i nodi secondo l'attuale configurazione dello sharding"""
-    # Prima ottieni tutte le chiavi esistenti
-    all_keys = set()
-    async with httpx.AsyncClient() as client:
-        for node in KVS_NODES:
-            response = await request_node(client, node, "GET", "/keys")
-            if response.success and response.value and "keys" in response.value:
-                all_keys.update(response.value["keys"])
-    
-    # Calcola la nuova distribuzione delle chiavi
-    key_nodes_map = {}
-    for key in all_keys:
-        key_nodes_map[key] = get_replica_nodes(key)
-    
-    # Per ogni chiave, assicurati che sia sui nodi corretti
-    rebalanced_keys = 0
-    total_operations = 0
-    failed_operations = 0
-    
-    async with httpx.AsyncClient() as client:
-        # Per ogni chiave, controlla dove è attualmente
-        for key in all_keys:
-            target_nodes = key_nodes_map[key]
-            value_found = False
-            current_value = None
-            
-            # Cerca il valore della chiave nei nodi attuali
+    global previous_ring
+    # Una riconfigurazione durante il ribilanciamento non deve essere chiusa da questo passaggio
+    async with sharding_lock:
+        # Per ogni chiave, assicurati che sia sui nodi corretti
+        total_keys = 0
+        rebalanced_keys = 0
+        total_operations = 0
+        failed_operations = 0
+        # Nodi che non hanno restituito tutte le pagine di chiavi: quelle che hanno solo loro non
+        # sono state viste, quindi la migrazione non può dirsi conclusa
+        unreachable: Set[str] = set()
+    
+        # Scorre le chiavi di tutti i nodi a pagine e, per ognuna, controlla dove è attualmente
+        async for key in iter_all_keys(http_client, unreachable):
+            total_keys += 1
+            target_nodes = get_replica_nodes(key)
+        
+            # Legge la chiave da tutti i nodi: si copia la replica con la versione più alta, come
+            # nella lettura, non la prima trovata, che potrebbe essere una copia rimasta indietro
+            found: Dict[str, NodeResponse] = {}
+            read_failed = False
             for node in KVS_NODES:
-                response = await request_node(client, node, "GET", f"/key/{key}")
+                response = await request_node(http_client, node, "GET", f"/key/{key}")
                 total_operations += 1
-                
                 if response.success:
-                    value_found = True
-                    current_value = response.value["value"]
-                    
-                    # Verifica se il nodo dovrebbe avere questa chiave
-                    if node not in target_nodes:
-                        # Rimuovi la chiave da questo nodo
-                        delete_resp = await request_node(client, node, "DELETE", f"/key/{key}")
-                        total_operations += 1
-                        if not delete_resp.success:
-                            failed_operations += 1
-                            logger.warning(f"Impossibile rimuovere la chiave '{key}' dal nodo {node}")
-                    
-                    break
-            
-            if value_found and current_value is not None:
-                # Aggiungi la chiave ai nodi che dovrebbero averla
-                for node in target_nodes:
-                    # Verifica se la chiave è già presente
-                    check_resp = await request_node(client, node, "GET", f"/key/{key}")
+                    found[node] = response
+                elif response.status_code != 404:
+                    # Il nodo potrebbe avere la copia più recente: la lettura conta come fallita
+                    read_failed = True
+                    failed_operations += 1
+                    logger.warning(f"Impossibile leggere la chiave '{key}' dal nodo {node}: {response.error}")
+        
+            if not found:
+                continue
+            newest = newest_response(list(found.values()))
+            current_value = newest.value["value"]
+            current_version = newest.value.get("version")
+        
+            # Aggiungi la chiave ai nodi che dovrebbero averla
+            copy_failed = False
+            for node in target_nodes:
+                # Aggiorna anche le copie con una versione più vecchia di quella scelta e quelle con la
+                # stessa versione ma un valore diverso (assegnata da due primari a nodi senza NODE_ID)
+                existing = found.get(node)
+                outdated = existing is not None and (
+                    (existing.value.get("version") or 0) < (current_version or 0) or
+                    (existing.value.get("version") == current_version and existing.value.get("value") != current_value)
+                )
+                if existing is None or outdated:
+                    # Aggiungi la chiave a questo nodo mantenendo la sua versione
+                    params = {"version": current_version} if current_version is not None else None
+                    put_resp = await request_node(http_client, node, "PUT", f"/key/{key}", json={"value": current_value}, params=params)
                     total_operations += 1
                     
-                    if not check_resp.success:
-                        # Aggiungi la chiave a questo nodo
-                        put_resp = await request_node(client, node, "PUT", f"/key/{key}", json={"value": current_value})
-                        total_operations += 1
-                        
-                        if put_resp.success:
-                            rebalanced_keys += 1
-                        else:
-                            failed_operations += 1
-                            logger.warning(f"Impossibile aggiungere la chiave '{key}' al nodo {node}")
+                    if put_resp.success:
+                        rebalanced_keys += 1
+                    else:
+                        copy_failed = True
+                        failed_operations += 1
+                        logger.warning(f"Impossibile aggiungere la chiave '{key}' al nodo {node}")
+        
+            # Rimuove la chiave dai nodi che non dovrebbero averla solo dopo averla copiata:
+            # se una copia fallisce le repliche vecchie restano l'unica fonte del valore, e se un nodo
+            # non ha risposto la copia scelta potrebbe non essere la più recente
+            if copy_failed or read_failed:
+                continue
+            for node in found:
+                if node not in target_nodes:
+                    delete_resp = await request_node(http_client, node, "DELETE", f"/key/{key}")
+                    total_operations += 1
+                    if not delete_resp.success:
+                        failed_operations += 1
+                        logger.warning(f"Impossibile rimuovere la chiave '{key}' dal nodo {node}")
     
-    return {
-        "status": "completed",
-        "message": f"Ribilanciamento completato: {rebalanced_keys} chiavi ribilanciate, {failed_operations} operazioni fallite",
-        "details": {
-            "total_keys": len(all_keys),
-            "rebalanced_keys": rebalanced_keys,
-            "total_operations": total_operations,
-            "failed_operations": failed_operations
+        # Con tutte le chiavi sui nodi del nuovo posizionamento la migrazione è conclusa
+        migrated_from = None
+        if unreachable:
+            failed_operations += len(unreachable)
+            logger.warning(f"Ribilanciamento incompleto: chiavi non elencate dai nodi {', '.join(sorted(unreachable))}")
+        if previous_ring is not None and failed_operations == 0:
+            migrated_from = previous_ring.describe()
+            previous_ring = None
+            logger.info(f"Migrazione del posizionamento da {migrated_from} a {hash_ring.describe()} completata")
+    
+        return {
+            "status": "completed",
+            "message": f"Ribilanciamento completato: {rebalanced_keys} chiavi ribilanciate, {failed_operations} operazioni fallite",
+            "details": {
+                "total_keys": total_keys,
+                "rebalanced_keys": rebalanced_keys,
+                "total_operations": total_operations,
+                "failed_operations": failed_operations,
+                "unreachable_nodes": sorted(unreachable),
+                "migrated_from": migrated_from
+            }
         }
-    }
 
 # Punto di ingresso
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Genera le copie del nodo (kvs_limited_cache.py) dei capitoli 04 e 05 a partire da
+quella di questo capitolo, che è l'unica da modificare a mano.
+
+- 05_key_value_store_dis1: copia identica
+- 04_key_value_store: versione a nodo singolo, con limiti della cache e file del
+  database fissi invece che letti dalle variabili d'ambiente
+
+Uso:
+    python sync_node_copies.py          # riscrive le copie
+    python sync_node_copies.py --check  # esce con 1 se una copia non è aggiornata
+"""
+
+import argparse
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NODE_FILE = "kvs_limited_cache.py"
+SOURCE_DIR = "06_key_value_store_dis2"
+
+# Differenze della versione del capitolo 04: ogni testo deve comparire una sola volta nella sorgente
+CHAPTER_04_REPLACEMENTS = [
+    (
+        "# Lettura delle variabili d'ambiente\n"
+        "MAX_CACHE_ITEMS = int(os.environ.get(\"MAX_CACHE_ITEMS\", 1000))\n"
+        "MAX_CACHE_SIZE_BYTES = int(os.environ.get(\"MAX_CACHE_SIZE_BYTES\", 10 * 1024 * 1024))  # 10 MB in bytes\n"
+        "DB_FILE = os.environ.get(\"DB_FILE\", \"kv_store.db\")\n"
+        "LOG_FILE = os.environ.get(\"LOG_FILE\", \"kv_store.log\")\n",
+        "",
+    ),
+    (
+        "    filename=LOG_FILE\n",
+        "    filename='kv_store.log'\n",
+    ),
+    (
+        "class StatusResponse(BaseModel):\n"
+        "    status: str\n"
+        "    message: str\n"
+        "\n",
+        "class StatusResponse(BaseModel):\n"
+        "    status: str\n"
+        "    message: str\n"
+        "\n"
+        "# Configurazione limiti cache\n"
+        "MAX_CACHE_ITEMS = 1000  # Numero massimo di elementi in cache\n"
+        "MAX_CACHE_SIZE_BYTES = 10 * 1024 * 1024  # 10 MB in bytes\n"
+        "current_cache_size = 0  # Dimensione attuale della cache in bytes\n"
+        "\n",
+    ),
+    (
+        "# Pool di connessioni SQLite: una connessione per thread, riutilizzata tra le richieste\n",
+        "# Configurazione del database SQLite\n"
+        "DB_FILE = \"kv_store.db\"\n"
+        "\n"
+        "# Pool di connessioni SQLite: una connessione per thread, riutilizzata tra le richieste\n",
+    ),
+    (
+        "    # Assicurati che la directory del DB esista\n"
+        "    db_dir = os.path.dirname(DB_FILE)\n"
+        "    if db_dir and not os.path.exists(db_dir):\n"
+        "        os.makedirs(db_dir)\n"
+        "    \n",
+        "",
+    ),
+    (
+        "    logger.info(f\"Configurazione: MAX_CACHE_ITEMS={MAX_CACHE_ITEMS}, MAX_CACHE_SIZE_BYTES={MAX_CACHE_SIZE_BYTES}, DB_FILE={DB_FILE}\")\n",
+        "",
+    ),
+    (
+        "    return {\"message\": \"Key-Value Store\"}\n",
+        "    return {\"message\": \"Key-Value Store Distribuito\"}\n",
+    ),
+]
+
+def chapter_04_source(source: str) -> str:
+    """Applica alla sorgente le differenze del capitolo 04"""
+    for old, new in CHAPTER_04_REPLACEMENTS:
+        count = source.count(old)
+        if count != 1:
+            raise ValueError(f"Testo da sostituire trovato {count} volte invece di una: {old.splitlines()[0]!r}")
+        source = source.replace(old, new)
+    return source
+
+def generated_copies() -> dict:
+    """Contenuto atteso di ogni copia, per percorso relativo"""
+    with open(os.path.join(BASE_DIR, SOURCE_DIR, NODE_FILE), encoding="utf-8") as f:
+        source = f.read()
+    return {
+        os.path.join("05_key_value_store_dis1", NODE_FILE): source,
+        os.path.join("04_key_value_store", NODE_FILE): chapter_04_source(source),
+    }
+
+def outdated_copies() -> list:
+    """Copie il cui contenuto differisce da quello generato"""
+    outdated = []
+    for path, content in generated_copies().items():
+        try:
+            with open(os.path.join(BASE_DIR, path), encoding="utf-8") as f:
+                current = f.read()
+        except FileNotFoundError:
+            current = None
+        if current != content:
+            outdated.append(path)
+    return outdated
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera le copie del nodo dei capitoli 04 e 05")
+    parser.add_argument("--check", action="store_true", help="Verifica soltanto che le copie siano aggiornate")
+    args = parser.parse_args()
+
+    if args.check:
+        outdated = outdated_copies()
+        for path in outdated:
+            print(f"Copia non aggiornata: {path}")
+        sys.exit(1 if outdated else 0)
+
+    for path, content in generated_copies().items():
+        with open(os.path.join(BASE_DIR, path), "w", encoding="utf-8") as f:
+            f.write(content)
+        print(f"Generato {path}")
+
+if __name__ == "__main__":
+    main()
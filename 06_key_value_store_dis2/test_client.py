@@ -135,17 +135,24 @@ def main():
     
     elif args.command == "keys":
         try:
-            response = requests.get(f"{base_url}/keys")
-            if response.status_code == 200:
+            # Le chiavi arrivano a pagine: next_after è il cursore della pagina successiva
+            after = ""
+            total = 0
+            while after is not None:
+                response = requests.get(f"{base_url}/keys", params={"after": after})
+                if response.status_code != 200:
+                    print_colored(f"Errore: {response.status_code} - {response.text}", "red")
+                    break
                 data = response.json()
-                if data['keys']:
+                if data['keys'] and total == 0:
                     print_colored("Chiavi presenti:", "blue")
-                    for key in data['keys']:
-                        print(f"  - {key}")
-                else:
-                    print_colored("Nessuna chiave presente nel sistema", "yellow")
+                for key in data['keys']:
+                    print(f"  - {key}")
+                total += len(data['keys'])
+                after = data['next_after']
             else:
-                print_colored(f"Errore: {response.status_code} - {response.text}", "red")
+                if total == 0:
+                    print_colored("Nessuna chiave presente nel sistema", "yellow")
         except Exception as e:
             print_colored(f"Errore: {str(e)}", "red")
     
@@ -186,19 +193,26 @@ def main():
     
     elif args.command == "node-keys":
         try:
-            response = requests.get(f"{base_url}/sharding/node-keys/{args.node}")
-            if response.status_code == 200:
+            # Come per "keys", le pagine del nodo si leggono seguendo next_after
+            after = ""
+            node_keys = []
+            while after is not None:
+                response = requests.get(f"{base_url}/sharding/node-keys/{args.node}", params={"after": after})
+                if response.status_code != 200:
+                    print_colored(f"Errore: {response.status_code} - {response.text}", "red")
+                    break
                 data = response.json()
+                node_keys.extend(data['keys'])
+                after = data['next_after']
+            else:
                 print_colored(f"Chiavi presenti sul nodo '{args.node}':", "blue")
-                print(f"  - Numero di chiavi: {data['keys_count']}")
-                if data['keys']:
+                print(f"  - Numero di chiavi: {len(node_keys)}")
+                if node_keys:
                     print_colored("  - Chiavi:", "green")
-                    for key in data['keys']:
+                    for key in node_keys:
                         print(f"    * {key}")
                 else:
                     print_colored("  - Nessuna chiave presente sul nodo", "yellow")
-            else:
-                print_colored(f"Errore: {response.status_code} - {response.text}", "red")
         except Exception as e:
             print_colored(f"Errore: {str(e)}", "red")
     
@@ -257,6 +271,8 @@ def main():
                 print(f"  - Chiavi ribilanciate: {data['details']['rebalanced_keys']}")
                 print(f"  - Operazioni totali: {data['details']['total_operations']}")
                 print(f"  - Operazioni fallite: {data['details']['failed_operations']}")
+                if data['details'].get('unreachable_nodes'):
+                    print(f"  - Nodi non raggiungibili: {', '.join(data['details']['unreachable_nodes'])}")
             else:
                 print_colored(f"Errore: {response.status_code} - {response.text}", "red")
         except Exception as e:
@@ -387,6 +403,7 @@ def main():
                         print(f"    - Dimensione cache: {cache['size_bytes']}/{cache['max_size_bytes']} bytes")
                         print(f"    - Utilizzo: {cache['utilization_percent']}%")
                     print(f"    - Elementi nel DB: {stats.get('db_size', 'N/A')}")
+                    print(f"    - Byte nel DB: {stats.get('db_bytes', 'N/A')}")
                     print(f"    - Elementi nella cronologia: {stats.get('history_count', 'N/A')}")
                     print(f"    - Operazioni in attesa: {stats.get('pending_operations', 'N/A')}")
             else:
@@ -0,0 +1,103 @@
+"""
+Fixture comuni: ogni test carica una copia nuova dei moduli (le configurazioni si leggono
+dalle variabili d'ambiente all'import) con il database in una directory temporanea.
+"""
+
+import asyncio
+import importlib.util
+import itertools
+from pathlib import Path
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+NODE_SOURCE = PROJECT_DIR / "kvs_limited_cache.py"
+COORDINATOR_SOURCE = PROJECT_DIR / "coordinator.py"
+
+_module_ids = itertools.count()
+
+def load_module(source: Path):
+    """Importa un file come modulo nuovo, senza riusare quello già importato"""
+    spec = importlib.util.spec_from_file_location(f"{source.stem}_{next(_module_ids)}", source)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def node_env(directory: Path, **env) -> dict:
+    """Variabili d'ambiente di un nodo con tutti i file nella directory indicata"""
+    env = {"DB_FILE": directory / "kv_store.db", "LOG_FILE": directory / "kv_store.log", **env}
+    return {variable: str(value) for variable, value in env.items()}
+
+@pytest.fixture
+def load_node(tmp_path, monkeypatch):
+    """Carica il modulo del nodo con l'ambiente indicato; i file stanno in tmp_path/<nome>"""
+    def load(name: str = "node", **env):
+        directory = tmp_path / name
+        directory.mkdir(exist_ok=True)
+        for variable, value in node_env(directory, **env).items():
+            monkeypatch.setenv(variable, value)
+        return load_module(NODE_SOURCE)
+    return load
+
+class NodeTransport(httpx.AsyncBaseTransport):
+    """Inoltra le richieste del coordinatore ai nodi eseguiti nel processo dei test:
+    un nodo assente dal dizionario si comporta come un nodo spento"""
+
+    def __init__(self, clients: dict):
+        self.clients = clients
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        client = self.clients.get(request.url.netloc.decode())
+        if client is None:
+            raise httpx.ConnectError("Nodo non raggiungibile", request=request)
+        content = await request.aread()
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in ("host", "content-length")}
+        # Il TestClient del nodo ha un proprio event loop: la chiamata bloccante va in un thread
+        response = await asyncio.to_thread(client.request, request.method, request.url.raw_path.decode(),
+                                           content=content, headers=headers)
+        response_headers = {name: value for name, value in response.headers.items()
+                            if name.lower() not in ("content-length", "content-encoding", "transfer-encoding")}
+        return httpx.Response(response.status_code, headers=response_headers, content=response.content)
+
+class Cluster:
+    """Tre nodi e un coordinatore; stop_node/start_node simulano un nodo spento"""
+
+    def __init__(self, coordinator, client: TestClient, nodes: dict):
+        self.coordinator = coordinator
+        self.client = client
+        self.nodes = nodes
+        self.reachable = dict(nodes)
+
+    def stop_node(self, node: str):
+        self.reachable.pop(node)
+
+    def start_node(self, node: str):
+        self.reachable[node] = self.nodes[node]
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch):
+    node_names = [f"node{i}:8050" for i in range(1, 4)]
+    node_clients = {}
+    try:
+        for node_id, name in enumerate(node_names, start=1):
+            directory = tmp_path / name.split(":")[0]
+            directory.mkdir()
+            for variable, value in node_env(directory, NODE_ID=node_id).items():
+                monkeypatch.setenv(variable, value)
+            node_clients[name] = TestClient(load_module(NODE_SOURCE).app).__enter__()
+
+        monkeypatch.setenv("KVS_NODES", ",".join(node_names))
+        monkeypatch.setenv("COORDINATOR_LOG_FILE", str(tmp_path / "coordinator.log"))
+        monkeypatch.setenv("PLACEMENT_STRATEGY", "ring")
+        monkeypatch.setenv("REPLICATION_FACTOR", "0.5")
+        coordinator = load_module(COORDINATOR_SOURCE)
+        with TestClient(coordinator.app) as client:
+            cluster = Cluster(coordinator, client, node_clients)
+            # Il client creato nel lifespan viene sostituito con uno che raggiunge i nodi in memoria
+            coordinator.http_client = httpx.AsyncClient(transport=NodeTransport(cluster.reachable))
+            yield cluster
+    finally:
+        for client in node_clients.values():
+            client.__exit__(None, None, None)
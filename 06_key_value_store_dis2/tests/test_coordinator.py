@@ -0,0 +1,61 @@
+KEYS = [f"chiave{i}" for i in range(30)]
+
+def put_keys(cluster):
+    for key in KEYS:
+        assert cluster.client.put(f"/key/{key}", json={"value": f"valore-{key}"}).status_code == 200
+
+def holders(cluster, key):
+    """Nodi che hanno una copia della chiave, letti direttamente"""
+    return {node for node, client in cluster.nodes.items() if client.get(f"/key/{key}").status_code == 200}
+
+def test_versions_are_unique_per_primary(cluster):
+    put_keys(cluster)
+    node_ids = {f"node{i}:8050": i for i in range(1, 4)}
+    for key in KEYS[:5]:
+        primary = cluster.client.get(f"/sharding/node-for-key/{key}").json()["responsible_nodes"][0]
+        version = cluster.client.get(f"/key/{key}").json()["version"]
+        assert version % 1024 == node_ids[primary]
+
+def test_migration_moves_keys_to_new_placement(cluster):
+    put_keys(cluster)
+    response = cluster.client.post("/sharding/reconfigure", json={
+        "replication_factor": 0.5, "virtual_nodes": 100, "strategy": "rendezvous"
+    })
+    assert response.json()["migrating_from"] is not None
+
+    # Durante la migrazione le chiavi si leggono anche dal posizionamento precedente
+    for key in KEYS:
+        assert cluster.client.get(f"/key/{key}").json()["value"] == f"valore-{key}"
+    # Una seconda riconfigurazione deve aspettare la fine della migrazione
+    assert cluster.client.post("/sharding/reconfigure", json={
+        "replication_factor": 0.5, "virtual_nodes": 100, "strategy": "jump"
+    }).status_code == 409
+
+    details = cluster.client.post("/rebalance").json()["details"]
+    assert details["failed_operations"] == 0
+    assert details["migrated_from"] is not None
+    for key in KEYS:
+        responsible = cluster.client.get(f"/sharding/node-for-key/{key}").json()["responsible_nodes"]
+        assert holders(cluster, key) == set(responsible)
+        assert cluster.client.get(f"/key/{key}").json()["value"] == f"valore-{key}"
+
+def test_migration_stays_open_with_unreachable_node(cluster):
+    put_keys(cluster)
+    cluster.client.post("/sharding/reconfigure", json={
+        "replication_factor": 0.5, "virtual_nodes": 100, "strategy": "rendezvous"
+    })
+
+    cluster.stop_node("node3:8050")
+    details = cluster.client.post("/rebalance").json()["details"]
+    assert details["unreachable_nodes"] == ["node3:8050"]
+    assert details["failed_operations"] > 0
+    assert details["migrated_from"] is None
+    assert cluster.client.get("/sharding/info").status_code == 200
+
+    # Tornato il nodo, il ribilanciamento successivo chiude la migrazione
+    cluster.start_node("node3:8050")
+    details = cluster.client.post("/rebalance").json()["details"]
+    assert details["failed_operations"] == 0
+    assert details["migrated_from"] is not None
+    for key in KEYS:
+        assert cluster.client.get(f"/key/{key}").json()["value"] == f"valore-{key}"
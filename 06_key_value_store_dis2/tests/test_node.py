@@ -0,0 +1,99 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import NODE_SOURCE, node_env
+
+# Scrive sul nodo e termina il processo senza arresto ordinato: le ultime operazioni
+# sono solo nel log delle operazioni, non ancora nel database
+CRASH_SCRIPT = """
+import os, sys
+sys.path.insert(0, sys.argv[1])
+from conftest import load_module, NODE_SOURCE
+from fastapi.testclient import TestClient
+client = TestClient(load_module(NODE_SOURCE).app).__enter__()
+for i in range(20):
+    client.put(f"/key/k{i}", json={"value": f"v{i}"})
+client.post("/force-sync")
+client.put("/key/k0", json={"value": "nuovo"})
+client.delete("/key/k1")
+client.put("/key/k20", json={"value": "v20"})
+assert client.get("/stats").json()["pending_operations"] > 0
+os._exit(1)
+"""
+
+def test_crash_replay(tmp_path, load_node):
+    env = dict(os.environ, **node_env(tmp_path / "node", BATCH_SIZE_THRESHOLD=1000, BATCH_TIME_THRESHOLD=60))
+    (tmp_path / "node").mkdir()
+    crashed = subprocess.run([sys.executable, "-c", CRASH_SCRIPT, os.path.dirname(__file__)], env=env)
+    assert crashed.returncode == 1
+
+    node = load_node(CACHE_WARMUP="none")
+    with TestClient(node.app) as client:
+        assert client.get("/key/k0").json()["value"] == "nuovo"
+        assert client.get("/key/k1").status_code == 404
+        assert client.get("/key/k20").json()["value"] == "v20"
+        assert client.get("/key/k19").json()["value"] == "v19"
+
+def test_etag_and_if_version(load_node):
+    with TestClient(load_node().app) as client:
+        assert client.put("/key/k", params={"if_version": 0}, json={"value": "a"}).status_code == 200
+        response = client.get("/key/k")
+        version = response.json()["version"]
+        assert response.headers["etag"] == f'"{version}"'
+        assert client.get("/key/k", headers={"If-None-Match": f'"{version}"'}).status_code == 304
+
+        # Una scrittura con una versione superata non sovrascrive il valore
+        assert client.put("/key/k", params={"if_version": 0}, json={"value": "b"}).status_code == 412
+        assert client.put("/key/k", params={"if_version": version + 1}, json={"value": "b"}).status_code == 412
+        assert client.put("/key/k", params={"if_version": version}, json={"value": "b"}).status_code == 200
+        assert client.get("/key/k").json()["value"] == "b"
+        assert client.get("/key/k", headers={"If-None-Match": f'"{version}"'}).status_code == 200
+
+def test_versions_carry_node_id(load_node):
+    with TestClient(load_node(NODE_ID=2).app) as client:
+        versions = [client.put("/key/k", json={"value": str(i)}).json()["version"] for i in range(3)]
+    assert versions == [1026, 2050, 3074]
+
+def test_keys_pagination(load_node):
+    with TestClient(load_node().app) as client:
+        expected = sorted(f"k{i:02d}" for i in range(25))
+        client.post("/mput", json={"items": {key: "v" for key in expected}})
+        client.delete("/key/k10")
+        expected.remove("k10")
+
+        keys, after, pages = [], "", 0
+        while after is not None:
+            page = client.get("/keys", params={"after": after, "limit": 7}).json()
+            keys.extend(page["keys"])
+            after = page["next_after"]
+            pages += 1
+        assert keys == expected
+        assert pages == 4
+
+        # La chiave vuota non sarebbe raggiungibile dal cursore after
+        assert client.post("/mput", json={"items": {"": "v"}}).status_code == 422
+
+@pytest.mark.parametrize("env", [
+    {"CACHE_POLICY": "lru"},
+    {"CACHE_POLICY": "lru", "CACHE_READ_PROMOTION": "clock"},
+    {"CACHE_POLICY": "tinylfu"},
+    {"CACHE_POLICY": "arc"},
+    {"CACHE_POLICY": "2q"},
+    {"CACHE_SHARDS": 4},
+])
+def test_eviction_budgets(load_node, env):
+    node = load_node(MAX_CACHE_ITEMS=20, MAX_CACHE_SIZE_BYTES=4000, **env)
+    with TestClient(node.app) as client:
+        for i in range(100):
+            client.put(f"/key/k{i}", json={"value": os.urandom(60).hex()})
+            client.get(f"/key/k{i % 10}")
+            cache = client.get("/stats").json()["cache"]
+            assert cache["items_count"] <= 20
+            assert cache["size_bytes"] <= 4000
+        assert cache["evictions"] > 0
+        # I valori rimossi dalla cache restano leggibili dal database
+        assert all(client.get(f"/key/k{i}").status_code == 200 for i in range(100))
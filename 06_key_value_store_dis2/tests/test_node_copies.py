@@ -0,0 +1,10 @@
+import sys
+
+from conftest import PROJECT_DIR
+
+sys.path.insert(0, str(PROJECT_DIR))
+from sync_node_copies import outdated_copies
+
+def test_node_copies_are_generated():
+    # Le copie dei capitoli 04 e 05 si rigenerano con: python sync_node_copies.py
+    assert outdated_copies() == []